@@ -0,0 +1,464 @@
+# Асинхронная среда выполнения бота на основе AsyncTeleBot (BOT_RUNTIME=async).
+#
+# Команды /join, /exit, /view и нажатия кнопок обрабатываются сопрограммами в одном
+# цикле событий, поэтому одновременные обновления не требуют потока на каждое.
+# Обращения к базе данных выполняются в отдельном пуле потоков, остальные сообщения
+# передаются обработчикам синхронного бота из модуля handlers.
+#
+# Требует aiohttp: pip install .[async]
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import telebot
+from telebot.async_telebot import AsyncTeleBot
+
+from config import BOT_TOKEN, BOT_MODE, EDIT_COALESCE_WINDOW, DB_EXECUTOR_WORKERS
+from config import WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL
+from config import WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY, TELEGRAM_API_URL
+from outbound import get_retry_after
+from webhook import WebhookServer
+from storage import default_storage as db
+import handlers
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Локальный сервер Bot API вместо api.telegram.org
+if TELEGRAM_API_URL:
+    telebot.asyncio_helper.API_URL = TELEGRAM_API_URL
+
+# Асинхронный экземпляр бота
+bot = AsyncTeleBot(BOT_TOKEN)
+
+# Пул потоков для обращений к базе данных
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_db(func, *args):
+    """Выполнение синхронной функции, работающей с базой данных, в пуле db_executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+async def acquire_outbound(chat_id):
+    """
+    Ожидание разрешения на отправку запроса в чат.
+
+    Токены берутся из ведер handlers.outbound_governor: синхронные обработчики, которым
+    передаются остальные сообщения, отправляют запросы через него же, поэтому у процесса
+    один общий лимит и один лимит каждой группы.
+    """
+    while True:
+        wait = handlers.outbound_governor.take_tokens(chat_id)
+        if not wait:
+            return
+        await asyncio.sleep(wait)
+
+async def send(chat_id, method, request, max_retries=3):
+    """
+    Выполнение запроса к Telegram с учетом лимитов и повтором при ошибке 429.
+
+    Args:
+        chat_id: чат назначения (None - запрос не относится к чату)
+        method: название метода Bot API (для метрик)
+        request: функция без аргументов, возвращающая сопрограмму запроса
+        max_retries: максимальное количество повторов
+    """
+    for attempt in range(max_retries + 1):
+        await acquire_outbound(chat_id)
+        try:
+            with metrics.API_LATENCY.time(method):
+                return await request()
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                metrics.API_RATE_LIMITED.inc(method)
+            if retry_after is None or attempt == max_retries:
+                raise
+            delay = max(retry_after, 2 ** attempt)
+            logger.warning(f"Rate limit exceeded in chat {chat_id}. Retry {attempt + 1}/{max_retries} after {delay} seconds")
+            await asyncio.sleep(delay)
+
+async def reply(message, text, **kwargs):
+    """Ответ на сообщение; ошибки записываются в лог"""
+    try:
+        return await send(message.chat.id, 'sendMessage', lambda: bot.reply_to(message, text, **kwargs))
+    except Exception as e:
+        logger.error(f"Failed to reply to message: {str(e)}")
+
+async def answer_callback(call, text):
+    """Ответ на нажатие кнопки; ошибки записываются в лог"""
+    try:
+        await send(None, 'answerCallbackQuery', lambda: bot.answer_callback_query(call.id, text))
+    except Exception as e:
+        logger.error(f"Failed to answer callback query: {str(e)}")
+
+async def reply_with_queue(message, text, queue_name, queue_id, version, page=1, pages=1):
+    """Ответ с текстом очереди и клавиатурой, версия очереди и страница запоминаются для сообщения"""
+    keyboard = handlers.create_queue_keyboard(queue_id, version, page, pages)
+    sent = await reply(message, text, parse_mode="Markdown", reply_markup=keyboard)
+    if sent is not None and version is not None:
+        key = (sent.chat.id, sent.message_id)
+        handlers.message_versions.put(key, (queue_id, version, page))
+        handlers.message_pages.put(key, (queue_id, page))
+
+# Изменения сообщений, ожидающие окончания окна объединения: (chat_id, message_id) -> (queue_name, queue_id)
+pending_edits = {}
+
+# Выполняющиеся задачи изменения сообщений: цикл событий хранит только слабые ссылки на задачи
+edit_tasks = set()
+
+def start_queue_message_update(key):
+    """Запуск изменения сообщения по окончании окна объединения"""
+    task = asyncio.get_running_loop().create_task(update_queue_message(key))
+    edit_tasks.add(task)
+    task.add_done_callback(finish_queue_message_update)
+
+def finish_queue_message_update(task):
+    """Удаление завершенной задачи изменения сообщения, ошибка записывается в лог"""
+    edit_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Error updating message: {str(task.exception())}", exc_info=task.exception())
+
+def schedule_queue_message_update(chat_id, message_id, queue_name, queue_id, page=None):
+    """Отложенное обновление сообщения с очередью (аналог handlers.schedule_queue_message_update)"""
+    key = (chat_id, message_id)
+    if page is not None:
+        handlers.message_pages.put(key, (queue_id, page))
+    is_first = key not in pending_edits
+    pending_edits[key] = (queue_name, queue_id)
+    if is_first:
+        asyncio.get_running_loop().call_later(EDIT_COALESCE_WINDOW, start_queue_message_update, key)
+
+async def update_queue_message(key):
+    """Изменение сообщения с очередью, если в нем показана не последняя версия очереди"""
+    queue_name, queue_id = pending_edits.pop(key)
+    chat_id, message_id = key
+    rendered = await run_db(handlers.render_queue, queue_name, queue_id, None, handlers.shown_page(key, queue_id))
+    handlers.message_pages.put(key, (queue_id, rendered.page))
+    shown = (queue_id, rendered.version, rendered.page)
+    if rendered.version is not None and handlers.message_versions.get(key) == shown:
+        return
+
+    handlers.message_versions.put(key, shown)
+    keyboard = handlers.create_queue_keyboard(queue_id, rendered.version, rendered.page, rendered.pages)
+    try:
+        await send(chat_id, 'editMessageText', lambda: bot.edit_message_text(
+            rendered.text, chat_id=chat_id, message_id=message_id,
+            parse_mode="Markdown", reply_markup=keyboard
+        ))
+    except Exception as e:
+        # Игнорируем ошибку "message is not modified"; при остальных ошибках (в том числе
+        # после исчерпания повторов) версия забывается, чтобы следующее нажатие обновило сообщение
+        if "message is not modified" not in str(e):
+            logger.error(f"Error updating message: {str(e)}")
+            if handlers.message_versions.peek(key) == shown:
+                handlers.message_versions.pop(key)
+
+# Блокировки чатов: обновления одного чата обрабатываются по одному в порядке поступления,
+# как в полосах handlers.update_dispatcher. chat_id -> [блокировка, число обработчиков]
+chat_locks = {}
+
+def chat_ordered(chat_id_of):
+    """
+    Обработка обновлений одного чата по очереди.
+
+    Обработчик ждет завершения предыдущих обработчиков своего чата; asyncio.Lock
+    пропускает ожидающих в порядке вызова. Блокировка удаляется, когда ее никто не ждет.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update):
+            chat_id = chat_id_of(update)
+            entry = chat_locks.get(chat_id)
+            if entry is None:
+                entry = chat_locks[chat_id] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    return await func(update)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del chat_locks[chat_id]
+        return wrapper
+    return decorator
+
+def message_chat_id(message):
+    return message.chat.id
+
+def callback_chat_id(call):
+    return call.message.chat.id if call.message is not None else call.from_user.id
+
+def timed_handler(label):
+    """Асинхронный аналог handlers.timed_handler"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update):
+            with metrics.HANDLER_LATENCY.time(label(update) if callable(label) else label):
+                return await func(update)
+        return wrapper
+    return decorator
+
+def rate_limited(command_type='default'):
+    """Асинхронный аналог handlers.rate_limit_decorator"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(message):
+            user_id = message.from_user.id
+            is_limited, wait_time = handlers.check_rate_limit(user_id, command_type)
+            if is_limited:
+                logger.warning(f"Rate limit exceeded for user {user_id}, command type {command_type}")
+                await reply(message, f"Пожалуйста, не отправляйте команды слишком часто. Попробуйте снова через {wait_time} сек.")
+                return
+
+            if message.chat.type in ['group', 'supergroup']:
+                is_chat_limited, _ = handlers.check_rate_limit(None, 'chat', message.chat.id)
+                if is_chat_limited:
+                    logger.warning(f"Chat rate limit exceeded for chat {message.chat.id}")
+                    return
+
+            return await func(message)
+        return wrapper
+    return decorator
+
+def command_argument(message):
+    """Текст после команды или None"""
+    command_parts = message.text.split(' ', 1)
+    if len(command_parts) < 2 or not command_parts[1].strip():
+        return None
+    return command_parts[1].strip()
+
+async def update_user_info(user):
+    """Добавление или обновление пользователя в базе данных"""
+    # Известный пользователь без изменений не требует обращения к пулу потоков базы данных
+    profile = handlers.user_profiles.peek(user.id)
+    if profile is not None and profile[1] and profile[0] == (user.username or ""):
+        return
+    await run_db(handlers.update_user_info, user.id, user.username or "", user.first_name, user.last_name)
+
+# Обработчик команды /join
+@bot.message_handler(commands=['join'])
+@chat_ordered(message_chat_id)
+@timed_handler('join')
+@rate_limited('join')
+async def join_queue(message):
+    try:
+        queue_name = command_argument(message)
+        if queue_name is None:
+            await reply(message, "Пожалуйста, укажите название очереди. Пример: `/join Математика`", parse_mode="Markdown")
+            return
+
+        chat_id = message.chat.id
+        user_id = message.from_user.id
+        await update_user_info(message.from_user)
+
+        result = await run_db(db.join_by_name, chat_id, queue_name, user_id)
+        if result.status == db.QUEUE_NOT_FOUND:
+            await reply(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+            return
+        if result.status == db.ALREADY_MEMBER:
+            await reply(message, f"Вы уже состоите в очереди '{queue_name}'.")
+            return
+
+        queue_id = result.queue_id
+        queue_info, version, page, pages = await run_db(handlers.render_queue, queue_name, queue_id, result.snapshot,
+                                                        handlers.page_of(result.position))
+        await reply_with_queue(message, f"Вы успешно присоединились к очереди '*{queue_name}*'!\n\n{queue_info}",
+                               queue_name, queue_id, version, page, pages)
+
+    except Exception as e:
+        logger.error(f"Error during joining queue: {str(e)}", exc_info=True)
+        await reply(message, f"Произошла ошибка при присоединении к очереди: {str(e)}")
+
+# Обработчик команды /exit
+@bot.message_handler(commands=['exit'])
+@chat_ordered(message_chat_id)
+@timed_handler('exit')
+@rate_limited('default')
+async def exit_queue(message):
+    try:
+        queue_name = command_argument(message)
+        if queue_name is None:
+            await reply(message, "Пожалуйста, укажите название очереди. Пример: `/exit Математика`", parse_mode="Markdown")
+            return
+
+        chat_id = message.chat.id
+        user_id = message.from_user.id
+
+        result = await run_db(db.exit_by_name, chat_id, queue_name, user_id)
+        if result.status == db.QUEUE_NOT_FOUND:
+            await reply(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+            return
+        if result.status == db.NOT_MEMBER:
+            await reply(message, f"Вы не состоите в очереди '{queue_name}'.")
+            return
+
+        queue_id = result.queue_id
+        _, total = await run_db(handlers.operation_queue_state, result)
+        if total:
+            queue_info, version, page, pages = await run_db(handlers.render_queue, queue_name, queue_id, result.snapshot)
+            await reply_with_queue(message, f"Вы успешно вышли из очереди '*{queue_name}*'.\n\n{queue_info}",
+                                   queue_name, queue_id, version, page, pages)
+        else:
+            await reply(message, f"Вы успешно вышли из очереди '{queue_name}'.\nОчередь теперь пуста.")
+
+    except Exception as e:
+        logger.error(f"Error during exiting queue: {str(e)}", exc_info=True)
+        await reply(message, f"Произошла ошибка при выходе из очереди: {str(e)}")
+
+# Обработчик команды /view
+@bot.message_handler(commands=['view'])
+@chat_ordered(message_chat_id)
+@timed_handler('view')
+@rate_limited('default')
+async def view_queue(message):
+    try:
+        chat_id = message.chat.id
+        queue_name = command_argument(message)
+
+        if queue_name is None:
+            queues = await run_db(db.get_all_queues, chat_id)
+            if not queues:
+                await reply(message, "В этом чате пока нет очередей. Создайте новую с помощью команды `/create`.", parse_mode="Markdown")
+                return
+
+            queues_list = "\n".join([f"📋 {name} - {count} участник(ов)" for name, count in queues])
+            await reply(message, f"Список очередей в этом чате:\n\n{queues_list}\n\nДля просмотра конкретной очереди используйте `/view [название очереди]`", parse_mode="Markdown")
+            return
+
+        queue_id = await run_db(db.get_queue_id, queue_name, chat_id)
+        if not queue_id:
+            await reply(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+            return
+
+        queue_info, version, page, pages = await run_db(handlers.render_queue, queue_name, queue_id)
+        await reply_with_queue(message, queue_info, queue_name, queue_id, version, page, pages)
+
+    except Exception as e:
+        logger.error(f"Error during viewing queue: {str(e)}", exc_info=True)
+        await reply(message, f"Произошла ошибка при просмотре очереди: {str(e)}")
+
+# Остальные сообщения обрабатываются синхронными обработчиками модуля handlers
+# в полосе своего чата (handlers.update_dispatcher), не блокируя цикл событий.
+# Блокировка чата удерживается до завершения обработчика, чтобы следующие
+# команды чата не обогнали его
+@bot.message_handler(func=lambda message: True, content_types=['text'])
+@chat_ordered(message_chat_id)
+async def delegate_to_threaded_handlers(message):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def finish():
+        if not done.done():
+            done.set_result(None)
+
+    def process():
+        try:
+            handlers.bot.process_new_messages([message])
+        finally:
+            loop.call_soon_threadsafe(finish)
+
+    handlers.update_dispatcher.submit(message.chat.id, process)
+    await done
+
+# Обработчик изменений статуса участников чата
+@bot.chat_member_handler()
+@chat_ordered(message_chat_id)
+async def handle_chat_member_update(update):
+    handlers.handle_chat_member_update(update)
+
+# Обработчик нажатий на инлайн-кнопки: действия описаны в реестре handlers.CALLBACK_ACTIONS,
+# операция с очередью и выбор ответа - общая функция handlers.execute_callback
+@bot.callback_query_handler(func=lambda call: True)
+@chat_ordered(callback_chat_id)
+@timed_handler(handlers.callback_handler_label)
+async def handle_callback_query(call):
+    try:
+        callback, action = handlers.decode_callback(call)
+        chat_id = call.message.chat.id
+        user_id = call.from_user.id
+
+        is_limited, wait_time = handlers.check_rate_limit(user_id, handlers.callback_rate_limit(action))
+        if is_limited:
+            logger.warning(f"Rate limit exceeded for user {user_id} in callback query")
+            await answer_callback(call, f"Пожалуйста, не нажимайте кнопки слишком часто. Подождите {wait_time} сек.")
+            return
+
+        if action is None:
+            await answer_callback(call, handlers.UNKNOWN_CALLBACK_ANSWER)
+            return
+
+        await update_user_info(call.from_user)
+
+        outcome = await run_db(handlers.execute_callback, chat_id, user_id, callback, action)
+        await answer_callback(call, outcome.answer)
+        if outcome.refresh:
+            schedule_queue_message_update(chat_id, call.message.message_id, outcome.queue_name,
+                                          outcome.queue_id, outcome.page)
+
+    except Exception as e:
+        error_msg = str(e)
+        if len(error_msg) > 50:
+            error_msg = error_msg[:47] + "..."
+        await answer_callback(call, f"Ошибка: {error_msg}")
+        logger.error(f"Error in callback query: {str(e)}", exc_info=True)
+
+async def run_webhook():
+    """Получение обновлений через встроенный HTTP-сервер и передача их в цикл событий"""
+    loop = asyncio.get_running_loop()
+
+    def on_update(update_json):
+        update = telebot.types.Update.de_json(update_json)
+        asyncio.run_coroutine_threadsafe(bot.process_new_updates([update]), loop)
+
+    server = WebhookServer(
+        WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, on_update,
+        secret_token=WEBHOOK_SECRET or None,
+        ssl_cert=WEBHOOK_SSL_CERT or None,
+        ssl_key=WEBHOOK_SSL_KEY or None
+    )
+    if WEBHOOK_URL:
+        certificate = open(WEBHOOK_SSL_CERT, 'rb') if WEBHOOK_SSL_CERT else None
+        try:
+            await bot.set_webhook(url=WEBHOOK_URL, certificate=certificate, secret_token=WEBHOOK_SECRET or None,
+                                  allowed_updates=handlers.ALLOWED_UPDATES)
+        finally:
+            if certificate is not None:
+                certificate.close()
+        logger.info(f"Webhook set to {WEBHOOK_URL}")
+
+    server.start()
+    try:
+        # Сервер работает в своем потоке, цикл событий обрабатывает обновления до остановки
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+
+async def start_bot():
+    """Запуск бота в асинхронном режиме"""
+    me = await bot.get_me()
+    logger.info("===== QueueMateBot started (asyncio runtime) =====")
+    logger.info(f"Bot name: {me.first_name}")
+    logger.info(f"Bot username: @{me.username}")
+    logger.info(f"Bot ID: {me.id}")
+    logger.info("====================================")
+    handlers.start_metrics_server()
+
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await bot.polling(non_stop=True, interval=3, timeout=30, allowed_updates=handlers.ALLOWED_UPDATES)
+    except Exception as e:
+        logger.error(f"Error during bot operation: {str(e)}", exc_info=True)
+    finally:
+        await bot.close_session()
+        if handlers.metrics_server is not None:
+            handlers.metrics_server.stop()
+        handlers.outbound_governor.stop()
+        handlers.retry_scheduler.stop()
+        db_executor.shutdown(wait=True)
+        logger.info("Bot has finished working")
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Бенчмарк пропускной способности /view при параллельных запросах.
+
+Сравнивает пул соединений в режиме WAL из модуля database с прежней схемой,
+в которой все потоки работали через одно соединение под глобальной блокировкой.
+Обе схемы выполняют одни и те же запросы к базе данных; кэш очередей модуля
+database не используется, поэтому измеряется доступ к базе, а не чтение из памяти.
+
+Запуск:
+    python benchmarks/bench_db_pool.py [--threads 8] [--views 2000] [--members 50]
+"""
+
+import argparse
+import contextlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="qm_bench_")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ["DB_NAME"] = os.path.join(_tmp_dir, "bench.db")
+
+import database as db  # noqa: E402
+
+
+# Запросы /view без кэша очередей
+QUEUE_ID_SQL = "SELECT queue_id FROM Queues WHERE queue_name = ? AND chat_id = ?"
+CREATOR_SQL = """
+    SELECT u.display_name
+    FROM Queues q
+    JOIN Users u ON q.creator_id = u.user_id
+    WHERE q.queue_id = ?
+"""
+MEMBERS_SQL = """
+    SELECT u.display_name, u.username, qm.join_order, qm.user_id
+    FROM QueueMembers qm
+    JOIN Users u ON qm.user_id = u.user_id
+    WHERE qm.queue_id = ?
+    ORDER BY qm.join_order
+"""
+
+
+class PooledViews:
+    """Запросы /view через соединения пула модуля database (свое соединение у каждого потока)"""
+
+    def cursor(self):
+        return contextlib.nullcontext(db._read_cursor())
+
+    def get_queue_id(self, queue_name, chat_id):
+        with self.cursor() as cursor:
+            cursor.execute(QUEUE_ID_SQL, (queue_name, chat_id))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def get_queue_creator(self, queue_id):
+        with self.cursor() as cursor:
+            cursor.execute(CREATOR_SQL, (queue_id,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+
+    def get_queue_members(self, queue_id):
+        with self.cursor() as cursor:
+            cursor.execute(MEMBERS_SQL, (queue_id,))
+            return cursor.fetchall()
+
+    def close(self):
+        db.close_connection()
+
+
+class LockSerializedViews(PooledViews):
+    """Воспроизведение прежней схемы: одно соединение и одна блокировка на все потоки"""
+
+    def __init__(self, db_name):
+        self.connection = sqlite3.connect(db_name, check_same_thread=False)
+        self._cursor = self.connection.cursor()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def cursor(self):
+        with self.lock:
+            yield self._cursor
+
+    def close(self):
+        self.connection.close()
+
+
+def populate(members):
+    """Заполнение базы: один чат, одна очередь и members участников"""
+    db.init_database()
+    chat_id = -100
+    db.add_chat(chat_id, "Benchmark")
+    db.add_or_update_user(1, "creator", "Создатель")
+    queue_id = db.create_queue("Математика", chat_id, 1)
+    for user_id in range(2, members + 2):
+        db.add_or_update_user(user_id, f"user{user_id}", f"Студент {user_id}")
+        db.add_user_to_queue(queue_id, user_id)
+    return chat_id
+
+
+def run_views(backend, chat_id, threads, views):
+    """Параллельное выполнение запросов /view, возвращает число просмотров в секунду"""
+    per_thread = views // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker():
+        barrier.wait()
+        for _ in range(per_thread):
+            queue_id = backend.get_queue_id("Математика", chat_id)
+            backend.get_queue_creator(queue_id)
+            backend.get_queue_members(queue_id)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=8, help="количество потоков-обработчиков")
+    parser.add_argument("--views", type=int, default=2000, help="общее количество просмотров")
+    parser.add_argument("--members", type=int, default=50, help="размер очереди")
+    args = parser.parse_args()
+
+    chat_id = populate(args.members)
+
+    baseline = LockSerializedViews(os.environ["DB_NAME"])
+    baseline_rate = run_views(baseline, chat_id, args.threads, args.views)
+    baseline.close()
+
+    pooled = PooledViews()
+    pooled_rate = run_views(pooled, chat_id, args.threads, args.views)
+    pooled.close()
+
+    print(f"Потоков: {args.threads}, просмотров: {args.views}, участников в очереди: {args.members}")
+    print(f"Глобальная блокировка:  {baseline_rate:10.1f} просмотров/с")
+    print(f"Пул соединений (WAL):   {pooled_rate:10.1f} просмотров/с")
+    print(f"Ускорение:              {pooled_rate / baseline_rate:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
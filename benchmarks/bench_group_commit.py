@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Бенчмарк групповой фиксации записей.
+
+Моделирует ситуацию, когда вся группа одновременно нажимает «Присоединиться»:
+каждый поток обновляет данные пользователя и добавляет его в очередь.
+Сравнивается фиксация каждой операции отдельно и групповая фиксация фоновым
+писателем с разными окнами группировки.
+
+Запуск:
+    python benchmarks/bench_group_commit.py [--users 100] [--synchronous FULL] [--windows 2,5,20]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="qm_bench_")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ["DB_NAME"] = os.path.join(_tmp_dir, "bench.db")
+
+
+def run_joins(db, users, round_number):
+    """Одновременное присоединение users пользователей к новой очереди, возвращает время в секундах"""
+    chat_id = -100 - round_number
+    db.add_chat(chat_id, "Benchmark")
+    db.add_or_update_user(1, "creator", "Создатель")
+    queue_id = db.create_queue(f"Очередь {round_number}", chat_id, 1)
+    barrier = threading.Barrier(users + 1)
+
+    def press_join(user_id):
+        barrier.wait()
+        db.add_or_update_user(user_id, f"user{user_id}", f"Студент {user_id}")
+        db.add_user_to_queue(queue_id, user_id)
+
+    threads = [threading.Thread(target=press_join, args=(user_id,)) for user_id in range(2, users + 2)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    assert db.get_queue_members_count(queue_id) == users
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="количество одновременных нажатий")
+    parser.add_argument("--synchronous", default="FULL", help="режим PRAGMA synchronous (FULL, NORMAL, OFF)")
+    parser.add_argument("--windows", default="2,5,20", help="окна группировки в миллисекундах через запятую")
+    args = parser.parse_args()
+
+    os.environ["DB_SYNCHRONOUS"] = args.synchronous
+    import database as db
+
+    db.init_database()
+    writes = args.users * 2
+
+    elapsed = run_joins(db, args.users, 0)
+    print(f"Пользователей: {args.users}, операций записи: {writes}, synchronous={args.synchronous}")
+    print(f"Фиксация каждой операции:       {elapsed * 1000:8.1f} мс, фиксаций: {writes + 3}")
+
+    for round_number, window in enumerate(args.windows.split(","), 1):
+        db._group_writer = db.GroupCommitWriter(window_ms=float(window))
+        elapsed = run_joins(db, args.users, round_number)
+        batches = db._group_writer.batches
+        db._group_writer.stop()
+        db._group_writer = None
+        print(f"Групповая фиксация, окно {float(window):4.0f} мс: {elapsed * 1000:8.1f} мс, фиксаций: {batches}")
+
+    db.close_connection()
+
+
+if __name__ == "__main__":
+    main()
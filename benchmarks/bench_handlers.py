@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+Нагрузочный тест обработчиков бота на синтетическом потоке обновлений.
+
+Строит объекты telebot.types.Update для команд /join и /view и нажатий
+инлайн-кнопок («Присоединиться», «Выйти», «В конец», «Пропустить») в N чатах
+по M пользователей и передает их зарегистрированным обработчикам модуля handlers
+через bot.process_new_updates, пачками, как при получении getUpdates.
+
+Запросы к Bot API не уходят в сеть: их принимает функция
+apihelper.CUSTOM_REQUEST_SENDER, отвечающая с заданной задержкой. Ограничения
+исходящих запросов (OUTBOUND_LIMITS) и команд пользователей (RATE_LIMITS)
+по умолчанию отключены, чтобы измерялись обработчики, а не лимиты.
+
+Для каждого обработчика выводятся p50/p99 времени выполнения, времени в
+функциях модуля database и ожидания блокировки записи db_write_lock. Результаты
+можно сохранить в JSON (--json) и сравнивать между версиями кода.
+
+Запуск:
+    python benchmarks/bench_handlers.py [--chats 20] [--users 30] [--actions 5]
+                                        [--latency 20] [--group-commit] [--legacy-callbacks]
+                                        [--json result.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="qm_bench_")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ["DB_NAME"] = os.path.join(_tmp_dir, "bench.db")
+os.environ.setdefault("EDIT_COALESCE_WINDOW", "0.05")
+
+# Размер пачки обновлений, как в ответе getUpdates
+BATCH_SIZE = 100
+# Название очереди, создаваемой в каждом чате
+QUEUE_NAME = "Математика"
+# Доли действий в потоке обновлений: (действие, вес)
+ACTIONS = [
+    ("/join", 20),
+    ("/view", 15),
+    ("join", 30),
+    ("exit", 10),
+    ("rejoin", 10),
+    ("skip", 15),
+]
+# Функции модуля database, которые не учитываются во времени работы с базой
+DB_EXCLUDED = {"init_database", "close_connection", "get_connection", "get_cache_stats", "get_schema_version"}
+
+
+class FakeResponse:
+    """Ответ Bot API в том виде, в котором его разбирает telebot.apihelper"""
+
+    def __init__(self, result):
+        self.status_code = 200
+        self.reason = "OK"
+        self.text = json.dumps({"ok": True, "result": result})
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeTelegram:
+    """Заглушка HTTP-уровня Bot API для apihelper.CUSTOM_REQUEST_SENDER"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = {}
+        self._message_id = 1000
+        self._lock = threading.Lock()
+
+    def __call__(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        api_method = url.rsplit("/", 1)[-1]
+        params = params or {}
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests[api_method] = self.requests.get(api_method, 0) + 1
+            if api_method == "sendMessage":
+                self._message_id += 1
+                message_id = self._message_id
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api_method == "sendMessage":
+            result = {"message_id": message_id, "date": 0, "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "group"}}
+        else:
+            result = True
+        return FakeResponse(result)
+
+
+class Recorder:
+    """
+    Сбор замеров: время обработчиков, время в функциях database и ожидание
+    блокировки записи. Замеры внутри обработчика относятся к этому обработчику.
+    """
+
+    def __init__(self):
+        self.samples = {}  # обработчик -> список (время, время в database, ожидание блокировки)
+        self.db_calls = {}  # функция database -> (количество вызовов, суммарное время)
+        self.lock_waits = []
+        self.completed = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def wrap_handler(self, name, function):
+        def timed(*args, **kwargs):
+            self._local.db_time = 0.0
+            self._local.lock_wait = 0.0
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.samples.setdefault(name, []).append(
+                        (elapsed, self._local.db_time, self._local.lock_wait))
+                    self.completed += 1
+        return timed
+
+    def wrap_db_function(self, name, function):
+        def timed(*args, **kwargs):
+            # Вложенные вызовы функций database учитываются только во внешнем
+            depth = getattr(self._local, "db_depth", 0)
+            self._local.db_depth = depth + 1
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._local.db_depth = depth
+                if depth == 0:
+                    elapsed = time.perf_counter() - started
+                    self._local.db_time = getattr(self._local, "db_time", 0.0) + elapsed
+                    with self._lock:
+                        count, total = self.db_calls.get(name, (0, 0.0))
+                        self.db_calls[name] = (count + 1, total + elapsed)
+        return timed
+
+    def record_lock_wait(self, waited):
+        self._local.lock_wait = getattr(self._local, "lock_wait", 0.0) + waited
+        with self._lock:
+            self.lock_waits.append(waited)
+
+
+class TimedLock:
+    """Обертка над блокировкой, измеряющая время ожидания ее захвата"""
+
+    def __init__(self, lock, recorder):
+        self._lock = lock
+        self._recorder = recorder
+
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self._recorder.record_lock_wait(time.perf_counter() - started)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def generate_updates(chats, users, actions, seed=1, queue_ids=None):
+    """
+    Синтетический поток обновлений: actions действий каждого из users пользователей в chats чатах.
+    Если передан queue_ids (chat_id -> ID очереди), данные кнопок - в компактном формате
+    модуля callback_data, иначе - в прежнем формате '<действие>_<название очереди>'.
+    """
+    import callback_data
+
+    rng = random.Random(seed)
+    names = [name for name, _ in ACTIONS]
+    weights = [weight for _, weight in ACTIONS]
+    updates = []
+    message_id = 1
+    for chat_index in range(chats):
+        chat = {"id": -1000 - chat_index, "type": "group", "title": f"Группа {chat_index}"}
+        for user_index in range(users):
+            user_id = 100000 + chat_index * users + user_index
+            user = {"id": user_id, "is_bot": False, "first_name": f"Студент {user_id}", "username": f"user{user_id}"}
+            for action in rng.choices(names, weights, k=actions):
+                message_id += 1
+                if action.startswith("/"):
+                    text = f"{action} {QUEUE_NAME}"
+                    updates.append({"message": {
+                        "message_id": message_id, "date": 0, "chat": chat, "from": user, "text": text,
+                        "entities": [{"type": "bot_command", "offset": 0, "length": len(action)}],
+                    }})
+                else:
+                    updates.append({"callback_query": {
+                        "id": str(message_id), "chat_instance": str(chat["id"]), "from": user,
+                        "data": (callback_data.encode(action, queue_ids[chat["id"]], 0) if queue_ids
+                                 else f"{action}_{QUEUE_NAME}"),
+                        "message": {"message_id": 1, "date": 0, "chat": chat, "text": "Очередь"},
+                    }})
+    rng.shuffle(updates)
+    for update_id, update in enumerate(updates, 1):
+        update["update_id"] = update_id
+    return updates
+
+
+def prepare_queues(db, chats):
+    """Создание очереди в каждом чате потока обновлений, возвращает chat_id -> ID очереди"""
+    db.add_or_update_user(1, "creator", "Создатель")
+    queue_ids = {}
+    for chat_index in range(chats):
+        chat_id = -1000 - chat_index
+        db.add_chat(chat_id, f"Группа {chat_index}")
+        queue_ids[chat_id] = db.create_queue(QUEUE_NAME, chat_id, 1)
+    return queue_ids
+
+
+def instrument(db, handlers, recorder):
+    """Подключение замеров к обработчикам бота, функциям database и блокировке записи"""
+    for handler_list in (handlers.bot.message_handlers, handlers.bot.callback_query_handlers):
+        for handler in handler_list:
+            function = handler["function"]
+            handler["function"] = recorder.wrap_handler(function.__name__, function)
+
+    for name, function in list(vars(db).items()):
+        if (callable(function) and not isinstance(function, type) and not name.startswith("_")
+                and getattr(function, "__module__", None) == db.__name__ and name not in DB_EXCLUDED):
+            setattr(db, name, recorder.wrap_db_function(name, function))
+
+    db.db_write_lock = TimedLock(db.db_write_lock, recorder)
+
+
+def percentile(values, fraction):
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 0.5) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": max(values) * 1000 if values else 0.0,
+        "total_ms": sum(values) * 1000,
+    }
+
+
+def run(handlers, telebot, recorder, updates, timeout):
+    """Передача обновлений обработчикам и ожидание их завершения, возвращает время в секундах"""
+    parsed = [telebot.types.Update.de_json(update) for update in updates]
+    started = time.perf_counter()
+    for index in range(0, len(parsed), BATCH_SIZE):
+        handlers.bot.process_new_updates(parsed[index:index + BATCH_SIZE])
+
+    deadline = time.monotonic() + timeout
+    while recorder.completed < len(parsed):
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"обработано {recorder.completed} из {len(parsed)} обновлений за {timeout} с")
+        time.sleep(0.001)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20, help="количество групповых чатов")
+    parser.add_argument("--users", type=int, default=30, help="пользователей в каждом чате")
+    parser.add_argument("--actions", type=int, default=5, help="действий каждого пользователя")
+    parser.add_argument("--latency", type=float, default=20, help="задержка ответа Bot API в миллисекундах")
+    parser.add_argument("--threads", type=int, default=2, help="потоков диспетчера обновлений (UPDATE_WORKERS)")
+    parser.add_argument("--group-commit", action="store_true", help="включить групповую фиксацию записей")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="не отключать RATE_LIMITS")
+    parser.add_argument("--legacy-callbacks", action="store_true",
+                        help="данные кнопок в прежнем формате (поиск очереди по названию)")
+    parser.add_argument("--seed", type=int, default=1, help="начальное значение генератора потока")
+    parser.add_argument("--timeout", type=float, default=300, help="максимальное время обработки в секундах")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    if args.group_commit:
+        os.environ["DB_GROUP_COMMIT"] = "1"
+
+    fake = FakeTelegram(args.latency / 1000)
+    import telebot
+    from telebot import apihelper
+    apihelper.CUSTOM_REQUEST_SENDER = fake
+
+    import database as db
+    import handlers
+    from outbound import OutboundGovernor
+    from rate_limiter import RateLimiter
+    from dispatcher import ChatLaneDispatcher
+
+    unlimited = {"count": 10 ** 6, "period": 1}
+    handlers.outbound_governor = OutboundGovernor(unlimited, unlimited, workers=handlers.OUTBOUND_WORKERS)
+    if not args.keep_rate_limits:
+        for name in handlers.rate_limiters:
+            handlers.rate_limiters[name] = RateLimiter(10 ** 6, 1)
+    handlers.update_dispatcher = ChatLaneDispatcher(args.threads, name="updates")
+
+    db.init_database()
+    queue_ids = prepare_queues(db, args.chats)
+    recorder = Recorder()
+    instrument(db, handlers, recorder)
+
+    updates = generate_updates(args.chats, args.users, args.actions, args.seed,
+                               None if args.legacy_callbacks else queue_ids)
+    elapsed = run(handlers, telebot, recorder, updates, args.timeout)
+
+    # Дожидаемся отправки отложенных изменений и ответов, чтобы посчитать все запросы к Bot API
+    while handlers.edit_coalescer.stats()["pending"]:
+        time.sleep(0.01)
+    handlers.outbound_governor.stop(timeout=args.timeout)
+    handlers.retry_scheduler.stop()
+    handlers.update_dispatcher.stop()
+    db.close_connection()
+
+    all_samples = [sample for samples in recorder.samples.values() for sample in samples]
+    results = {
+        "updates": len(updates),
+        "elapsed_s": elapsed,
+        "updates_per_s": len(updates) / elapsed,
+        "handlers": {name: summarize([sample[0] for sample in samples])
+                     for name, samples in sorted(recorder.samples.items())},
+        "handler_latency": summarize([sample[0] for sample in all_samples]),
+        "db_time": summarize([sample[1] for sample in all_samples]),
+        "lock_wait": summarize([sample[2] for sample in all_samples]),
+        "lock_acquisitions": summarize(recorder.lock_waits),
+        "db_functions": {name: {"calls": count, "total_ms": total * 1000}
+                         for name, (count, total) in sorted(recorder.db_calls.items(),
+                                                           key=lambda item: -item[1][1])},
+        "api_requests": fake.requests,
+    }
+
+    print(f"Обновлений: {len(updates)} ({args.chats} чатов x {args.users} пользователей x {args.actions} действий), "
+          f"потоков: {args.threads}, групповая фиксация: {'да' if args.group_commit else 'нет'}")
+    print(f"Время: {elapsed:.2f} с, {results['updates_per_s']:.1f} обновлений/с\n")
+    print(f"{'':28}{'вызовов':>9}{'p50, мс':>10}{'p99, мс':>10}{'макс, мс':>10}")
+    rows = [(name, stats) for name, stats in results["handlers"].items()]
+    rows += [("все обработчики", results["handler_latency"]),
+             ("  из них в database", results["db_time"]),
+             ("  из них ожидание блокировки", results["lock_wait"]),
+             ("захват db_write_lock", results["lock_acquisitions"])]
+    for name, stats in rows:
+        print(f"{name:28}{stats['count']:9d}{stats['p50_ms']:10.2f}{stats['p99_ms']:10.2f}{stats['max_ms']:10.2f}")
+    print("\nФункции database по суммарному времени:")
+    for name, stats in list(results["db_functions"].items())[:8]:
+        print(f"  {name:28}{stats['calls']:7d} вызовов {stats['total_ms']:10.1f} мс")
+    print(f"\nЗапросов к Bot API: {sum(fake.requests.values())} {fake.requests}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Микробенчмарк ограничителя частоты команд.
+
+Сравнивает прежнюю реализацию check_rate_limit (словарь строковых ключей с
+очередью временных меток на каждый ключ, без блокировок) и RateLimiter из модуля
+rate_limiter (GCRA, одно число на ключ, сегменты с отдельными блокировками):
+
+- пропускная способность в одном потоке и в нескольких потоках;
+- память, занимаемая состоянием keys ключей, каждый из которых исчерпал лимит.
+
+Запуск:
+    python benchmarks/bench_rate_limiter.py [--keys 10000] [--hits 500000] [--threads 8]
+"""
+
+import argparse
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limiter import RateLimiter
+
+# Ограничение, как у команды /join: 30 запросов в минуту
+LIMIT = {"count": 30, "period": 60}
+
+
+class LegacyRateLimiter:
+    """Прежняя реализация handlers.check_rate_limit для одного типа ограничения"""
+
+    def __init__(self, count, period):
+        self.count = count
+        self.period = period
+        self.usage = {}
+
+    def hit(self, key):
+        current_time = time.time()
+        key = str(key)
+        if key not in self.usage:
+            self.usage[key] = collections.deque()
+        while self.usage[key] and current_time - self.usage[key][0] > self.period:
+            self.usage[key].popleft()
+        if len(self.usage[key]) >= self.count:
+            return int(self.usage[key][0] + self.period - current_time) + 1
+        self.usage[key].append(current_time)
+        return 0
+
+
+def run_threads(limiter, keys, hits, threads):
+    """hits обращений, равномерно распределенных по keys ключам и threads потокам; возвращает обращений в секунду"""
+    per_thread = hits // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(offset):
+        barrier.wait()
+        for index in range(per_thread):
+            limiter.hit(offset + index % keys)
+
+    workers = [threading.Thread(target=worker, args=(thread * keys,)) for thread in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return per_thread * threads / (time.perf_counter() - started)
+
+
+def measure_memory(factory, keys, count):
+    """Память (в байтах), занимаемая состоянием keys ключей, исчерпавших лимит"""
+    tracemalloc.start()
+    limiter = factory()
+    before = tracemalloc.take_snapshot()
+    for key in range(keys):
+        for _ in range(count):
+            limiter.hit(key)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keys", type=int, default=10000, help="количество пользователей (ключей)")
+    parser.add_argument("--hits", type=int, default=500000, help="количество обращений в тесте пропускной способности")
+    parser.add_argument("--threads", type=int, default=8, help="количество потоков в многопоточном тесте")
+    args = parser.parse_args()
+
+    implementations = [
+        ("прежняя (deque на ключ)", lambda: LegacyRateLimiter(LIMIT["count"], LIMIT["period"])),
+        ("RateLimiter (GCRA)", lambda: RateLimiter(LIMIT["count"], LIMIT["period"])),
+    ]
+
+    print(f"Ключей: {args.keys}, обращений: {args.hits}, лимит: {LIMIT['count']} за {LIMIT['period']} с\n")
+    print(f"{'':26}{'1 поток, обр/с':>16}{f'{args.threads} потоков, обр/с':>20}{'память, КиБ':>14}")
+    for name, factory in implementations:
+        single = run_threads(factory(), args.keys, args.hits, 1)
+        multi = run_threads(factory(), args.keys, args.hits, args.threads)
+        memory = measure_memory(factory, args.keys, LIMIT["count"])
+        print(f"{name:26}{single:16,.0f}{multi:20,.0f}{memory / 1024:14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
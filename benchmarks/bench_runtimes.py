@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+"""
+Бенчмарк пропускной способности синхронной (TeleBot) и асинхронной (AsyncTeleBot)
+сред выполнения на одном и том же потоке обновлений.
+
+Запросы к Bot API направляются на локальный HTTP-сервер, имитирующий Telegram
+с заданной задержкой ответа. Поток обновлений - нажатия «Присоединиться»
+и команды /view в нескольких групповых чатах; его можно сохранить в файл
+(--record) и затем воспроизводить (--traffic). Время обработки измеряется от
+передачи первого обновления до последнего запроса к Bot API.
+
+Ограничения исходящих запросов (OUTBOUND_LIMITS) в бенчмарке отключены, чтобы
+измерялась пропускная способность обработчиков, а не лимиты Telegram.
+
+Запуск:
+    python benchmarks/bench_runtimes.py [--chats 20] [--clicks 50] [--latency 50]
+                                        [--record traffic.json] [--traffic traffic.json]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="qm_bench_")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ["DB_NAME"] = os.path.join(_tmp_dir, "bench.db")
+os.environ.setdefault("EDIT_COALESCE_WINDOW", "0.05")
+
+# Размер пачки обновлений, как в ответе getUpdates
+BATCH_SIZE = 100
+# Сколько ждать новых запросов к Bot API, чтобы считать обработку завершенной (в секундах)
+IDLE_TIMEOUT = 1.0
+
+
+class FakeTelegram:
+    """Локальный HTTP-сервер, отвечающий на запросы Bot API с задержкой latency секунд"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.last_request = 0
+        self.messages = []  # (chat_id, text) отправленных сообщений
+        self._message_id = 1000
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                fake.handle(self)
+
+            def do_GET(self):
+                fake.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def api_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def handle(self, request):
+        url = urlsplit(request.path)
+        method = url.path.rsplit("/", 1)[-1]
+        params = dict(parse_qsl(url.query))
+        length = int(request.headers.get("Content-Length") or 0)
+        if length and "urlencoded" in request.headers.get("Content-Type", ""):
+            params.update(parse_qsl(request.rfile.read(length).decode()))
+        elif length:
+            request.rfile.read(length)
+
+        time.sleep(self.latency)
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "sendMessage":
+            with self._lock:
+                self._message_id += 1
+                message_id = self._message_id
+                self.messages.append((int(params.get("chat_id", 0)), params.get("text", "")))
+            result = {"message_id": message_id, "date": 0, "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id", 0)), "type": "group"}}
+        else:
+            result = True
+
+        body = json.dumps({"ok": True, "result": result}).encode()
+        request.send_response(200)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+        with self._lock:
+            self.requests += 1
+            self.last_request = time.perf_counter()
+
+    def wait_idle(self, since=0):
+        """
+        Ожидание, пока запросы не перестанут поступать, возвращает время последнего запроса.
+        Ожидание не заканчивается, пока не получен хотя бы один запрос позже since.
+        """
+        while True:
+            with self._lock:
+                last_request = self.last_request
+            if last_request > since and time.perf_counter() - last_request > IDLE_TIMEOUT:
+                return last_request
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def generate_traffic(chats, clicks, seed=1):
+    """
+    Синтетический поток обновлений: в каждом чате clicks нажатий «Присоединиться»
+    разными пользователями и по одной команде /view на каждые 10 нажатий
+    """
+    rng = random.Random(seed)
+    updates = []
+    for chat_index in range(chats):
+        chat_id = -1000 - chat_index
+        for click in range(clicks):
+            user_id = 100000 + chat_index * clicks + click
+            user = {"id": user_id, "is_bot": False, "first_name": f"Студент {user_id}", "username": f"user{user_id}"}
+            chat = {"id": chat_id, "type": "group", "title": f"Группа {chat_index}"}
+            updates.append({"callback_query": {
+                "id": str(user_id), "chat_instance": str(chat_id), "data": "join_Математика", "from": user,
+                "message": {"message_id": 1, "date": 0, "chat": chat, "text": "Очередь"},
+            }})
+            if click % 10 == 0:
+                updates.append({"message": {
+                    "message_id": click + 2, "date": 0, "chat": chat, "from": user, "text": "/view Математика",
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 5}],
+                }})
+    rng.shuffle(updates)
+    for update_id, update in enumerate(updates, 1):
+        update["update_id"] = update_id
+    return updates
+
+
+def prepare_queues(db, updates):
+    """Создание очередей «Математика» во всех чатах потока обновлений"""
+    db.add_or_update_user(1, "creator", "Создатель")
+    chat_ids = set()
+    for update in updates:
+        body = update.get("message") or update["callback_query"]["message"]
+        chat_ids.add(body["chat"]["id"])
+    for chat_id in chat_ids:
+        db.add_chat(chat_id, "Benchmark")
+        if not db.get_queue_id("Математика", chat_id):
+            db.create_queue("Математика", chat_id, 1)
+
+
+def shift_chats(updates, chat_offset):
+    """Копия потока обновлений с другими ID чатов, чтобы режимы не влияли друг на друга"""
+    shifted = json.loads(json.dumps(updates))
+    for update in shifted:
+        body = update.get("message") or update["callback_query"]["message"]
+        body["chat"]["id"] += chat_offset
+    return shifted
+
+
+def check_joins(db, updates):
+    """Проверка, что все нажатия «Присоединиться» дошли до базы данных"""
+    expected = {}
+    for update in updates:
+        if "callback_query" in update:
+            chat_id = update["callback_query"]["message"]["chat"]["id"]
+            expected[chat_id] = expected.get(chat_id, 0) + 1
+    for chat_id, count in expected.items():
+        actual = db.get_queue_members_count(db.get_queue_id("Математика", chat_id))
+        assert actual == count, f"чат {chat_id}: в очереди {actual} участников вместо {count}"
+
+
+def reset_rate_limits(handlers):
+    for limiter in handlers.rate_limiters.values():
+        limiter.reset()
+
+
+def run_threaded(handlers, telebot, fake, updates):
+    reset_rate_limits(handlers)
+    parsed = [telebot.types.Update.de_json(update) for update in updates]
+    started = time.perf_counter()
+    for index in range(0, len(parsed), BATCH_SIZE):
+        handlers.bot.process_new_updates(parsed[index:index + BATCH_SIZE])
+    return fake.wait_idle(started) - started
+
+
+def run_async(async_handlers, handlers, telebot, fake, updates):
+    reset_rate_limits(handlers)
+    parsed = [telebot.types.Update.de_json(update) for update in updates]
+
+    async def feed():
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(async_handlers.bot.process_new_updates(parsed[index:index + BATCH_SIZE]))
+                 for index in range(0, len(parsed), BATCH_SIZE)]
+        await asyncio.gather(*tasks)
+        # Ожидаем отложенные изменения сообщений, не блокируя цикл событий
+        while async_handlers.pending_edits:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(IDLE_TIMEOUT)
+        await async_handlers.bot.close_session()
+        return started
+
+    started = asyncio.run(feed())
+    return fake.wait_idle(started) - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20, help="количество групповых чатов")
+    parser.add_argument("--clicks", type=int, default=50, help="нажатий «Присоединиться» в каждом чате")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа Bot API в миллисекундах")
+    parser.add_argument("--record", help="сохранить сгенерированный поток обновлений в файл")
+    parser.add_argument("--traffic", help="воспроизвести поток обновлений из файла")
+    args = parser.parse_args()
+
+    if args.traffic:
+        with open(args.traffic, encoding="utf-8") as file:
+            updates = json.load(file)
+    else:
+        updates = generate_traffic(args.chats, args.clicks)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as file:
+            json.dump(updates, file, ensure_ascii=False)
+
+    fake = FakeTelegram(args.latency / 1000)
+
+    import telebot
+    from telebot import apihelper, asyncio_helper
+    apihelper.API_URL = fake.api_url
+    asyncio_helper.API_URL = fake.api_url
+
+    import database as db
+    import handlers
+    import async_handlers
+    from outbound import OutboundGovernor
+
+    unlimited = {"count": 10 ** 6, "period": 1}
+    handlers.outbound_governor = OutboundGovernor(unlimited, unlimited, workers=handlers.OUTBOUND_WORKERS)
+
+    db.init_database()
+    threaded_updates = shift_chats(updates, 0)
+    async_updates = shift_chats(updates, -10 ** 6)
+    prepare_queues(db, threaded_updates)
+    prepare_queues(db, async_updates)
+
+    threaded_time = run_threaded(handlers, telebot, fake, threaded_updates)
+    threaded_requests = fake.requests
+    async_time = run_async(async_handlers, handlers, telebot, fake, async_updates)
+    async_requests = fake.requests - threaded_requests
+    check_joins(db, threaded_updates)
+    check_joins(db, async_updates)
+
+    handlers.outbound_governor.stop()
+    handlers.retry_scheduler.stop()
+    async_handlers.db_executor.shutdown()
+    db.close_connection()
+    fake.stop()
+
+    print(f"Обновлений: {len(updates)}, задержка Bot API: {args.latency:.0f} мс")
+    print(f"TeleBot (потоки):         {len(updates) / threaded_time:8.1f} обновлений/с, "
+          f"запросов к API: {threaded_requests}")
+    print(f"AsyncTeleBot (asyncio):   {len(updates) / async_time:8.1f} обновлений/с, "
+          f"запросов к API: {async_requests}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Бенчмарк многопроцессного режима вебхука (модуль supervisor).
+
+Запускает супервизор с разным количеством рабочих процессов и отправляет на его
+вебхук один и тот же поток обновлений (как в bench_runtimes.py) параллельными
+HTTP-запросами. Запросы к Bot API направляются на локальный сервер, имитирующий
+Telegram с заданной задержкой ответа (через TELEGRAM_API_URL). После каждого
+прогона проверяется, что все нажатия «Присоединиться» записаны в общую базу данных.
+
+Перед измерением каждый рабочий процесс получает команду /start, чтобы время
+запуска процессов не входило в результат. Ограничения исходящих запросов
+(OUTBOUND_LIMITS) в рабочих процессах отключены.
+
+Запуск:
+    python benchmarks/bench_supervisor.py [--workers 1,2,4] [--chats 40] [--clicks 50]
+                                          [--latency 50] [--clients 16] [--traffic traffic.json]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def unlimited_outbound():
+    """Отключение ограничений исходящих запросов в рабочем процессе (worker_init супервизора)"""
+    import handlers
+    from outbound import OutboundGovernor
+
+    unlimited = {"count": 10 ** 6, "period": 1}
+    handlers.outbound_governor = OutboundGovernor(unlimited, unlimited, workers=handlers.OUTBOUND_WORKERS)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def post_updates(url, updates, clients):
+    """Отправка обновлений на вебхук из clients потоков"""
+    def post(update):
+        request = urllib.request.Request(url, data=json.dumps(update).encode(),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            assert response.status == 200, response.status
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(post, updates))
+
+
+def warmup_updates(workers):
+    """По одной команде /start в чат каждого рабочего процесса"""
+    base = -10 ** 8 - (-10 ** 8) % workers
+    updates = []
+    for index in range(workers):
+        chat = {"id": base + index, "type": "group", "title": "Warmup"}
+        user = {"id": 1, "is_bot": False, "first_name": "Warmup"}
+        updates.append({"update_id": index + 1, "message": {
+            "message_id": 1, "date": 0, "chat": chat, "from": user, "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        }})
+    return updates
+
+
+def check_joins(db_name, updates):
+    """
+    Проверка по файлу базы данных, что все нажатия «Присоединиться» записаны.
+    Кэш очередей супервизора не используется: очереди изменяли другие процессы.
+    """
+    expected = {}
+    for update in updates:
+        if "callback_query" in update:
+            chat_id = update["callback_query"]["message"]["chat"]["id"]
+            expected[chat_id] = expected.get(chat_id, 0) + 1
+    connection = sqlite3.connect(db_name)
+    try:
+        for chat_id, count in expected.items():
+            actual = connection.execute("""
+                SELECT COUNT(*) FROM QueueMembers qm JOIN Queues q ON qm.queue_id = q.queue_id
+                WHERE q.chat_id = ? AND q.queue_name = ?
+            """, (chat_id, "Математика")).fetchone()[0]
+            assert actual == count, f"чат {chat_id}: в очереди {actual} участников вместо {count}"
+    finally:
+        connection.close()
+
+
+def run(workers, fake, updates, clients):
+    """Один прогон с workers процессами: время обработки в секундах, запросов к API и статистика супервизора"""
+    from supervisor import Supervisor
+    from config import WEBHOOK_PORT, WEBHOOK_PATH
+
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    supervisor = Supervisor(workers, worker_init=unlimited_outbound)
+    supervisor.start()
+    try:
+        post_updates(url, warmup_updates(workers), clients)
+        fake.wait_idle()
+        requests_before = fake.requests
+        started = time.perf_counter()
+        post_updates(url, updates, clients)
+        elapsed = fake.wait_idle(started) - started
+    finally:
+        supervisor.stop()
+    return elapsed, fake.requests - requests_before, supervisor.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="количество рабочих процессов через запятую")
+    parser.add_argument("--chats", type=int, default=40, help="количество групповых чатов")
+    parser.add_argument("--clicks", type=int, default=50, help="нажатий «Присоединиться» в каждом чате")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа Bot API в миллисекундах")
+    parser.add_argument("--clients", type=int, default=16, help="параллельных HTTP-запросов к вебхуку")
+    parser.add_argument("--traffic", help="воспроизвести поток обновлений из файла")
+    args = parser.parse_args()
+
+    # Импортируется здесь, а не на уровне модуля: рабочие процессы (spawn) заново
+    # импортируют этот модуль, а bench_runtimes при импорте меняет DB_NAME
+    from bench_runtimes import FakeTelegram, generate_traffic, prepare_queues, shift_chats
+
+    if args.traffic:
+        with open(args.traffic, encoding="utf-8") as file:
+            updates = json.load(file)
+    else:
+        updates = generate_traffic(args.chats, args.clicks)
+
+    fake = FakeTelegram(args.latency / 1000)
+    # Настройки передаются рабочим процессам через окружение
+    db_name = os.path.join(tempfile.mkdtemp(prefix="qm_bench_"), "bench.db")
+    os.environ["DB_NAME"] = db_name
+    os.environ["TELEGRAM_API_URL"] = fake.api_url
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["WEBHOOK_HOST"] = "127.0.0.1"
+    os.environ["WEBHOOK_PORT"] = str(free_port())
+    os.environ["WEBHOOK_SECRET"] = ""
+    os.environ["WEBHOOK_URL"] = ""
+    os.environ["METRICS_PORT"] = "0"
+
+    import database as db
+
+    db.init_database()
+    counts = [int(value) for value in args.workers.split(",")]
+    runs = [shift_chats(updates, -index * 10 ** 6) for index in range(len(counts))]
+    for run_updates in runs:
+        prepare_queues(db, run_updates)
+    db.close_connection()
+
+    print(f"Обновлений: {len(updates)}, чатов: {args.chats}, задержка Bot API: {args.latency:.0f} мс")
+    for workers, run_updates in zip(counts, runs):
+        elapsed, requests, stats = run(workers, fake, run_updates, args.clients)
+        check_joins(db_name, run_updates)
+        print(f"Процессов: {workers:2}  {len(run_updates) / elapsed:8.1f} обновлений/с, "
+              f"запросов к API: {requests}, по процессам: {stats['routed']}")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Проверка диспетчера полос dispatcher.ChatLaneDispatcher.
+
+Задачи одной полосы выполняются по порядку, задачи разных полос - параллельно.
+После остановки диспетчера submit вызывает RuntimeError и не оставляет полосу,
+которую некому выполнить; то же при остановке пула потоков между проверкой
+и постановкой задачи. Полоса, продолжение которой не удалось поставить в пул,
+удаляется, а ее задачи считаются невыполненными, поэтому join() не зависает.
+
+Запуск:
+    python benchmarks/check_dispatcher.py
+"""
+
+import os
+import sys
+import threading
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dispatcher import ChatLaneDispatcher  # noqa: E402
+
+
+def check_lane_order():
+    dispatcher = ChatLaneDispatcher(4)
+    results = {key: [] for key in range(8)}
+    for index in range(100):
+        for key in results:
+            dispatcher.submit(key, lambda key=key, index=index: results[key].append(index))
+    assert dispatcher.join(10)
+    for key, values in results.items():
+        assert values == list(range(100)), key
+    stats = dispatcher.stats()
+    assert stats['processed'] == stats['submitted'] == 800 and stats['lanes'] == 0, stats
+    dispatcher.stop()
+
+
+def check_submit_after_stop():
+    dispatcher = ChatLaneDispatcher(2)
+    done = []
+    dispatcher.submit(1, lambda: done.append(1))
+    dispatcher.stop()
+    assert done == [1]
+    for key in (1, 2):
+        try:
+            dispatcher.submit(key, lambda: done.append(key))
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("submit после stop() не вызвал RuntimeError")
+    assert dispatcher.stats()['lanes'] == 0, dispatcher.stats()
+    assert dispatcher.join(1)
+
+
+def check_submit_after_executor_shutdown():
+    dispatcher = ChatLaneDispatcher(2)
+    # Пул остановлен, а флаг диспетчера еще не установлен (гонка со stop())
+    dispatcher._executor.shutdown(wait=True)
+    try:
+        dispatcher.submit(1, lambda: None)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("submit в остановленный пул не вызвал RuntimeError")
+    stats = dispatcher.stats()
+    assert stats['lanes'] == 0 and stats['failed'] == 1, stats
+    assert dispatcher.join(1)
+
+
+def check_lane_dropped_on_shutdown():
+    dispatcher = ChatLaneDispatcher(1)
+    release = threading.Event()
+    dispatcher.submit(1, release.wait)
+    # Полоса длиннее MAX_BATCH: ее продолжение ставится в пул после остановки
+    for _ in range(ChatLaneDispatcher.MAX_BATCH * 2):
+        dispatcher.submit(1, lambda: time.sleep(0.001))
+    dispatcher.stop(timeout=0)
+    release.set()
+    assert dispatcher.join(5), "join() не дождался удаления полосы"
+    stats = dispatcher.stats()
+    assert stats['lanes'] == 0, stats
+    assert stats['processed'] == ChatLaneDispatcher.MAX_BATCH, stats
+    assert stats['failed'] == stats['submitted'] - stats['processed'], stats
+
+
+CHECKS = [check_lane_order, check_submit_after_stop, check_submit_after_executor_shutdown,
+          check_lane_dropped_on_shutdown]
+
+
+def main():
+    failures = 0
+    for check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failures += 1
+            print(f"{check.__name__} - ошибка")
+            traceback.print_exc()
+
+    if failures:
+        print(f"Ошибок: {failures}")
+        return 1
+    print(f"Все проверки пройдены: {len(CHECKS)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Проверка планов выполнения запросов модуля database (EXPLAIN QUERY PLAN).
+
+Скрипт создает временную базу, применяет все миграции, вызывает функции
+модуля database и перехватывает выполненные ими SELECT-запросы. Для каждого
+запроса строится план выполнения; полный просмотр таблицы или индекса
+(строка плана, начинающаяся со SCAN) считается ошибкой. Просмотр результата
+подзапроса (CO-ROUTINE, MATERIALIZE) допускается.
+
+Кроме того, проверяется, что ключевые запросы используют индексы из миграций.
+
+Запуск:
+    python benchmarks/check_query_plans.py [-v]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="qm_plans_")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ["DB_NAME"] = os.path.join(_tmp_dir, "plans.db")
+
+import database as db  # noqa: E402
+
+# Фрагмент запроса -> индекс, который обязан присутствовать в его плане
+EXPECTED_INDEXES = {
+    "SELECT queue_name, member_count FROM Queues": "idx_queues_chat_name",
+    "SELECT MAX(join_order)": "idx_queue_members_order",
+    "AND join_order <=": "idx_queue_members_order",
+    "ORDER BY qm.join_order": "idx_queue_members_order",
+    "ORDER BY join_order": "idx_queue_members_order",
+}
+
+
+def collect_queries():
+    """Выполнение типичных операций бота с записью всех SELECT-запросов"""
+    db.init_database()
+    queries = []
+    connection = db.get_connection()
+    connection.set_trace_callback(queries.append)
+
+    chat_id = -100
+    db.add_chat(chat_id, "Plans")
+    for user_id in range(1, 7):
+        db.add_or_update_user(user_id, f"user{user_id}", f"Студент {user_id}")
+        db.get_user_info(user_id)
+    queue_id = db.create_queue("Математика", chat_id, 1)
+    db.get_queue_id("Математика", chat_id)
+    for user_id in range(1, 6):
+        db.check_user_in_queue(queue_id, user_id)
+        db.add_user_to_queue(queue_id, user_id)
+    db.get_queue_members(queue_id)
+    db.get_queue_members_count(queue_id)
+    db.get_queue_creator(queue_id)
+    db.get_all_queues(chat_id)
+    db.rejoin_queue(queue_id, 1)
+    db.skip_position_in_queue(queue_id, 2)
+    db.set_user_position(queue_id, 3, 1)
+    db.remove_user_from_queue(queue_id, 4)
+    db.join_by_name(chat_id, "Математика", 6)
+    db.skip_by_name(chat_id, "Математика", 6)
+    db.rejoin_by_name(chat_id, "Математика", 5)
+    db.exit_by_name(chat_id, "Математика", 5)
+    db.join_by_id(chat_id, queue_id, 5)
+    db.skip_by_id(chat_id, queue_id, 5)
+    db.rejoin_by_id(chat_id, queue_id, 6)
+    db.exit_by_id(chat_id, queue_id, 6)
+    # Очередь, не загруженная в кэш: страница читается из базы данных
+    large_queue_id = db.create_queue("Физика", chat_id, 1)
+    for user_id in range(1, 7):
+        db.add_user_to_queue(large_queue_id, user_id)
+    db.get_queue_members_page(large_queue_id, 2, 2)
+    db.get_queue_members_count(large_queue_id)
+    # Массовые операции администратора
+    db.set_queue_order(large_queue_id, [3, 1])
+    db.sort_queue_by_join_time(large_queue_id)
+    db.shuffle_queue(large_queue_id)
+    db.remove_users_from_queue(large_queue_id, [2, 4])
+    db.clear_queue(large_queue_id)
+
+    connection.set_trace_callback(None)
+    return [query for query in queries if query.lstrip().upper().startswith("SELECT")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-v", "--verbose", action="store_true", help="печатать планы всех запросов")
+    args = parser.parse_args()
+
+    queries = collect_queries()
+    cursor = db.get_connection().cursor()
+    failures = []
+    seen = set()
+
+    for query in queries:
+        query = " ".join(query.split())
+        if query in seen:
+            continue
+        seen.add(query)
+
+        cursor.execute(f"EXPLAIN QUERY PLAN {query}")
+        plan = [row[3] for row in cursor.fetchall()]
+        if args.verbose:
+            plan_text = "\n    ".join(plan)
+            print(f"{query}\n    {plan_text}\n")
+
+        # Просмотр результата подзапроса (страницы из LIMIT строк) - не полный просмотр таблицы
+        subqueries = {detail.split()[1] for detail in plan if detail.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+        if any(detail.startswith("SCAN ") and detail.split()[1] not in subqueries for detail in plan):
+            failures.append(f"полный просмотр: {query}")
+        for fragment, index in EXPECTED_INDEXES.items():
+            if fragment in query and not any(index in detail for detail in plan):
+                failures.append(f"не используется {index}: {query}")
+
+    db.close_connection()
+
+    if failures:
+        print("Ошибки:")
+        for failure in failures:
+            print(f"  - {failure}")
+        return 1
+    print(f"Проверено запросов: {len(seen)}, все используют индексы")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,524 @@
+#!/usr/bin/env python
+"""
+Проверка соответствия реализаций хранилища интерфейсу storage.Storage.
+
+Одни и те же проверки выполняются для SQLiteStorage (временная база данных)
+и MemoryStorage: пользователи, создание и удаление очередей, позиции участников,
+версии очередей, страницы очередей, составные и массовые операции. Затем одна и та же случайная
+последовательность операций выполняется в обеих реализациях, и после каждой
+операции сравниваются результаты и снимки очередей, а в конце - счетчики
+участников. Для SQLiteStorage дополнительно проверяется исправление расхождения
+счетчика и то, что страницы и операции по ID не загружают незакэшированную
+очередь целиком, для MemoryStorage - сохранение и загрузка снимка.
+
+Запуск:
+    python benchmarks/check_storage.py [--operations 2000] [--seed 1]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp_dir = tempfile.mkdtemp(prefix="qm_storage_")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ["DB_NAME"] = os.path.join(_tmp_dir, "storage.db")
+
+from storage import SQLiteStorage, MemoryStorage, QueueExistsError, Storage  # noqa: E402
+
+QUEUE = "Математика"
+
+
+def add_users(storage, user_ids):
+    for user_id in user_ids:
+        storage.add_or_update_user(user_id, f"user{user_id}", f"Студент {user_id}")
+
+
+def member_ids(storage, queue_id):
+    return [row[3] for row in storage.get_queue_members(queue_id)]
+
+
+def check_users(storage, chat_id):
+    user_id = chat_id * -10
+    assert storage.get_user_info(user_id) == (None, None)
+    storage.add_or_update_user(user_id, "vasya", "Вася")
+    assert tuple(storage.get_user_info(user_id)) == ("vasya", "Вася")
+    storage.update_display_name(user_id, "Василий")
+    storage.update_username(user_id, "vasily")
+    assert tuple(storage.get_user_info(user_id)) == ("vasily", "Василий")
+    # Изменение отсутствующего пользователя не создает запись
+    storage.update_display_name(user_id + 1, "Никто")
+    assert storage.get_user_info(user_id + 1) == (None, None)
+
+
+def check_queues(storage, chat_id):
+    add_users(storage, [1])
+    storage.add_chat(chat_id, "Группа")
+    storage.add_chat(chat_id, "Группа (повторно)")
+    first = storage.create_queue("Физика", chat_id, 1)
+    second = storage.create_queue(QUEUE, chat_id, 1)
+    assert first != second
+    try:
+        storage.create_queue(QUEUE, chat_id, 1)
+    except QueueExistsError:
+        pass
+    else:
+        raise AssertionError("повторное создание очереди не вызвало QueueExistsError")
+    # Очередь с тем же названием в другом чате допустима
+    storage.create_queue(QUEUE, chat_id - 1, 1)
+
+    assert storage.get_queue_id(QUEUE, chat_id) == second
+    assert storage.get_queue_id("Химия", chat_id) is None
+    assert storage.get_queue_creator(second) == "Студент 1"
+    storage.add_user_to_queue(first, 1)
+    assert [tuple(row) for row in storage.get_all_queues(chat_id)] == [(QUEUE, 0), ("Физика", 1)]
+
+    storage.delete_queue(first)
+    assert storage.get_queue_id("Физика", chat_id) is None
+    assert storage.get_queue_version(first) is None
+    assert storage.get_queue_snapshot(first) is None
+    assert storage.get_queue_members(first) == []
+    assert [tuple(row) for row in storage.get_all_queues(chat_id)] == [(QUEUE, 0)]
+    # Название удаленной очереди можно использовать снова
+    assert storage.create_queue("Физика", chat_id, 1) not in (first, second)
+
+
+def check_positions(storage, chat_id):
+    users = list(range(11, 16))
+    add_users(storage, users)
+    queue_id = storage.create_queue(QUEUE, chat_id, 11)
+    for position, user_id in enumerate(users, 1):
+        assert storage.add_user_to_queue(queue_id, user_id) == position
+    assert storage.get_queue_members_count(queue_id) == 5
+    assert storage.check_user_in_queue(queue_id, 13) == 3
+    assert storage.check_user_in_queue(queue_id, 99) is None
+    assert [tuple(row) for row in storage.get_queue_members(queue_id)][0] == ("Студент 11", "user11", 1, 11)
+
+    storage.remove_user_from_queue(queue_id, 12)
+    assert member_ids(storage, queue_id) == [11, 13, 14, 15]
+    storage.remove_user_from_queue(queue_id, 12)
+    assert storage.rejoin_queue(queue_id, 11) == 4
+    assert member_ids(storage, queue_id) == [13, 14, 15, 11]
+    assert storage.rejoin_queue(queue_id, 12) == 5
+    assert member_ids(storage, queue_id) == [13, 14, 15, 11, 12]
+
+    assert storage.skip_position_in_queue(queue_id, 13) is True
+    assert member_ids(storage, queue_id) == [14, 13, 15, 11, 12]
+    assert storage.skip_position_in_queue(queue_id, 12) is False
+    assert storage.skip_position_in_queue(queue_id, 99) is False
+
+    assert tuple(storage.set_user_position(queue_id, 12, 1)) == (True, 5)
+    assert member_ids(storage, queue_id) == [12, 14, 13, 15, 11]
+    assert tuple(storage.set_user_position(queue_id, 12, 3)) == (True, 1)
+    assert member_ids(storage, queue_id) == [14, 13, 12, 15, 11]
+    assert tuple(storage.set_user_position(queue_id, 14, 5)) == (True, 1)
+    assert member_ids(storage, queue_id) == [13, 12, 15, 11, 14]
+    assert tuple(storage.set_user_position(queue_id, 15, 3)) == (False, 3)
+    assert tuple(storage.set_user_position(queue_id, 99, 1)) == (False, None)
+    # Многократные перемещения в одно место (в SQLite - до перенумерации ключей)
+    for _ in range(15):
+        storage.set_user_position(queue_id, 14, 2)
+        storage.set_user_position(queue_id, 13, 2)
+    assert member_ids(storage, queue_id) == [14, 13, 12, 15, 11]
+
+
+def check_versions(storage, chat_id):
+    add_users(storage, [21, 22, 23])
+    queue_id = storage.create_queue(QUEUE, chat_id, 21)
+    other_id = storage.create_queue("Физика", chat_id, 23)
+    version = storage.get_queue_version(queue_id)
+    storage.add_user_to_queue(queue_id, 22)
+    assert storage.get_queue_version(queue_id) == version + 1
+    storage.get_queue_members(queue_id)
+    storage.get_queue_snapshot(queue_id)
+    assert storage.get_queue_version(queue_id) == version + 1
+    # Переименование участника и создателя меняет версии их очередей
+    storage.update_display_name(22, "Петя")
+    assert storage.get_queue_version(queue_id) == version + 2
+    assert storage.get_queue_snapshot(queue_id).members[0][0] == "Петя"
+    other_version = storage.get_queue_version(other_id)
+    storage.update_username(23, "new23")
+    assert storage.get_queue_version(other_id) == other_version + 1
+    assert storage.get_queue_version(queue_id) == version + 2
+    storage.add_or_update_user(21, "user21", "Создатель")
+    assert storage.get_queue_creator(queue_id) == "Создатель"
+    assert storage.get_queue_snapshot(queue_id).creator_name == "Создатель"
+    assert storage.get_queue_version(queue_id) == version + 3
+    # Операции без изменений версию не меняют
+    storage.skip_position_in_queue(queue_id, 22)
+    storage.remove_user_from_queue(queue_id, 23)
+    assert storage.get_queue_version(queue_id) == version + 3
+
+
+def check_operations(storage, chat_id):
+    add_users(storage, [31, 32, 33])
+    queue_id = storage.create_queue(QUEUE, chat_id, 31)
+    # Очередь загружена в память (в SQLite - в кэш): операции возвращают ее снимок
+    storage.get_queue_snapshot(queue_id)
+
+    result = storage.join_by_name(chat_id, "Нет такой", 31)
+    assert tuple(result) == (Storage.QUEUE_NOT_FOUND, None, None, None, None)
+    for name in ("exit_by_name", "rejoin_by_name", "skip_by_name"):
+        assert getattr(storage, name)(chat_id, "Нет такой", 31).status == Storage.QUEUE_NOT_FOUND
+        result = getattr(storage, name)(chat_id, QUEUE, 31)
+        assert (result.status, result.queue_id, result.position) == (Storage.NOT_MEMBER, queue_id, None)
+        assert result.snapshot.members == []
+
+    for position, user_id in enumerate([31, 32, 33], 1):
+        result = storage.join_by_name(chat_id, QUEUE, user_id)
+        assert (result.status, result.position) == (Storage.DONE, position)
+        assert result.snapshot.version == storage.get_queue_version(queue_id)
+    result = storage.join_by_name(chat_id, QUEUE, 32)
+    assert (result.status, result.position) == (Storage.ALREADY_MEMBER, 2)
+
+    result = storage.skip_by_name(chat_id, QUEUE, 33)
+    assert (result.status, result.position) == (Storage.LAST_IN_QUEUE, 3)
+    result = storage.skip_by_name(chat_id, QUEUE, 31)
+    assert (result.status, result.position) == (Storage.DONE, 2)
+    assert [row[3] for row in result.snapshot.members] == [32, 31, 33]
+
+    result = storage.rejoin_by_name(chat_id, QUEUE, 32)
+    assert (result.status, result.position) == (Storage.DONE, 3)
+    assert [row[3] for row in result.snapshot.members] == [31, 33, 32]
+
+    result = storage.exit_by_name(chat_id, QUEUE, 33)
+    assert (result.status, result.position) == (Storage.DONE, 2)
+    assert [tuple(row) for row in result.snapshot.members] == [("Студент 31", "user31", 1, 31),
+                                                               ("Студент 32", "user32", 2, 32)]
+    assert result.snapshot.creator_name == "Студент 31"
+    assert tuple(storage.get_queue_snapshot(queue_id)) == tuple(result.snapshot)
+
+
+def check_operations_by_id(storage, chat_id):
+    add_users(storage, [41, 42])
+    queue_id = storage.create_queue(QUEUE, chat_id, 41)
+
+    # Очередь другого чата и несуществующая очередь не находятся
+    for name in ("join_by_id", "exit_by_id", "rejoin_by_id", "skip_by_id"):
+        assert getattr(storage, name)(chat_id + 1, queue_id, 41).status == Storage.QUEUE_NOT_FOUND
+        assert getattr(storage, name)(chat_id, queue_id + 1000, 41).status == Storage.QUEUE_NOT_FOUND
+    assert storage.get_queue_members_count(queue_id) == 0
+
+    result = storage.join_by_id(chat_id, queue_id, 41)
+    assert (result.status, result.queue_id, result.position, result.queue_name) == (Storage.DONE, queue_id, 1, QUEUE)
+    storage.join_by_id(chat_id, queue_id, 42)
+    result = storage.skip_by_id(chat_id, queue_id, 41)
+    assert (result.status, result.position) == (Storage.DONE, 2)
+    result = storage.rejoin_by_id(chat_id, queue_id, 42)
+    assert (result.status, result.position) == (Storage.DONE, 2)
+    assert member_ids(storage, queue_id) == [41, 42]
+    result = storage.exit_by_id(chat_id, queue_id, 41)
+    assert (result.status, result.position, result.queue_name) == (Storage.DONE, 1, QUEUE)
+    # Снимок возвращается, только если очередь уже в памяти (SQLiteStorage не загружает ее ради операции)
+    assert result.snapshot is None or result.snapshot.version == storage.get_queue_version(queue_id)
+    assert storage.join_by_name(chat_id, QUEUE, 42).status == Storage.ALREADY_MEMBER
+
+
+def check_pages(storage, chat_id):
+    add_users(storage, range(51, 58))
+    queue_id = storage.create_queue(QUEUE, chat_id, 51)
+    for user_id in range(51, 58):
+        storage.add_user_to_queue(queue_id, user_id)
+
+    # Первые запросы - до загрузки очереди целиком (в SQLite - чтение страницы из базы)
+    page = storage.get_queue_members_page(queue_id, 3, 3)
+    assert (page.chat_id, page.queue_name, page.creator_name, page.total) == (chat_id, QUEUE, "Студент 51", 7)
+    assert [tuple(row) for row in page.members] == [(f"Студент {user_id}", f"user{user_id}", user_id - 50, user_id)
+                                                    for user_id in (54, 55, 56)]
+    assert [row[2] for row in storage.get_queue_members_page(queue_id, 6, 3).members] == [7]
+    assert storage.get_queue_members_page(queue_id, 9, 3).members == []
+    assert storage.get_queue_members_page(queue_id + 1000, 0, 3) is None
+
+    # После загрузки очереди (в SQLite - из кэша) результат тот же
+    assert page.version == storage.get_queue_version(queue_id)
+    assert tuple(storage.get_queue_members_page(queue_id, 3, 3)) == tuple(page)
+
+    storage.remove_user_from_queue(queue_id, 52)
+    page = storage.get_queue_members_page(queue_id, 0, 2)
+    assert page.total == 6 and [row[3] for row in page.members] == [51, 53]
+
+
+def check_bulk(storage, chat_id):
+    users = list(range(61, 67))
+    add_users(storage, users)
+    queue_id = storage.create_queue(QUEUE, chat_id, 61)
+    for user_id in users:
+        storage.add_user_to_queue(queue_id, user_id)
+    storage.rejoin_queue(queue_id, 61)
+    storage.skip_position_in_queue(queue_id, 62)
+
+    # Порядок задается одним изменением: версия увеличивается на 1
+    version = storage.get_queue_version(queue_id)
+    assert storage.set_queue_order(queue_id, [65, 99, 63, 65]) is True
+    assert member_ids(storage, queue_id) == [65, 63, 62, 64, 66, 61]
+    assert storage.get_queue_version(queue_id) == version + 1
+    assert storage.set_queue_order(queue_id, [65]) is False
+    assert storage.get_queue_version(queue_id) == version + 1
+
+    # Сортировка по времени вступления не учитывает перемещения
+    assert storage.sort_queue_by_join_time(queue_id) is True
+    assert member_ids(storage, queue_id) == users
+    assert storage.sort_queue_by_join_time(queue_id) is False
+
+    assert storage.shuffle_queue(queue_id, random.Random(3)) == (member_ids(storage, queue_id) != users)
+    assert sorted(member_ids(storage, queue_id)) == users
+    storage.sort_queue_by_join_time(queue_id)
+    # После перемещения и пропуска позиции вычисляются по новым ключам
+    storage.set_user_position(queue_id, 66, 2)
+    assert member_ids(storage, queue_id) == [61, 66, 62, 63, 64, 65]
+
+    assert storage.remove_users_from_queue(queue_id, [64, 99, 61]) == [61, 64]
+    assert member_ids(storage, queue_id) == [66, 62, 63, 65]
+    assert storage.get_queue_members_count(queue_id) == 4
+    assert storage.check_user_in_queue(queue_id, 61) is None
+    assert storage.remove_users_from_queue(queue_id, [99]) == []
+    # Вернувшийся участник вступает заново и при сортировке оказывается последним
+    storage.add_user_to_queue(queue_id, 61)
+    storage.set_user_position(queue_id, 61, 1)
+    storage.sort_queue_by_join_time(queue_id)
+    assert member_ids(storage, queue_id) == [62, 63, 65, 66, 61]
+
+    assert storage.clear_queue(queue_id) == 5
+    assert storage.get_queue_members(queue_id) == []
+    assert storage.get_queue_members_count(queue_id) == 0
+    assert storage.clear_queue(queue_id) == 0
+    assert [tuple(row) for row in storage.get_all_queues(chat_id)] == [(QUEUE, 0)]
+    assert storage.shuffle_queue(queue_id + 1000) is False
+    assert storage.join_by_name(chat_id, QUEUE, 62).position == 1
+
+
+CHECKS = [check_users, check_queues, check_positions, check_versions, check_pages, check_operations,
+          check_operations_by_id, check_bulk]
+
+
+def run_checks(name, storage):
+    """Выполнение всех проверок, возвращает количество ошибок"""
+    failures = 0
+    for index, check in enumerate(CHECKS):
+        try:
+            check(storage, -1000 * (index + 1))
+        except Exception:
+            failures += 1
+            print(f"{name}: {check.__name__} - ошибка")
+            traceback.print_exc()
+    return failures
+
+
+def normalize(result):
+    """Результат операции в сравнимом виде (снимки и кортежи - как кортежи)"""
+    if isinstance(result, tuple):
+        return tuple(normalize(value) for value in result)
+    if isinstance(result, list):
+        return [normalize(value) for value in result]
+    return result
+
+
+def run_differential(backends, operations, seed):
+    """
+    Одна и та же случайная последовательность операций во всех реализациях.
+
+    Returns:
+        int: количество расхождений (проверка останавливается на первом)
+    """
+    rng = random.Random(seed)
+    chat_id = -9000
+    names = ["Очередь 1", "Очередь 2", "Очередь 3"]
+    users = list(range(100, 112))
+    queue_ids = []
+    for storage in backends.values():
+        add_users(storage, users)
+        queue_ids.append({name: storage.create_queue(name, chat_id, users[0]) for name in names})
+
+    for step in range(operations):
+        name = rng.choice(names)
+        user_id = rng.choice(users)
+        kind = rng.choice(["join", "exit", "rejoin", "skip", "position", "rename", "remove", "rejoin_id",
+                           "shuffle", "sort", "setorder", "removemany"])
+        # Участники для массовых операций и общее начальное значение для перемешивания
+        some_users = rng.sample(users, rng.randint(1, 4))
+        shuffle_seed = rng.random()
+        position = rng.randint(1, len(users))
+        by_id = rng.random() < 0.5
+        results = []
+        for storage, ids in zip(backends.values(), queue_ids):
+            queue_id = ids[name]
+            if kind == "position":
+                # Позиция может быть больше длины очереди (очередь сократилась после проверки
+                # в обработчике /setposition): пользователь ставится в конец
+                result = storage.set_user_position(queue_id, user_id, position)
+            elif kind == "rename":
+                result = storage.update_display_name(user_id, f"Имя {step}")
+            elif kind == "remove":
+                result = storage.remove_user_from_queue(queue_id, user_id)
+            elif kind == "rejoin_id":
+                result = storage.rejoin_queue(queue_id, user_id)
+            elif kind == "shuffle":
+                result = storage.shuffle_queue(queue_id, random.Random(shuffle_seed))
+            elif kind == "sort":
+                result = storage.sort_queue_by_join_time(queue_id)
+            elif kind == "setorder":
+                result = storage.set_queue_order(queue_id, some_users)
+            elif kind == "removemany":
+                result = storage.remove_users_from_queue(queue_id, some_users)
+            elif by_id:
+                result = getattr(storage, f"{kind}_by_id")(chat_id, queue_id, user_id)
+                result = result._replace(queue_id=None, snapshot=None)
+            else:
+                result = getattr(storage, f"{kind}_by_name")(chat_id, name, user_id)
+                result = result._replace(queue_id=None, snapshot=None)
+            # Снимки в результатах операций зависят от кэша SQLiteStorage, поэтому
+            # состояние очередей сравнивается по get_queue_snapshot
+            snapshots = [storage.get_queue_snapshot(ids[queue_name]) for queue_name in names]
+            snapshots.append(storage.get_queue_members_page(queue_id, 2, 3))
+            results.append(normalize((result, snapshots, storage.get_all_queues(chat_id))))
+        if any(result != results[0] for result in results[1:]):
+            print(f"Расхождение на шаге {step} ({kind} {name} {user_id}):")
+            for backend_name, result in zip(backends, results):
+                print(f"  {backend_name}: {result}")
+            return 1
+    # Счетчики участников совпадают с фактическим количеством после всех операций
+    for backend_name, storage in backends.items():
+        drift = storage.check_member_counts()
+        if drift:
+            print(f"{backend_name}: расхождение счетчиков участников {drift}")
+            return 1
+    return 0
+
+
+def check_count_repair(storage):
+    """Обнаружение и исправление расхождения счетчика участников SQLiteStorage"""
+    import database
+
+    chat_id = -20000
+    add_users(storage, [1, 2])
+    queue_id = storage.create_queue(QUEUE, chat_id, 1)
+    storage.join_by_id(chat_id, queue_id, 1)
+    storage.join_by_id(chat_id, queue_id, 2)
+    version = storage.get_queue_version(queue_id)
+
+    connection = database.get_connection()
+    connection.execute("UPDATE Queues SET member_count = 5 WHERE queue_id = ?", (queue_id,))
+    connection.commit()
+    assert storage.check_member_counts() == [(queue_id, 5, 2)]
+    assert storage.check_member_counts(repair=True) == [(queue_id, 5, 2)]
+    assert storage.check_member_counts() == []
+    assert storage.get_queue_members_count(queue_id) == 2
+    # Исправленная очередь получает новую версию, чтобы обновились показанные сообщения
+    assert storage.get_queue_version(queue_id) == version + 1
+
+
+def check_flat_memory(storage):
+    """Страницы и операции по ID не загружают незакэшированную очередь SQLiteStorage целиком"""
+    import database
+
+    chat_id = -21000
+    user_ids = list(range(1000, 1200))
+    add_users(storage, user_ids)
+    queue_id = storage.create_queue(QUEUE, chat_id, user_ids[0])
+    for user_id in user_ids:
+        storage.join_by_id(chat_id, queue_id, user_id)
+    database._queue_cache.clear()
+
+    queries = []
+    connection = database.get_connection()
+    connection.set_trace_callback(queries.append)
+    try:
+        page = storage.get_queue_members_page(queue_id, 100, 50)
+        assert [row[2] for row in page.members] == list(range(101, 151))
+        assert [row[3] for row in page.members] == user_ids[100:150]
+        add_users(storage, [1200])
+        result = storage.join_by_id(chat_id, queue_id, 1200)
+        assert (result.status, result.position, result.snapshot) == (Storage.DONE, 201, None)
+        result = storage.skip_by_id(chat_id, queue_id, 1100)
+        assert (result.status, result.position, result.snapshot) == (Storage.DONE, 102, None)
+        result = storage.rejoin_by_id(chat_id, queue_id, 1000)
+        assert (result.status, result.position, result.snapshot) == (Storage.DONE, 201, None)
+        result = storage.exit_by_id(chat_id, queue_id, 1200)
+        assert (result.status, result.position, result.snapshot) == (Storage.DONE, 200, None)
+    finally:
+        connection.set_trace_callback(None)
+
+    assert database._queue_cache.get_by_id(queue_id) is None
+    # Список участников без LIMIT читает только get_queue_snapshot и его аналоги
+    full_reads = [query for query in queries
+                  if "FROM QueueMembers" in query and "ORDER BY" in query and "LIMIT" not in query]
+    assert not full_reads, full_reads
+
+
+def check_snapshot_roundtrip(path):
+    """Сохранение снимка MemoryStorage и загрузка его в новое хранилище"""
+    storage = MemoryStorage(path, snapshot_interval=0)
+    storage.init()
+    add_users(storage, [1, 2, 3])
+    storage.add_chat(-1, "Группа")
+    queue_id = storage.create_queue(QUEUE, -1, 1)
+    for user_id in (3, 1, 2):
+        storage.join_by_name(-1, QUEUE, user_id)
+    storage.skip_by_name(-1, QUEUE, 3)
+    storage.close()
+
+    restored = MemoryStorage(path, snapshot_interval=0)
+    restored.init()
+    assert restored.get_queue_snapshot(queue_id) == storage.get_queue_snapshot(queue_id)
+    assert restored.get_user_info(2) == ("user2", "Студент 2")
+    # Время вступления сохраняется в снимке
+    assert restored.sort_queue_by_join_time(queue_id) is True
+    assert member_ids(restored, queue_id) == [3, 1, 2]
+    assert restored.create_queue("Физика", -1, 1) == queue_id + 1
+    assert not os.path.exists(path + ".tmp")
+    # Без изменений снимок повторно не записывается
+    assert restored.save_snapshot() is True
+    assert restored.save_snapshot() is False
+    restored.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--operations", type=int, default=2000, help="длина случайной последовательности операций")
+    parser.add_argument("--seed", type=int, default=1, help="начальное значение генератора случайных чисел")
+    args = parser.parse_args()
+
+    sqlite_storage = SQLiteStorage()
+    sqlite_storage.init()
+    memory_storage = MemoryStorage(snapshot_path=None)
+    memory_storage.init()
+    backends = {"sqlite": sqlite_storage, "memory": memory_storage}
+
+    failures = 0
+    for name, storage in backends.items():
+        failures += run_checks(name, storage)
+    failures += run_differential(backends, args.operations, args.seed)
+    try:
+        check_count_repair(sqlite_storage)
+    except Exception:
+        failures += 1
+        print("sqlite: исправление счетчиков - ошибка")
+        traceback.print_exc()
+    try:
+        check_flat_memory(sqlite_storage)
+    except Exception:
+        failures += 1
+        print("sqlite: чтение страниц без загрузки очереди - ошибка")
+        traceback.print_exc()
+    try:
+        check_snapshot_roundtrip(os.path.join(_tmp_dir, "storage.json"))
+    except Exception:
+        failures += 1
+        print("memory: снимок - ошибка")
+        traceback.print_exc()
+    for storage in backends.values():
+        storage.close()
+
+    if failures:
+        print(f"Ошибок: {failures}")
+        return 1
+    print(f"Все проверки пройдены: {', '.join(backends)}; случайных операций: {args.operations}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Проверка согласованности рабочих процессов супервизора.
+
+Запускаются два рабочих процесса с общей временной базой данных; запросы к Bot API
+направляются на локальный HTTP-сервер, имитирующий Telegram. Пользователь состоит
+в очереди группы, которую обслуживает процесс 0, и меняет имя командой /setname
+в личном чате, который обслуживает процесс 1. Команда /view в группе после этого
+должна показать новое имя, хотя очередь уже была в кэше процесса 0.
+
+Запуск:
+    python benchmarks/check_supervisor.py
+"""
+
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUEUE = "Математика"
+GROUP_ID = -2  # процесс 0
+USER_ID = 3    # личный чат пользователя - процесс 1
+WORKERS = 2
+
+
+def warm_queue_cache():
+    """Загрузка всех очередей в кэш рабочего процесса (worker_init супервизора)"""
+    import database
+
+    connection = database.get_connection()
+    for (queue_id,) in connection.execute("SELECT queue_id FROM Queues").fetchall():
+        database.get_queue_snapshot(queue_id)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def command(update_id, chat, text):
+    user = {"id": USER_ID, "is_bot": False, "first_name": "Студент", "username": "student"}
+    length = len(text.split(" ", 1)[0])
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "chat": chat, "from": user, "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": length}],
+    }}
+
+
+def post(url, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 200, response.status
+
+
+def wait_message(fake, chat_id, count, timeout=30):
+    """Ожидание count-го сообщения в чат chat_id, возвращает его текст"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        texts = [text for message_chat, text in fake.messages if message_chat == chat_id]
+        if len(texts) >= count:
+            return texts[count - 1]
+        time.sleep(0.05)
+    raise AssertionError(f"нет сообщения {count} в чат {chat_id}")
+
+
+def main():
+    from bench_runtimes import FakeTelegram
+
+    fake = FakeTelegram(0)
+    os.environ.setdefault("BOT_TOKEN", "0:check")
+    os.environ["DB_NAME"] = os.path.join(tempfile.mkdtemp(prefix="qm_supervisor_"), "check.db")
+    os.environ["TELEGRAM_API_URL"] = fake.api_url
+    os.environ["BOT_MODE"] = "webhook"
+    os.environ["WEBHOOK_HOST"] = "127.0.0.1"
+    os.environ["WEBHOOK_PORT"] = str(free_port())
+    os.environ["WEBHOOK_SECRET"] = ""
+    os.environ["WEBHOOK_URL"] = ""
+    os.environ["METRICS_PORT"] = "0"
+
+    import database as db
+    from config import WEBHOOK_PORT, WEBHOOK_PATH
+    from supervisor import Supervisor, shard_for
+
+    assert shard_for(GROUP_ID, WORKERS) != shard_for(USER_ID, WORKERS)
+    db.init_database()
+    db.add_or_update_user(USER_ID, "student", "Старое имя")
+    db.add_chat(GROUP_ID, "Группа")
+    queue_id = db.create_queue(QUEUE, GROUP_ID, USER_ID)
+    db.add_user_to_queue(queue_id, USER_ID)
+    db.close_connection()
+
+    group = {"id": GROUP_ID, "type": "group", "title": "Группа"}
+    private = {"id": USER_ID, "type": "private", "first_name": "Студент"}
+    url = f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    supervisor = Supervisor(WORKERS, worker_init=warm_queue_cache)
+    supervisor.start()
+    try:
+        post(url, command(1, group, f"/view {QUEUE}"))
+        before = wait_message(fake, GROUP_ID, 1)
+        assert "Старое имя" in before, before
+
+        post(url, command(2, private, "/setname Новое имя"))
+        wait_message(fake, USER_ID, 1)
+
+        post(url, command(3, group, f"/view {QUEUE}"))
+        after = wait_message(fake, GROUP_ID, 2)
+        assert "Новое имя" in after and "Старое имя" not in after, after
+    except AssertionError as e:
+        print(f"Ошибка: {e}")
+        return 1
+    finally:
+        supervisor.stop()
+        fake.stop()
+
+    print(f"Все проверки пройдены: имя, измененное процессом {shard_for(USER_ID, WORKERS)}, "
+          f"видно в очереди процесса {shard_for(GROUP_ID, WORKERS)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
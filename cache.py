@@ -0,0 +1,412 @@
+import threading
+import time
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Признак того, что поле не нужно изменять (None - допустимое значение username)
+UNCHANGED = object()
+
+class LRUCache:
+    """
+    Потокобезопасный кэш с вытеснением давно не использовавшихся записей (LRU).
+
+    Ведет счетчики попаданий, промахов и вытеснений.
+    """
+
+    def __init__(self, maxsize, on_evict=None):
+        """
+        Args:
+            maxsize: максимальное количество записей
+            on_evict: функция (key, value), вызываемая при вытеснении записи
+        """
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """Получение значения с обновлением его позиции в LRU"""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """Получение значения без учета в статистике и без изменения порядка LRU"""
+        with self._lock:
+            return self._data.get(key, default)
+
+    def put(self, key, value):
+        """Сохранение значения с вытеснением самых старых записей при переполнении"""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                old_key, old_value = self._data.popitem(last=False)
+                self.evictions += 1
+                if self.on_evict:
+                    self.on_evict(old_key, old_value)
+
+    def pop(self, key, default=None):
+        """Удаление записи"""
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def values(self):
+        """Снимок всех значений кэша"""
+        with self._lock:
+            return list(self._data.values())
+
+    def clear(self):
+        """Очистка кэша"""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Статистика кэша: размер, попадания, промахи и вытеснения"""
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+class QueueState:
+    """Состояние очереди: ID, версия, создатель и упорядоченный список участников"""
+
+    __slots__ = ('queue_id', 'chat_id', 'queue_name', 'creator_id', 'creator_name', 'members', 'version')
+
+    def __init__(self, queue_id, chat_id, queue_name, creator_id, creator_name, members, version=0):
+        self.queue_id = queue_id
+        self.chat_id = chat_id
+        self.queue_name = queue_name
+        self.creator_id = creator_id
+        self.creator_name = creator_name
+        # Участники в порядке очереди: (display_name, username, user_id)
+        self.members = members
+        # Версия очереди (столбец Queues.version), увеличивается при каждом изменении
+        self.version = version
+
+    def member_rows(self):
+        """Участники в формате get_queue_members: (display_name, username, позиция, user_id)"""
+        return [(name, username, position, user_id)
+                for position, (name, username, user_id) in enumerate(self.members, 1)]
+
+    def index_of(self, user_id):
+        """Индекс участника в очереди или None"""
+        for index, member in enumerate(self.members):
+            if member[2] == user_id:
+                return index
+        return None
+
+class QueueStateCache:
+    """
+    Кэш состояний очередей с ключом (chat_id, queue_name) и сквозной записью.
+
+    Модуль database заполняет кэш при промахах и применяет к нему изменения после
+    фиксации каждой транзакции. Чтобы чтение, начавшееся до записи, не положило
+    в кэш устаревшее состояние, заполнение разрешено только если с момента
+    получения токена (generation) не было ни одной записи.
+    """
+
+    def __init__(self, maxsize):
+        self._states = LRUCache(maxsize, on_evict=self._on_evict)
+        self._keys = {}  # queue_id -> (chat_id, queue_name)
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._pending_writes = 0
+
+    def _on_evict(self, key, state):
+        self._keys.pop(state.queue_id, None)
+
+    def get_by_name(self, chat_id, queue_name):
+        """Состояние очереди по чату и названию или None"""
+        return self._states.get((chat_id, queue_name))
+
+    def get_by_id(self, queue_id):
+        """Состояние очереди по ID или None"""
+        with self._lock:
+            return self._states.get(self._keys.get(queue_id))
+
+    def snapshot(self, queue_id):
+        """
+        Согласованный снимок закэшированной очереди: (version, creator_name, members)
+        или None при промахе
+        """
+        with self._lock:
+            state = self._states.get(self._keys.get(queue_id))
+            if state is None:
+                return None
+            return state.version, state.creator_name, state.members
+
+    def page(self, queue_id, offset, limit):
+        """
+        Согласованный срез закэшированной очереди:
+        (chat_id, queue_name, version, creator_name, total, members) или None при промахе;
+        members - участники с offset по offset + limit в формате get_queue_members
+        """
+        with self._lock:
+            state = self._states.get(self._keys.get(queue_id))
+            if state is None:
+                return None
+            members = state.members[offset:offset + limit]
+            rows = [(name, username, position, user_id)
+                    for position, (name, username, user_id) in enumerate(members, offset + 1)]
+            return state.chat_id, state.queue_name, state.version, state.creator_name, len(state.members), rows
+
+    def generation(self):
+        """Токен для последующего заполнения кэша прочитанным состоянием"""
+        with self._lock:
+            return self._generation
+
+    def fill(self, state, token):
+        """Сохранение прочитанного из базы состояния, если с момента чтения не было записей"""
+        with self._lock:
+            if self._pending_writes or token != self._generation:
+                return False
+            previous = self._states.peek((state.chat_id, state.queue_name))
+            if previous is not None:
+                self._keys.pop(previous.queue_id, None)
+            self._states.put((state.chat_id, state.queue_name), state)
+            self._keys[state.queue_id] = (state.chat_id, state.queue_name)
+            return True
+
+    def begin_write(self):
+        """Отметка о начале транзакции записи: заполнение кэша приостанавливается"""
+        with self._lock:
+            self._pending_writes += 1
+            self._generation += 1
+
+    def end_write(self, apply_changes=None):
+        """
+        Завершение транзакции записи.
+
+        Args:
+            apply_changes: функция без аргументов, применяющая изменения к кэшу
+                (вызывается только для зафиксированной транзакции)
+        """
+        with self._lock:
+            try:
+                if apply_changes is not None:
+                    apply_changes()
+            except Exception as e:
+                # Не рискуем оставить в кэше расходящееся с базой состояние
+                logger.error(f"Failed to update queue cache, clearing it: {str(e)}", exc_info=True)
+                self.clear()
+            finally:
+                self._pending_writes -= 1
+                self._generation += 1
+
+    def _state(self, queue_id):
+        key = self._keys.get(queue_id)
+        return self._states.peek(key) if key is not None else None
+
+    # Изменения не трогают текущий список участников, а заменяют его новым:
+    # читатели, уже получившие список, продолжают работать с целостным снимком.
+    # Каждое изменение увеличивает версию очереди так же, как это делает база данных.
+
+    def append_member(self, queue_id, member):
+        """Добавление участника (display_name, username, user_id) в конец очереди"""
+        with self._lock:
+            state = self._state(queue_id)
+            if state is not None:
+                state.members = state.members + [member]
+                state.version += 1
+
+    def remove_member(self, queue_id, user_id):
+        """Удаление участника из очереди"""
+        with self._lock:
+            state = self._state(queue_id)
+            if state is not None:
+                state.members = [member for member in state.members if member[2] != user_id]
+                state.version += 1
+
+    def move_member(self, queue_id, user_id, new_index=None):
+        """Перемещение участника на позицию new_index (по умолчанию в конец очереди)"""
+        with self._lock:
+            state = self._state(queue_id)
+            if state is None:
+                return
+            index = state.index_of(user_id)
+            if index is None:
+                self.drop(queue_id)
+                return
+            members = list(state.members)
+            member = members.pop(index)
+            if new_index is None:
+                members.append(member)
+            else:
+                members.insert(new_index, member)
+            state.members = members
+            state.version += 1
+
+    def swap_with_next(self, queue_id, user_id):
+        """Обмен участника местами со следующим за ним"""
+        with self._lock:
+            state = self._state(queue_id)
+            if state is None:
+                return
+            index = state.index_of(user_id)
+            if index is None or index + 1 >= len(state.members):
+                self.drop(queue_id)
+                return
+            members = list(state.members)
+            members[index], members[index + 1] = members[index + 1], members[index]
+            state.members = members
+            state.version += 1
+
+    def set_members_order(self, queue_id, user_ids):
+        """Замена списка участников: остаются участники из user_ids в указанном порядке"""
+        with self._lock:
+            state = self._state(queue_id)
+            if state is not None:
+                members = {member[2]: member for member in state.members}
+                state.members = [members[user_id] for user_id in user_ids if user_id in members]
+                state.version += 1
+
+    def update_user(self, user_id, username=UNCHANGED, display_name=UNCHANGED):
+        """
+        Обновление имени и/или username пользователя во всех закэшированных очередях.
+
+        Версия увеличивается у очередей, где пользователь участник или создатель.
+        """
+        with self._lock:
+            for state in self._states.values():
+                is_member = state.index_of(user_id) is not None
+                if state.creator_id == user_id:
+                    if display_name is not UNCHANGED:
+                        state.creator_name = display_name
+                    if not is_member:
+                        state.version += 1
+                if not is_member:
+                    continue
+                state.members = [
+                    (name if display_name is UNCHANGED else display_name,
+                     old_username if username is UNCHANGED else username,
+                     member_id) if member_id == user_id else (name, old_username, member_id)
+                    for name, old_username, member_id in state.members
+                ]
+                state.version += 1
+
+    def drop(self, queue_id):
+        """Удаление очереди из кэша"""
+        with self._lock:
+            key = self._keys.pop(queue_id, None)
+            if key is not None:
+                self._states.pop(key)
+
+    def clear(self):
+        """Очистка кэша"""
+        with self._lock:
+            self._states.clear()
+            self._keys.clear()
+
+    def stats(self):
+        """Статистика кэша: размер, попадания, промахи и вытеснения"""
+        return self._states.stats()
+
+class AdminCache:
+    """
+    Кэш администраторов чатов с ограниченным временем жизни записей (TTL).
+
+    Список администраторов чата загружается целиком функцией fetch при первой
+    проверке и обновляется после истечения ttl секунд или вызова invalidate().
+    """
+
+    def __init__(self, fetch, ttl, maxsize):
+        """
+        Args:
+            fetch: функция (chat_id), возвращающая множество ID администраторов чата
+            ttl: время жизни списка администраторов в секундах
+            maxsize: максимальное количество чатов в кэше
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.refreshes = 0
+        self.invalidations = 0
+        self.expired = 0
+        self._entries = LRUCache(maxsize)  # chat_id -> (множество администраторов, время загрузки)
+        self._lock = threading.Lock()
+        # chat_id -> [блокировка загрузки, число потоков, использующих ее, поколение];
+        # запись удаляется последним потоком, поэтому все ждущие загрузку используют одну блокировку
+        self._loading = {}
+
+    def _load(self, chat_id):
+        with self._lock:
+            loading = self._loading.get(chat_id)
+            if loading is None:
+                loading = self._loading[chat_id] = [threading.Lock(), 0, 0]
+            loading[1] += 1
+        try:
+            with loading[0]:
+                # Пока мы ждали, список мог загрузить другой поток
+                entry = self._entries.peek(chat_id)
+                if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                    return entry[0]
+                with self._lock:
+                    generation = loading[2]
+                admins = frozenset(self.fetch(chat_id))
+                with self._lock:
+                    self.refreshes += 1
+                    # Сброс во время загрузки: полученный список мог устареть и не кэшируется
+                    if loading[2] == generation:
+                        self._entries.put(chat_id, (admins, time.monotonic()))
+                return admins
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self._loading[chat_id]
+
+    def is_admin(self, chat_id, user_id):
+        """Является ли пользователь администратором или создателем чата"""
+        entry = self._entries.get(chat_id)
+        if entry is not None and time.monotonic() - entry[1] >= self.ttl:
+            with self._lock:
+                self.expired += 1
+            entry = None
+        if entry is None:
+            admins = self._load(chat_id)
+        else:
+            admins = entry[0]
+        return user_id in admins
+
+    def invalidate(self, chat_id):
+        """Сброс списка администраторов чата (при изменении прав участника)"""
+        with self._lock:
+            loading = self._loading.get(chat_id)
+            if loading is not None:
+                loading[2] += 1
+            if self._entries.pop(chat_id) is not None:
+                self.invalidations += 1
+
+    def stats(self):
+        """Статистика кэша: попадания и промахи, загрузки, сбросы и возраст самой старой записи"""
+        now = time.monotonic()
+        ages = [now - loaded_at for _, loaded_at in self._entries.values()]
+        stats = self._entries.stats()
+        # Обращение к устаревшей записи считается промахом
+        stats['hits'] -= self.expired
+        stats['misses'] += self.expired
+        stats.update({
+            'ttl': self.ttl,
+            'refreshes': self.refreshes,
+            'invalidations': self.invalidations,
+            'oldest_age': max(ages) if ages else 0,
+        })
+        return stats
@@ -0,0 +1,75 @@
+import base64
+import binascii
+import collections
+import struct
+
+# Действия инлайн-кнопок с очередью; код действия в callback_data - индекс в кортеже
+ACTIONS = ('join', 'exit', 'rejoin', 'skip')
+_ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+
+# Компактный формат: префикс и base64url (без выравнивания) от упакованных
+# кода действия (1 байт), ID очереди и версии очереди (по 4 байта)
+PREFIX = 'q'
+_LAYOUT = struct.Struct('>BII')
+_VERSION_MASK = 0xFFFFFFFF
+
+# Кнопки перехода между страницами очереди: префикс и base64url от ID очереди
+# (4 байта) и номера страницы (2 байта)
+PAGE_ACTION = 'page'
+PAGE_PREFIX = 'p'
+_PAGE_LAYOUT = struct.Struct('>IH')
+
+# Разобранные данные кнопки. Для кнопок компактного формата известны queue_id
+# и version, для кнопок прежнего формата ('join_Название') - только queue_name,
+# для кнопок перехода (action = PAGE_ACTION) - queue_id и page
+CallbackData = collections.namedtuple('CallbackData', ['action', 'queue_id', 'version', 'queue_name', 'page'],
+                                      defaults=(None,))
+
+def encode(action, queue_id, version):
+    """
+    Упаковка данных кнопки (13 байт независимо от длины названия очереди).
+
+    Args:
+        action: действие из ACTIONS
+        queue_id: ID очереди
+        version: версия очереди, показанная в сообщении с кнопкой
+    """
+    packed = _LAYOUT.pack(_ACTION_CODES[action], queue_id, version & _VERSION_MASK)
+    return PREFIX + base64.urlsafe_b64encode(packed).decode('ascii')
+
+def encode_page(queue_id, page):
+    """Данные кнопки перехода на страницу page очереди (9 байт)"""
+    return PAGE_PREFIX + base64.urlsafe_b64encode(_PAGE_LAYOUT.pack(queue_id, page)).decode('ascii')
+
+def decode(data):
+    """
+    Разбор callback_data в компактном или прежнем формате.
+
+    Returns:
+        CallbackData или None, если данные не относятся к кнопкам очереди
+    """
+    if not data:
+        return None
+    if data[0] == PREFIX and len(data) == 13:
+        try:
+            code, queue_id, version = _LAYOUT.unpack(base64.urlsafe_b64decode(data[1:]))
+        except (binascii.Error, struct.error, ValueError):
+            return None
+        if code >= len(ACTIONS):
+            return None
+        return CallbackData(ACTIONS[code], queue_id, version, None)
+    if data[0] == PAGE_PREFIX and len(data) == 9:
+        try:
+            queue_id, page = _PAGE_LAYOUT.unpack(base64.urlsafe_b64decode(data[1:]))
+        except (binascii.Error, struct.error, ValueError):
+            return None
+        return CallbackData(PAGE_ACTION, queue_id, None, None, page) if page >= 1 else None
+    # Кнопки, отправленные до перехода на компактный формат: '<действие>_<название очереди>'
+    action, separator, queue_name = data.partition('_')
+    if separator and action in _ACTION_CODES:
+        return CallbackData(action, None, None, queue_name)
+    return None
+
+def is_stale(callback, version):
+    """Показывала ли кнопка другую версию очереди, чем текущая version"""
+    return callback.version is not None and version is not None and callback.version != version & _VERSION_MASK
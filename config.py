@@ -9,8 +9,91 @@ BOT_TOKEN = os.environ.get('BOT_TOKEN')
 if not BOT_TOKEN:
     raise ValueError("Environment variable BOT_TOKEN is not set. Please set it before running the bot.")
 
+# Адрес Bot API в формате telebot ('http://localhost:8081/bot{0}/{1}') для локального
+# сервера Bot API; пустая строка - api.telegram.org
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '')
+
+# Хранилище данных: 'sqlite' (база данных DB_NAME) или 'memory' (в памяти процесса
+# со снимками в файл STORAGE_SNAPSHOT_PATH каждые STORAGE_SNAPSHOT_INTERVAL секунд)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite').lower()
+STORAGE_SNAPSHOT_PATH = os.environ.get('STORAGE_SNAPSHOT_PATH', 'data/storage.json')
+STORAGE_SNAPSHOT_INTERVAL = int(os.environ.get('STORAGE_SNAPSHOT_INTERVAL', '10'))
+
 # Настройки базы данных
-DB_NAME = 'data/botdb.db'  # Путь внутри Docker-тома
+DB_NAME = os.environ.get('DB_NAME', 'data/botdb.db')  # Путь внутри Docker-тома
+DB_TIMEOUT = 30  # Время ожидания блокировки базы данных другим процессом (в секундах)
+
+# Групповая фиксация: записи из разных потоков объединяются фоновым писателем в одну транзакцию
+DB_GROUP_COMMIT = os.environ.get('DB_GROUP_COMMIT', '0') == '1'
+DB_GROUP_COMMIT_WINDOW_MS = int(os.environ.get('DB_GROUP_COMMIT_WINDOW_MS', '5'))  # Сколько ждать другие записи перед фиксацией
+DB_GROUP_COMMIT_MAX_BATCH = 100  # Максимальное количество операций в одной транзакции
+
+# Режим синхронизации SQLite (PRAGMA synchronous): FULL - fsync при каждой фиксации,
+# NORMAL - в режиме WAL fsync только при контрольных точках (быстрее, но последние
+# транзакции могут потеряться при отключении питания)
+DB_SYNCHRONOUS = os.environ.get('DB_SYNCHRONOUS', 'FULL').upper()
+
+# Кэш состояния очередей в памяти: сколько очередей хранить (вытесняются давно не использовавшиеся)
+QUEUE_CACHE_SIZE = 256
+
+# Кэши отображения: тексты и клавиатуры очередей, версии очередей в отправленных сообщениях
+RENDER_CACHE_SIZE = 512
+MESSAGE_VERSIONS_CACHE_SIZE = 4096
+
+# Количество участников на одной странице сообщения с очередью (кнопки ◀ / ▶ для остальных)
+QUEUE_PAGE_SIZE = 50
+
+# Кэш последних известных username и отображаемых имен пользователей (количество пользователей)
+USER_PROFILE_CACHE_SIZE = 10000
+
+# Кэш администраторов чатов: время жизни списка администраторов (в секундах) и количество чатов
+ADMIN_CACHE_TTL = 300
+ADMIN_CACHE_SIZE = 1024
+
+# Окно объединения изменений одного сообщения с очередью (в секундах): нажатия кнопок
+# в пределах окна приводят к одному изменению сообщения с последним состоянием очереди
+EDIT_COALESCE_WINDOW = float(os.environ.get('EDIT_COALESCE_WINDOW', '1.0'))
+
+# Ограничения исходящих запросов к Telegram (ведра токенов), соответствующие лимитам Bot API
+OUTBOUND_LIMITS = {
+    'global': {'count': 30, 'period': 1},   # 30 запросов в секунду для всего бота
+    'group': {'count': 20, 'period': 60}    # 20 сообщений в минуту в одну группу
+}
+OUTBOUND_WORKERS = 8  # Количество потоков, одновременно выполняющих запросы к Telegram
+
+# Количество потоков, выполняющих обработчики обновлений (обновления одного чата
+# обрабатываются по порядку, разных чатов - параллельно)
+UPDATE_WORKERS = 4
+
+# Среда выполнения обработчиков: 'threaded' (TeleBot и пул потоков) или 'async' (AsyncTeleBot, требует aiohttp)
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'threaded').lower()
+DB_EXECUTOR_WORKERS = 4  # Потоки для обращений к базе данных в асинхронном режиме
+
+# Способ получения обновлений: 'polling' (long polling) или 'webhook' (встроенный HTTP-сервер)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling').lower()
+
+# Количество рабочих процессов (только при BOT_MODE=webhook): обновления распределяются
+# между процессами по ID чата, все процессы работают с одной базой данных в режиме WAL
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', '1'))
+
+# Настройки вебхука (используются при BOT_MODE=webhook)
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')  # Адрес, на котором слушает сервер
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # Секретный токен в заголовке запросов Telegram
+# Публичный адрес (например, https://example.com/webhook); если задан, вебхук устанавливается при запуске
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')
+# Сертификат и ключ для HTTPS; без них сервер работает по HTTP за обратным прокси
+WEBHOOK_SSL_CERT = os.environ.get('WEBHOOK_SSL_CERT', '')
+WEBHOOK_SSL_KEY = os.environ.get('WEBHOOK_SSL_KEY', '')
+
+# Типы обновлений, которые бот запрашивает у Telegram (chat_member нужен для кэша администраторов)
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member']
+
+# HTTP-сервер метрик в текстовом формате Prometheus (адрес /metrics); 0 - сервер отключен.
+# По умолчанию слушает только локальный адрес
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9464'))
 
 # Сообщения бота
 MESSAGES = {
@@ -37,5 +120,10 @@ MESSAGES = {
 `/delete [название]` - удалить очередь полностью
 `/remove [название] [пользователь]` - удалить пользователя из очереди
 `/setposition [название] [пользователь] [позиция]` - изменить позицию пользователя в очереди
+`/setorder [название] [пользователь], [пользователь], ...` - поставить пользователей в начало очереди в указанном порядке
+`/removemany [название] [пользователь], [пользователь], ...` - удалить нескольких пользователей из очереди
+`/shuffle [название]` - перемешать очередь в случайном порядке
+`/sort [название]` - расставить участников в порядке вступления в очередь
+`/clear [название]` - удалить всех участников очереди
 """
 } 
\ No newline at end of file
@@ -1,321 +1,1285 @@
 import sqlite3
 import threading
-from config import DB_NAME
+import queue
+import time
+import random
+import logging
+import collections
+import contextlib
+import functools
+import weakref
+from concurrent.futures import Future
+from config import (DB_NAME, DB_TIMEOUT, DB_SYNCHRONOUS, DB_GROUP_COMMIT,
+                    DB_GROUP_COMMIT_WINDOW_MS, DB_GROUP_COMMIT_MAX_BATCH, QUEUE_CACHE_SIZE)
+from cache import QueueState, QueueStateCache
+import metrics
 
-# Создаем соединение с базой данных
-connection = sqlite3.connect(DB_NAME, check_same_thread=False)
-cursor = connection.cursor()
+logger = logging.getLogger(__name__)
 
-# Создаем блокировку для безопасного доступа к базе данных
-db_lock = threading.Lock()
+# Пул соединений: каждый поток работает со своим соединением с базой данных,
+# которое закрывается при завершении потока
+_local = threading.local()
+_connections = []
+# Повторно входимая: финализатор соединения может сработать при сборке мусора,
+# пока поток удерживает блокировку
+_connections_lock = threading.RLock()
 
-def init_database():
-    """Инициализация базы данных и создание необходимых таблиц"""
-    with db_lock:
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Chats (
-            chat_id INTEGER PRIMARY KEY,
-            chat_name TEXT)'''
-        )
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            display_name TEXT
-        )
-        ''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Queues (
-            queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            queue_name TEXT,
-            chat_id INTEGER,
-            creator_id INTEGER,
-            FOREIGN KEY (chat_id) REFERENCES Chats(chat_id),
-            FOREIGN KEY (creator_id) REFERENCES Users(user_id),
-            UNIQUE (queue_name, chat_id)  -- Очередь с таким именем может быть только одна в каждой беседе
-        )
-        ''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS QueueMembers (
-            queue_id INTEGER,
-            user_id INTEGER,
-            join_order INTEGER,
-            PRIMARY KEY (queue_id, user_id),
-            FOREIGN KEY (queue_id) REFERENCES Queues(queue_id),
-            FOREIGN KEY (user_id) REFERENCES Users(user_id)
-        )
-        ''')
+# Блокировка записи: в режиме WAL чтения выполняются параллельно, а писатель всегда один
+db_write_lock = threading.Lock()
+
+# Шаг между ключами сортировки участников очереди. Ключи разрежены, поэтому
+# выход, перемещение в конец и смена позиции меняют лишь несколько строк, а
+# отображаемая позиция вычисляется при чтении.
+ORDER_GAP = 1024
+
+# Кэш состояния очередей (ID, создатель, участники) со сквозной записью:
+# мутаторы модуля обновляют его после фиксации своих транзакций
+_queue_cache = QueueStateCache(QUEUE_CACHE_SIZE)
+
+# Базу данных изменяют и другие процессы (см. set_shared)
+_shared = False
+
+# Согласованный снимок очереди для отображения
+QueueSnapshot = collections.namedtuple('QueueSnapshot', ['version', 'creator_name', 'members'])
+
+# Страница очереди для отображения: total - количество участников во всей очереди,
+# members - участники страницы в формате get_queue_members (позиции во всей очереди)
+QueuePage = collections.namedtuple('QueuePage', ['chat_id', 'queue_name', 'version', 'creator_name', 'total', 'members'])
+
+# Результат составной операции с очередью (join_by_name, join_by_id и др.):
+# status - один из статусов ниже, position - позиция пользователя после операции
+# (для выхода - позиция до выхода), snapshot - QueueSnapshot после операции или None,
+# если очередь не загружена в кэш (большая очередь не читается целиком),
+# queue_name - название очереди (для операций по ID)
+QueueOperation = collections.namedtuple('QueueOperation', ['status', 'queue_id', 'position', 'snapshot', 'queue_name'])
+
+# Статусы составных операций
+QUEUE_NOT_FOUND = 'queue_not_found'  # Очередь с таким названием (ID) в чате не найдена
+ALREADY_MEMBER = 'already_member'    # Пользователь уже состоит в очереди
+NOT_MEMBER = 'not_member'            # Пользователь не состоит в очереди
+LAST_IN_QUEUE = 'last_in_queue'      # Пропуск невозможен: пользователь последний в очереди
+DONE = 'done'                        # Операция выполнена
+
+def _timed(func):
+    """Декоратор, учитывающий время выполнения функции в метрике DB_QUERY_LATENCY"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with metrics.DB_QUERY_LATENCY.time(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+@contextlib.contextmanager
+def _write_locked():
+    """Захват блокировки записи с учетом времени ожидания в метрике DB_LOCK_WAIT"""
+    started = time.perf_counter()
+    with db_write_lock:
+        metrics.DB_LOCK_WAIT.observe(time.perf_counter() - started)
+        yield
+
+def _connect():
+    """Открытие нового соединения с базой данных в режиме WAL"""
+    connection = sqlite3.connect(DB_NAME, timeout=DB_TIMEOUT, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    return connection
+
+class _ThreadConnection:
+    """
+    Соединение потока. Объект хранится только в threading.local, поэтому
+    удаляется при завершении потока, а вместе с ним закрывается соединение.
+    """
+
+    __slots__ = ('connection', '__weakref__')
+
+    def __init__(self, connection):
+        self.connection = connection
+        weakref.finalize(self, _release_connection, connection)
+
+def _release_connection(connection):
+    """Закрытие соединения завершившегося потока и удаление его из пула"""
+    with _connections_lock:
+        if connection not in _connections:
+            # Уже закрыто close_connection()
+            return
+        _connections.remove(connection)
+    connection.close()
+
+def get_connection():
+    """Получение соединения для текущего потока (создается при первом обращении)"""
+    holder = getattr(_local, 'holder', None)
+    if holder is None:
+        connection = _connect()
+        with _connections_lock:
+            _connections.append(connection)
+        holder = _ThreadConnection(connection)
+        _local.holder = holder
+    return holder.connection
+
+def _read_cursor():
+    """Курсор для чтения: не требует блокировки и не мешает другим потокам"""
+    return get_connection().cursor()
+
+def set_shared(shared):
+    """
+    Включение сверки кэша очередей с базой данных, которую изменяют и другие процессы.
+
+    Очередь чата изменяет только процесс-владелец чата, но имя и username пользователя
+    может изменить любой процесс; изменение увеличивает версии очередей пользователя
+    (_bump_user_queue_versions). Поэтому перед использованием закэшированной очереди
+    ее версия сверяется с Queues.version, и устаревшая очередь читается из базы заново.
+    """
+    global _shared
+    _shared = shared
+
+def _is_current(queue_id, version):
+    """
+    Совпадает ли версия закэшированной очереди с базой данных (всегда True без set_shared).
+    Устаревшая очередь удаляется из кэша.
+    """
+    if not _shared:
+        return True
+    cursor = _read_cursor()
+    cursor.execute("SELECT version FROM Queues WHERE queue_id = ?", (queue_id,))
+    row = cursor.fetchone()
+    if row is not None and row[0] == version:
+        return True
+    _queue_cache.drop(queue_id)
+    return False
+
+def _write_direct(operation, on_commit=None):
+    """
+    Выполнение операции записи в отдельной транзакции в текущем потоке.
+
+    Args:
+        operation: функция, принимающая курсор и возвращающая результат операции
+        on_commit: функция, получающая результат операции и обновляющая кэш
+            (вызывается только после успешной фиксации)
+
+    Returns:
+        Результат, возвращенный operation
+    """
+    with _write_locked():
+        connection = get_connection()
+        _queue_cache.begin_write()
+        apply_changes = None
+        try:
+            cursor = connection.cursor()
+            # Блокировка записи берется в начале транзакции: чтения операции и ее запись
+            # видят одно состояние, даже если базу изменяют другие процессы
+            cursor.execute("BEGIN IMMEDIATE")
+            result = operation(cursor)
+            connection.commit()
+            if on_commit is not None:
+                apply_changes = lambda: on_commit(result)
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            _queue_cache.end_write(apply_changes)
+        return result
+
+class GroupCommitWriter:
+    """
+    Фоновый писатель с групповой фиксацией.
+
+    Операции записи из разных потоков ставятся в очередь, а писатель выполняет
+    их пачками в одной транзакции: одна фиксация (и один fsync) на пачку вместо
+    одной на каждую операцию. Каждая операция выполняется внутри SAVEPOINT, поэтому
+    ошибка в одной из них не отменяет остальные. Результат операции возвращается
+    вызывающему через Future.
+    """
+
+    def __init__(self, window_ms=DB_GROUP_COMMIT_WINDOW_MS, max_batch=DB_GROUP_COMMIT_MAX_BATCH):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.batches = 0
+        self.operations = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, operation, on_commit=None):
+        """Постановка операции в очередь, возвращает Future с ее результатом"""
+        future = Future()
+        self._queue.put((operation, on_commit, future))
+        return future
+
+    def stop(self):
+        """Фиксация уже поставленных операций и остановка писателя"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            
+            # Собираем операции, пришедшие в течение окна группировки
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        """Выполнение пачки операций в одной транзакции"""
+        outcomes = []
+        with _write_locked():
+            connection = get_connection()
+            cursor = connection.cursor()
+            _queue_cache.begin_write()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                for operation, on_commit, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    cursor.execute("SAVEPOINT group_commit_operation")
+                    try:
+                        outcomes.append((future, on_commit, operation(cursor), None))
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO group_commit_operation")
+                        outcomes.append((future, None, None, e))
+                    cursor.execute("RELEASE group_commit_operation")
+                connection.commit()
+            except Exception as e:
+                logger.error(f"Group commit of {len(batch)} operations failed: {str(e)}")
+                connection.rollback()
+                _queue_cache.end_write()
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            
+            def apply_changes():
+                for _, on_commit, result, error in outcomes:
+                    if on_commit is not None and error is None:
+                        on_commit(result)
+            
+            _queue_cache.end_write(apply_changes)
         
-        connection.commit()
+        self.batches += 1
+        self.operations += len(outcomes)
+        
+        # Результаты отдаем только после фиксации, чтобы вызывающий видел сохраненные данные
+        for future, _, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+# Фоновый писатель (создается в init_database, если включена групповая фиксация)
+_group_writer = None
+
+def _write(operation, on_commit=None):
+    """
+    Выполнение операции записи.
+
+    В режиме групповой фиксации операция передается фоновому писателю, иначе
+    выполняется сразу в отдельной транзакции.
+
+    Args:
+        operation: функция, принимающая курсор и возвращающая результат операции
+        on_commit: функция, получающая результат операции и обновляющая кэш
+            (вызывается только после успешной фиксации)
+
+    Returns:
+        Результат, возвращенный operation
+    """
+    if _group_writer is not None:
+        return _group_writer.submit(operation, on_commit).result()
+    return _write_direct(operation, on_commit)
+
+def _create_base_tables(cursor):
+    """Создание исходных таблиц базы данных (схема версии 0)"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS Chats (
+        chat_id INTEGER PRIMARY KEY,
+        chat_name TEXT)'''
+    )
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS Users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        display_name TEXT
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS Queues (
+        queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        queue_name TEXT,
+        chat_id INTEGER,
+        creator_id INTEGER,
+        FOREIGN KEY (chat_id) REFERENCES Chats(chat_id),
+        FOREIGN KEY (creator_id) REFERENCES Users(user_id),
+        UNIQUE (queue_name, chat_id)  -- Очередь с таким именем может быть только одна в каждой беседе
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS QueueMembers (
+        queue_id INTEGER,
+        user_id INTEGER,
+        join_order INTEGER,
+        PRIMARY KEY (queue_id, user_id),
+        FOREIGN KEY (queue_id) REFERENCES Queues(queue_id),
+        FOREIGN KEY (user_id) REFERENCES Users(user_id)
+    )
+    ''')
+
+def _migrate_sparse_order_keys(cursor):
+    """Версия 1: перевод плотной нумерации join_order на разреженные ключи"""
+    cursor.execute("SELECT DISTINCT queue_id FROM QueueMembers")
+    for (queue_id,) in cursor.fetchall():
+        _rebalance_queue(cursor, queue_id)
+
+def _migrate_add_indexes(cursor):
+    """Версия 2: индексы для выборок по чату, порядку в очереди и username"""
+    # Список очередей чата: поиск по chat_id и сортировка по названию без обращения к таблице
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_queues_chat_name ON Queues (chat_id, queue_name)")
+    # MAX(join_order), позиции и список участников читаются только из индекса
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_queue_members_order ON QueueMembers (queue_id, join_order, user_id)")
+    # Поиск пользователя по username без учета регистра
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON Users (username COLLATE NOCASE)")
+
+def _migrate_queue_versions(cursor):
+    """Версия 3: версия очереди, увеличиваемая при каждом ее изменении"""
+    cursor.execute("ALTER TABLE Queues ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    # Поиск очередей пользователя при смене его имени
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_queue_members_user ON QueueMembers (user_id)")
+
+def _migrate_member_counts(cursor):
+    """Версия 4: количество участников очереди, обновляемое вместе с ее версией"""
+    cursor.execute("ALTER TABLE Queues ADD COLUMN member_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("""
+        UPDATE Queues SET member_count = (SELECT COUNT(*) FROM QueueMembers qm WHERE qm.queue_id = Queues.queue_id)
+    """)
+
+def _migrate_join_times(cursor):
+    """Версия 5: время вступления участника в очередь для сортировки /sort"""
+    # У участников, вступивших до миграции, время неизвестно (0): между собой они
+    # упорядочиваются по rowid, то есть по порядку добавления строк
+    cursor.execute("ALTER TABLE QueueMembers ADD COLUMN joined_at REAL NOT NULL DEFAULT 0")
+
+# Миграции схемы: элемент с индексом i переводит базу с версии i на версию i + 1.
+# Новые изменения схемы добавляются только в конец списка.
+MIGRATIONS = [
+    _migrate_sparse_order_keys,
+    _migrate_add_indexes,
+    _migrate_queue_versions,
+    _migrate_member_counts,
+    _migrate_join_times,
+]
+
+# Текущая версия схемы базы данных (хранится в PRAGMA user_version)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def get_schema_version():
+    """Получение версии схемы базы данных"""
+    cursor = _read_cursor()
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+def init_database():
+    """
+    Инициализация базы данных: создание таблиц, применение недостающих миграций
+    и запуск фонового писателя, если включена групповая фиксация
+    """
+    global _group_writer
 
+    _write_direct(_create_base_tables)
+
+    for version in range(get_schema_version(), SCHEMA_VERSION):
+        migration = MIGRATIONS[version]
+
+        def operation(cursor, migration=migration, version=version):
+            # Каждая миграция применяется атомарно вместе с обновлением версии схемы;
+            # версия проверяется повторно, так как миграцию мог применить другой процесс
+            cursor.execute("PRAGMA user_version")
+            if cursor.fetchone()[0] != version:
+                return
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version = {version + 1}")
+
+        _write_direct(operation)
+
+    if DB_GROUP_COMMIT and _group_writer is None:
+        _group_writer = GroupCommitWriter()
+        logger.info(f"Group commit enabled: window {DB_GROUP_COMMIT_WINDOW_MS} ms, synchronous={DB_SYNCHRONOUS}")
+
+def _next_order_key(cursor, queue_id):
+    """Ключ сортировки для добавления участника в конец очереди"""
+    cursor.execute("SELECT MAX(join_order) FROM QueueMembers WHERE queue_id = ?", (queue_id,))
+    max_order = cursor.fetchone()[0]
+    return ORDER_GAP if max_order is None else max_order + ORDER_GAP
+
+def _position_by_key(cursor, queue_id, order_key):
+    """Позиция (начиная с 1) участника с указанным ключом сортировки"""
+    cursor.execute("SELECT COUNT(*) FROM QueueMembers WHERE queue_id = ? AND join_order <= ?",
+                  (queue_id, order_key))
+    return cursor.fetchone()[0]
+
+def _bump_version(cursor, queue_id, members_added=0):
+    """
+    Увеличение версии очереди (в той же транзакции, что и ее изменение).
+
+    Args:
+        members_added: изменение количества участников (1 - добавлен, -1 - удален)
+    """
+    cursor.execute("UPDATE Queues SET version = version + 1, member_count = member_count + ? WHERE queue_id = ?",
+                  (members_added, queue_id))
+
+def _bump_user_queue_versions(cursor, user_id):
+    """Увеличение версий всех очередей, где пользователь участник или создатель"""
+    cursor.execute("""
+        UPDATE Queues SET version = version + 1 
+        WHERE queue_id IN (SELECT queue_id FROM QueueMembers WHERE user_id = ?) OR creator_id = ?
+    """, (user_id, user_id))
+
+def _rebalance_queue(cursor, queue_id):
+    """Равномерная перенумерация ключей очереди, когда между соседями не осталось места"""
+    cursor.execute("SELECT user_id FROM QueueMembers WHERE queue_id = ? ORDER BY join_order, rowid",
+                  (queue_id,))
+    user_ids = [row[0] for row in cursor.fetchall()]
+    cursor.executemany("UPDATE QueueMembers SET join_order = ? WHERE queue_id = ? AND user_id = ?",
+                      [((index + 1) * ORDER_GAP, queue_id, user_id) for index, user_id in enumerate(user_ids)])
+
+@_timed
 def add_or_update_user(user_id, username, display_name):
     """Добавление или обновление информации о пользователе"""
-    with db_lock:
+    def operation(cursor):
         cursor.execute("INSERT OR REPLACE INTO Users (user_id, username, display_name) VALUES (?, ?, ?)", 
                       (user_id, username, display_name))
-        connection.commit()
+        _bump_user_queue_versions(cursor, user_id)
 
+    _write(operation, lambda _: _queue_cache.update_user(user_id, username=username, display_name=display_name))
+
+@_timed
 def get_user_info(user_id):
     """Получение информации о пользователе"""
-    with db_lock:
-        cursor.execute("SELECT username, display_name FROM Users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result if result else (None, None)
+    cursor = _read_cursor()
+    cursor.execute("SELECT username, display_name FROM Users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    return result if result else (None, None)
 
+@_timed
 def add_chat(chat_id, chat_name):
     """Добавление информации о чате"""
-    with db_lock:
+    def operation(cursor):
         cursor.execute("INSERT OR IGNORE INTO Chats (chat_id, chat_name) VALUES (?, ?)", 
                       (chat_id, chat_name))
-        connection.commit()
 
+    _write(operation)
+
+@_timed
 def create_queue(queue_name, chat_id, creator_id):
     """Создание новой очереди"""
-    with db_lock:
+    def operation(cursor):
         cursor.execute("INSERT INTO Queues (queue_name, chat_id, creator_id) VALUES (?, ?, ?)", 
                       (queue_name, chat_id, creator_id))
-        connection.commit()
         return cursor.lastrowid
 
+    return _write(operation)
+
+def _load_queue_state(condition, params):
+    """
+    Чтение состояния очереди из базы данных и сохранение его в кэш.
+
+    Args:
+        condition: условие отбора очереди по таблице Queues (псевдоним q)
+        params: параметры условия
+
+    Returns:
+        QueueState или None, если очередь не найдена
+    """
+    token = _queue_cache.generation()
+    connection = get_connection()
+    cursor = connection.cursor()
+    
+    # Очередь и ее участников читаем в одной транзакции, чтобы получить согласованный снимок
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute(f"""
+            SELECT q.queue_id, q.chat_id, q.queue_name, q.creator_id, u.display_name, q.version
+            FROM Queues q 
+            LEFT JOIN Users u ON q.creator_id = u.user_id 
+            WHERE {condition}
+        """, params)
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        queue_id, chat_id, queue_name, creator_id, creator_name, version = row
+        cursor.execute("""
+            SELECT u.display_name, u.username, qm.user_id
+            FROM QueueMembers qm 
+            JOIN Users u ON qm.user_id = u.user_id 
+            WHERE qm.queue_id = ? 
+            ORDER BY qm.join_order
+        """, (queue_id,))
+        members = cursor.fetchall()
+    finally:
+        connection.commit()
+    
+    state = QueueState(queue_id, chat_id, queue_name, creator_id, creator_name, members, version)
+    _queue_cache.fill(state, token)
+    return state
+
+def _get_queue_state(queue_id):
+    """Состояние очереди по ID: из кэша или из базы данных"""
+    state = _queue_cache.get_by_id(queue_id)
+    if state is None or not _is_current(queue_id, state.version):
+        state = _load_queue_state("q.queue_id = ?", (queue_id,))
+    return state
+
+@_timed
 def get_queue_id(queue_name, chat_id):
     """Получение ID очереди по названию и ID чата"""
-    with db_lock:
-        cursor.execute("SELECT queue_id FROM Queues WHERE queue_name = ? AND chat_id = ?", 
-                      (queue_name, chat_id))
-        result = cursor.fetchone()
-        return result[0] if result else None
+    state = _queue_cache.get_by_name(chat_id, queue_name)
+    if state is not None:
+        return state.queue_id
+    
+    # Участники при промахе не загружаются: для просмотра большой очереди
+    # достаточно ее страницы (get_queue_members_page)
+    cursor = _read_cursor()
+    cursor.execute("SELECT queue_id FROM Queues WHERE queue_name = ? AND chat_id = ?", (queue_name, chat_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
 
+@_timed
 def check_user_in_queue(queue_id, user_id):
-    """Проверка, состоит ли пользователь в очереди"""
-    with db_lock:
-        cursor.execute("SELECT join_order FROM QueueMembers WHERE queue_id = ? AND user_id = ?", 
-                      (queue_id, user_id))
-        result = cursor.fetchone()
-        return result[0] if result else None
+    """Проверка, состоит ли пользователь в очереди. Возвращает его позицию или None"""
+    state = _get_queue_state(queue_id)
+    if state is None:
+        return None
+    index = state.index_of(user_id)
+    return index + 1 if index is not None else None
+
+def _member_entry(cursor, user_id):
+    """Запись участника для кэша: (display_name, username, user_id) или None"""
+    cursor.execute("SELECT display_name, username FROM Users WHERE user_id = ?", (user_id,))
+    result = cursor.fetchone()
+    return (result[0], result[1], user_id) if result else None
 
+def _append_to_cache(queue_id, member):
+    """Добавление участника в конец закэшированной очереди"""
+    if member is None:
+        # Участник без записи в Users не попадает в выборку, проще перечитать очередь
+        _queue_cache.drop(queue_id)
+    else:
+        _queue_cache.append_member(queue_id, member)
+
+@_timed
 def add_user_to_queue(queue_id, user_id):
     """Добавление пользователя в очередь"""
-    with db_lock:
-        # Определяем порядковый номер для нового участника
-        cursor.execute("SELECT MAX(join_order) FROM QueueMembers WHERE queue_id = ?", (queue_id,))
-        max_order = cursor.fetchone()[0]
-        new_order = 1 if max_order is None else max_order + 1
+    def operation(cursor):
+        # Определяем ключ сортировки для нового участника
+        new_key = _next_order_key(cursor, queue_id)
         
         # Добавляем пользователя в очередь
-        cursor.execute("INSERT INTO QueueMembers (queue_id, user_id, join_order) VALUES (?, ?, ?)", 
-                      (queue_id, user_id, new_order))
-        connection.commit()
-        return new_order
+        cursor.execute("INSERT INTO QueueMembers (queue_id, user_id, join_order, joined_at) VALUES (?, ?, ?, ?)", 
+                      (queue_id, user_id, new_key, time.time()))
+        _bump_version(cursor, queue_id, 1)
+        return _position_by_key(cursor, queue_id, new_key), _member_entry(cursor, user_id)
+
+    position, _ = _write(operation, lambda result: _append_to_cache(queue_id, result[1]))
+    return position
+
+@_timed
+def remove_user_from_queue(queue_id, user_id):
+    """
+    Удаление пользователя из очереди.
 
-def remove_user_from_queue(queue_id, user_id, user_order):
-    """Удаление пользователя из очереди"""
-    with db_lock:
-        # Удаляем пользователя из очереди
+    Позиции остальных участников не пересчитываются: они вычисляются при чтении.
+    """
+    def operation(cursor):
         cursor.execute("DELETE FROM QueueMembers WHERE queue_id = ? AND user_id = ?", 
                       (queue_id, user_id))
-        
-        # Обновляем порядковые номера оставшихся участников
-        cursor.execute("""
-            UPDATE QueueMembers 
-            SET join_order = join_order - 1 
-            WHERE queue_id = ? AND join_order > ?
-        """, (queue_id, user_order))
-        
-        connection.commit()
+        removed = cursor.rowcount > 0
+        if removed:
+            _bump_version(cursor, queue_id, -1)
+        return removed
+
+    def on_commit(removed):
+        if removed:
+            _queue_cache.remove_member(queue_id, user_id)
 
+    _write(operation, on_commit)
+
+@_timed
 def rejoin_queue(queue_id, user_id):
     """Перемещение пользователя в конец очереди"""
-    with db_lock:
-        # Проверяем, есть ли пользователь в очереди
-        cursor.execute("SELECT join_order FROM QueueMembers WHERE queue_id = ? AND user_id = ?", 
-                      (queue_id, user_id))
-        result = cursor.fetchone()
+    def operation(cursor):
+        # Определяем новый ключ сортировки в конце очереди
+        new_key = _next_order_key(cursor, queue_id)
         
-        if result:
-            current_order = result[0]
-            
-            # Удаляем пользователя из очереди
-            cursor.execute("DELETE FROM QueueMembers WHERE queue_id = ? AND user_id = ?", 
-                          (queue_id, user_id))
-            
-            # Обновляем порядковые номера оставшихся участников
-            cursor.execute("""
-                UPDATE QueueMembers 
-                SET join_order = join_order - 1 
-                WHERE queue_id = ? AND join_order > ?
-            """, (queue_id, current_order))
-            
-            # Определяем новый порядковый номер для пользователя
-            cursor.execute("SELECT MAX(join_order) FROM QueueMembers WHERE queue_id = ?", (queue_id,))
-            max_order = cursor.fetchone()[0]
-            new_order = 1 if max_order is None else max_order + 1
-            
-            # Добавляем пользователя в конец очереди
-            cursor.execute("INSERT INTO QueueMembers (queue_id, user_id, join_order) VALUES (?, ?, ?)", 
-                          (queue_id, user_id, new_order))
-            
-            connection.commit()
-            return new_order
+        # Если пользователь уже в очереди, меняем только его ключ, иначе добавляем его
+        cursor.execute("UPDATE QueueMembers SET join_order = ? WHERE queue_id = ? AND user_id = ?", 
+                      (new_key, queue_id, user_id))
+        if cursor.rowcount:
+            _bump_version(cursor, queue_id)
+            return _position_by_key(cursor, queue_id, new_key), None
+        
+        cursor.execute("INSERT INTO QueueMembers (queue_id, user_id, join_order, joined_at) VALUES (?, ?, ?, ?)", 
+                      (queue_id, user_id, new_key, time.time()))
+        _bump_version(cursor, queue_id, 1)
+        return _position_by_key(cursor, queue_id, new_key), _member_entry(cursor, user_id)
+
+    def on_commit(result):
+        _, new_member = result
+        if new_member is None:
+            _queue_cache.move_member(queue_id, user_id)
         else:
-            # Если пользователя нет в очереди, просто добавляем его
-            cursor.execute("SELECT MAX(join_order) FROM QueueMembers WHERE queue_id = ?", (queue_id,))
-            max_order = cursor.fetchone()[0]
-            new_order = 1 if max_order is None else max_order + 1
-            
-            cursor.execute("INSERT INTO QueueMembers (queue_id, user_id, join_order) VALUES (?, ?, ?)", 
-                          (queue_id, user_id, new_order))
-            
-            connection.commit()
-            return new_order
+            _append_to_cache(queue_id, new_member)
 
-def get_queue_members(queue_id):
-    """Получение списка участников очереди"""
-    with db_lock:
+    position, _ = _write(operation, on_commit)
+    return position
+
+@_timed
+def get_queue_version(queue_id):
+    """Получение версии очереди или None, если очередь не найдена"""
+    state = _get_queue_state(queue_id)
+    return state.version if state else None
+
+@_timed
+def get_queue_snapshot(queue_id):
+    """
+    Получение согласованного снимка очереди для отображения.
+
+    Returns:
+        QueueSnapshot(version, creator_name, members) или None, если очередь не найдена;
+        members - список в формате get_queue_members
+    """
+    snapshot = _queue_cache.snapshot(queue_id)
+    if snapshot is None or not _is_current(queue_id, snapshot[0]):
+        state = _load_queue_state("q.queue_id = ?", (queue_id,))
+        if state is None:
+            return None
+        snapshot = state.version, state.creator_name, state.members
+    
+    version, creator_name, members = snapshot
+    return QueueSnapshot(version, creator_name,
+                         [(name, username, position, user_id)
+                          for position, (name, username, user_id) in enumerate(members, 1)])
+
+@_timed
+def get_queue_members_page(queue_id, offset, limit):
+    """
+    Получение страницы очереди для отображения.
+
+    Закэшированная очередь нарезается в памяти. Иначе из базы данных читаются только
+    limit участников начиная с offset (по индексу idx_queue_members_order), а общее
+    количество берется из столбца Queues.member_count; очередь в кэш не загружается,
+    поэтому просмотр большой очереди не зависит от ее размера.
+
+    Returns:
+        QueuePage или None, если очередь не найдена
+    """
+    page = _queue_cache.page(queue_id, offset, limit)
+    if page is not None and _is_current(queue_id, page[2]):
+        return QueuePage(*page)
+    
+    connection = get_connection()
+    cursor = connection.cursor()
+    # Заголовок и участники читаются в одной транзакции чтения
+    cursor.execute("BEGIN")
+    try:
         cursor.execute("""
-            SELECT u.display_name, u.username, qm.join_order, qm.user_id
-            FROM QueueMembers qm 
-            JOIN Users u ON qm.user_id = u.user_id 
-            WHERE qm.queue_id = ? 
-            ORDER BY qm.join_order
+            SELECT q.chat_id, q.queue_name, q.version, u.display_name, q.member_count
+            FROM Queues q 
+            LEFT JOIN Users u ON q.creator_id = u.user_id 
+            WHERE q.queue_id = ?
         """, (queue_id,))
-        return cursor.fetchall()
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        # Пропуск первых offset участников выполняется только по покрывающему индексу
+        # idx_queue_members_order, имена читаются лишь для участников страницы
+        cursor.execute("""
+            SELECT u.display_name, u.username, page.user_id, u.user_id IS NOT NULL
+            FROM (
+                SELECT user_id, join_order FROM QueueMembers 
+                WHERE queue_id = ? 
+                ORDER BY join_order 
+                LIMIT ? OFFSET ?
+            ) page
+            LEFT JOIN Users u ON page.user_id = u.user_id
+            ORDER BY page.join_order
+        """, (queue_id, limit, offset))
+        # Как и в get_queue_members, участники без записи о пользователе не выводятся
+        members = [(name, username, position, user_id)
+                   for position, (name, username, user_id, known) in enumerate(cursor.fetchall(), offset + 1)
+                   if known]
+    finally:
+        connection.commit()
+    return QueuePage(*row, members)
 
+@_timed
+def get_queue_members(queue_id):
+    """Получение списка участников очереди в виде (имя, username, позиция, user_id)"""
+    state = _get_queue_state(queue_id)
+    return state.member_rows() if state else []
+
+@_timed
 def get_queue_members_count(queue_id):
     """Получение количества участников в очереди"""
-    with db_lock:
-        cursor.execute("SELECT COUNT(*) FROM QueueMembers WHERE queue_id = ?", (queue_id,))
-        return cursor.fetchone()[0]
+    state = _queue_cache.get_by_id(queue_id)
+    if state is not None and _is_current(queue_id, state.version):
+        return len(state.members)
+    
+    cursor = _read_cursor()
+    cursor.execute("SELECT member_count FROM Queues WHERE queue_id = ?", (queue_id,))
+    result = cursor.fetchone()
+    return result[0] if result else 0
 
+@_timed
 def delete_queue(queue_id):
     """Удаление очереди и всех её участников"""
-    with db_lock:
+    def operation(cursor):
         # Удаляем всех участников очереди
         cursor.execute("DELETE FROM QueueMembers WHERE queue_id = ?", (queue_id,))
         
         # Удаляем саму очередь
         cursor.execute("DELETE FROM Queues WHERE queue_id = ?", (queue_id,))
-        
-        connection.commit()
 
+    _write(operation, lambda _: _queue_cache.drop(queue_id))
+
+@_timed
 def get_all_queues(chat_id):
     """Получение списка всех очередей в чате"""
-    with db_lock:
-        cursor.execute("""
-            SELECT q.queue_name, COUNT(qm.user_id) as members_count 
-            FROM Queues q 
-            LEFT JOIN QueueMembers qm ON q.queue_id = qm.queue_id 
-            WHERE q.chat_id = ? 
-            GROUP BY q.queue_id, q.queue_name
-            ORDER BY q.queue_name
-        """, (chat_id,))
-        return cursor.fetchall()
+    cursor = _read_cursor()
+    cursor.execute("""
+        SELECT queue_name, member_count FROM Queues 
+        WHERE chat_id = ? 
+        ORDER BY queue_name
+    """, (chat_id,))
+    return cursor.fetchall()
+
+def _member_count_drift(cursor):
+    """Очереди, у которых Queues.member_count не совпадает с числом строк QueueMembers"""
+    cursor.execute("""
+        SELECT queue_id, member_count, actual FROM (
+            SELECT q.queue_id, q.member_count, 
+                   (SELECT COUNT(*) FROM QueueMembers qm WHERE qm.queue_id = q.queue_id) AS actual
+            FROM Queues q
+        ) WHERE member_count != actual
+        ORDER BY queue_id
+    """)
+    return cursor.fetchall()
+
+@_timed
+def check_member_counts(repair=False):
+    """
+    Проверка счетчиков участников (Queues.member_count) по таблице QueueMembers.
+    Запрос просматривает все очереди, поэтому выполняется только по команде администратора.
+
+    Args:
+        repair: исправить расхождения (в одной транзакции записи, с увеличением версий очередей)
 
+    Returns:
+        Список (queue_id, значение счетчика, фактическое количество) для очередей с расхождением
+    """
+    if not repair:
+        return _member_count_drift(_read_cursor())
+
+    def operation(cursor):
+        drift = _member_count_drift(cursor)
+        # Версия увеличивается, чтобы обновились закэшированные тексты очередей
+        cursor.executemany("UPDATE Queues SET member_count = ?, version = version + 1 WHERE queue_id = ?",
+                          [(actual, queue_id) for queue_id, _, actual in drift])
+        return drift
+
+    def on_commit(drift):
+        # Закэшированные версии этих очередей устарели
+        for queue_id, _, _ in drift:
+            _queue_cache.drop(queue_id)
+
+    drift = _write(operation, on_commit)
+    for queue_id, stored, actual in drift:
+        logger.warning(f"Repaired member count of queue {queue_id}: {stored} -> {actual}")
+    return drift
+
+@_timed
 def get_queue_creator(queue_id):
     """Получение информации о создателе очереди"""
-    with db_lock:
-        cursor.execute("""
-            SELECT u.display_name 
-            FROM Queues q 
-            JOIN Users u ON q.creator_id = u.user_id 
-            WHERE q.queue_id = ?
-        """, (queue_id,))
-        result = cursor.fetchone()
-        return result[0] if result else None
+    state = _get_queue_state(queue_id)
+    return state.creator_name if state else None
 
+@_timed
 def update_display_name(user_id, display_name):
     """Обновление отображаемого имени пользователя"""
-    with db_lock:
+    def operation(cursor):
         cursor.execute("UPDATE Users SET display_name = ? WHERE user_id = ?", (display_name, user_id))
-        connection.commit()
+        _bump_user_queue_versions(cursor, user_id)
 
+    _write(operation, lambda _: _queue_cache.update_user(user_id, display_name=display_name))
+
+@_timed
 def update_username(user_id, username):
     """Обновление только username пользователя"""
-    with db_lock:
+    def operation(cursor):
         cursor.execute("UPDATE Users SET username = ? WHERE user_id = ?", (username, user_id))
-        connection.commit()
+        _bump_user_queue_versions(cursor, user_id)
 
+    _write(operation, lambda _: _queue_cache.update_user(user_id, username=username))
+
+@_timed
 def skip_position_in_queue(queue_id, user_id):
     """Перемещение пользователя на одну позицию назад в очереди"""
-    with db_lock:
-        # Получаем текущую позицию пользователя
+    def operation(cursor):
+        # Получаем ключ сортировки пользователя
         cursor.execute("SELECT join_order FROM QueueMembers WHERE queue_id = ? AND user_id = ?", 
                       (queue_id, user_id))
         result = cursor.fetchone()
         if not result:
             return False
         
-        user_order = result[0]
+        user_key = result[0]
         
-        # Получаем количество участников в очереди
-        cursor.execute("SELECT COUNT(*) FROM QueueMembers WHERE queue_id = ?", (queue_id,))
-        members_count = cursor.fetchone()[0]
+        # Находим следующего участника очереди
+        cursor.execute("""
+            SELECT user_id, join_order FROM QueueMembers 
+            WHERE queue_id = ? AND join_order > ? 
+            ORDER BY join_order LIMIT 1
+        """, (queue_id, user_key))
+        next_member = cursor.fetchone()
         
-        # Проверяем, не последний ли пользователь в очереди
-        if user_order == members_count:
+        # Если следующего нет, пользователь уже последний в очереди
+        if not next_member:
             return False
         
-        # Обновляем позицию пользователя, который будет перемещен вперед
-        cursor.execute("""
-            UPDATE QueueMembers 
-            SET join_order = ? 
-            WHERE queue_id = ? AND join_order = ?
-        """, (user_order, queue_id, user_order + 1))
+        next_user_id, next_key = next_member
         
-        # Обновляем позицию текущего пользователя
-        cursor.execute("""
-            UPDATE QueueMembers 
-            SET join_order = ? 
-            WHERE queue_id = ? AND user_id = ?
-        """, (user_order + 1, queue_id, user_id))
-        
-        connection.commit()
+        # Меняем ключи сортировки двух участников местами
+        cursor.executemany("UPDATE QueueMembers SET join_order = ? WHERE queue_id = ? AND user_id = ?",
+                          [(user_key, queue_id, next_user_id), (next_key, queue_id, user_id)])
+        _bump_version(cursor, queue_id)
         return True
 
+    def on_commit(success):
+        if success:
+            _queue_cache.swap_with_next(queue_id, user_id)
+
+    return _write(operation, on_commit)
+
+def _key_for_position(cursor, queue_id, user_id, new_position):
+    """
+    Ключ сортировки, ставящий пользователя на позицию new_position.
+
+    Возвращает None, если между соседними ключами не осталось свободного места.
+    """
+    # Соседи на новой позиции среди остальных участников очереди
+    cursor.execute("""
+        SELECT join_order FROM QueueMembers 
+        WHERE queue_id = ? AND user_id != ? 
+        ORDER BY join_order LIMIT 2 OFFSET ?
+    """, (queue_id, user_id, max(new_position - 2, 0)))
+    keys = [row[0] for row in cursor.fetchall()]
+
+    if new_position > 1 and not keys:
+        # Позиция за концом очереди (очередь успела сократиться): ставим пользователя
+        # в конец, как и кэш очередей
+        return _next_order_key(cursor, queue_id)
+    if new_position == 1:
+        prev_key, next_key = None, keys[0] if keys else None
+    else:
+        prev_key = keys[0] if keys else None
+        next_key = keys[1] if len(keys) > 1 else None
+    
+    if prev_key is None and next_key is None:
+        return ORDER_GAP
+    if prev_key is None:
+        return next_key - ORDER_GAP
+    if next_key is None:
+        return prev_key + ORDER_GAP
+    if next_key - prev_key > 1:
+        return (prev_key + next_key) // 2
+    return None
+
+@_timed
 def set_user_position(queue_id, user_id, new_position):
     """Изменение позиции пользователя в очереди"""
-    with db_lock:
-        # Получаем текущую позицию пользователя
+    def operation(cursor):
+        # Получаем ключ сортировки пользователя
         cursor.execute("SELECT join_order FROM QueueMembers WHERE queue_id = ? AND user_id = ?", 
                       (queue_id, user_id))
         result = cursor.fetchone()
         if not result:
             return False, None
         
-        user_order = result[0]
+        user_order = _position_by_key(cursor, queue_id, result[0])
         
         # Если новая позиция совпадает с текущей, ничего не делаем
         if user_order == new_position:
             return False, user_order
         
-        # Временно удаляем пользователя из очереди
-        cursor.execute("DELETE FROM QueueMembers WHERE queue_id = ? AND user_id = ?", 
-                     (queue_id, user_id))
+        # Вычисляем ключ между новыми соседями; если места нет, перенумеровываем очередь
+        new_key = _key_for_position(cursor, queue_id, user_id, new_position)
+        if new_key is None:
+            _rebalance_queue(cursor, queue_id)
+            new_key = _key_for_position(cursor, queue_id, user_id, new_position)
         
-        # Если перемещаем вверх (на меньшую позицию)
-        if new_position < user_order:
-            cursor.execute("""
-                UPDATE QueueMembers 
-                SET join_order = join_order + 1 
-                WHERE queue_id = ? AND join_order >= ? AND join_order < ?
-            """, (queue_id, new_position, user_order))
-        # Если перемещаем вниз (на большую позицию)
-        else:
-            cursor.execute("""
-                UPDATE QueueMembers 
-                SET join_order = join_order - 1 
-                WHERE queue_id = ? AND join_order > ? AND join_order <= ?
-            """, (queue_id, user_order, new_position))
+        cursor.execute("UPDATE QueueMembers SET join_order = ? WHERE queue_id = ? AND user_id = ?", 
+                      (new_key, queue_id, user_id))
+        _bump_version(cursor, queue_id)
+        return True, user_order
+
+    def on_commit(result):
+        success, _ = result
+        if success:
+            _queue_cache.move_member(queue_id, user_id, new_position - 1)
+
+    return _write(operation, on_commit)
+
+def _rewrite_queue(queue_id, arrange):
+    """
+    Перестановка и удаление участников очереди в одной транзакции записи.
+
+    Ключи сортировки оставшихся участников перезаписываются одним executemany,
+    версия очереди увеличивается один раз.
+
+    Args:
+        arrange: функция (cursor, user_ids), получающая участников в текущем порядке
+            и возвращающая оставшихся участников в новом порядке
+
+    Returns:
+        tuple: (новый порядок, удаленные user_id) или None, если очередь не изменилась
+    """
+    def operation(cursor):
+        cursor.execute("SELECT user_id FROM QueueMembers WHERE queue_id = ? ORDER BY join_order", (queue_id,))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        order = arrange(cursor, user_ids)
+        kept = set(order)
+        removed = [user_id for user_id in user_ids if user_id not in kept]
+        remaining = [user_id for user_id in user_ids if user_id in kept]
+        if not removed and order == remaining:
+            return None
         
-        # Добавляем пользователя на новую позицию
-        cursor.execute("INSERT INTO QueueMembers (queue_id, user_id, join_order) VALUES (?, ?, ?)", 
-                     (queue_id, user_id, new_position))
+        cursor.executemany("DELETE FROM QueueMembers WHERE queue_id = ? AND user_id = ?",
+                          [(queue_id, user_id) for user_id in removed])
+        if order != remaining:
+            cursor.executemany("UPDATE QueueMembers SET join_order = ? WHERE queue_id = ? AND user_id = ?",
+                              [((index + 1) * ORDER_GAP, queue_id, user_id) for index, user_id in enumerate(order)])
+        _bump_version(cursor, queue_id, -len(removed))
+        return order, removed
+
+    def on_commit(result):
+        if result is not None:
+            _queue_cache.set_members_order(queue_id, result[0])
+
+    return _write(operation, on_commit)
+
+@_timed
+def shuffle_queue(queue_id, rng=random):
+    """
+    Случайная перестановка участников очереди.
+
+    Args:
+        rng: генератор случайных чисел (random.Random) с методом sample
+
+    Returns:
+        bool: True, если порядок изменился
+    """
+    return _rewrite_queue(queue_id, lambda cursor, user_ids: rng.sample(user_ids, len(user_ids))) is not None
+
+@_timed
+def sort_queue_by_join_time(queue_id):
+    """
+    Упорядочивание участников по времени вступления в очередь (перемещения в конец
+    и пропуски не учитываются).
+
+    Returns:
+        bool: True, если порядок изменился
+    """
+    def arrange(cursor, user_ids):
+        cursor.execute("SELECT user_id FROM QueueMembers WHERE queue_id = ? ORDER BY joined_at, rowid", (queue_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+    return _rewrite_queue(queue_id, arrange) is not None
+
+@_timed
+def set_queue_order(queue_id, user_ids):
+    """
+    Установка порядка очереди: участники из user_ids встают в начало в указанном
+    порядке, остальные следуют за ними в прежнем порядке. Пользователи, не
+    состоящие в очереди, пропускаются.
+
+    Returns:
+        bool: True, если порядок изменился
+    """
+    def arrange(cursor, members):
+        member_set = set(members)
+        first = [user_id for user_id in dict.fromkeys(user_ids) if user_id in member_set]
+        listed = set(first)
+        return first + [user_id for user_id in members if user_id not in listed]
+
+    return _rewrite_queue(queue_id, arrange) is not None
+
+@_timed
+def remove_users_from_queue(queue_id, user_ids):
+    """
+    Удаление нескольких пользователей из очереди.
+
+    Returns:
+        Список удаленных user_id (пользователи, не состоящие в очереди, пропускаются)
+    """
+    excluded = set(user_ids)
+    result = _rewrite_queue(queue_id, lambda cursor, members: [user_id for user_id in members
+                                                                if user_id not in excluded])
+    return result[1] if result else []
+
+@_timed
+def clear_queue(queue_id):
+    """
+    Удаление всех участников очереди (сама очередь остается).
+
+    Returns:
+        int: количество удаленных участников
+    """
+    result = _rewrite_queue(queue_id, lambda cursor, members: [])
+    return len(result[1]) if result else 0
+
+# Способы найти очередь для составных операций: условие WHERE и его параметры.
+# Поиск по ID тоже проверяет чат, чтобы данные кнопки не давали доступ к чужим очередям
+def _by_name(chat_id, queue_name):
+    return "queue_name = ? AND chat_id = ?", (queue_name, chat_id)
+
+def _by_id(chat_id, queue_id):
+    return "queue_id = ? AND chat_id = ?", (queue_id, chat_id)
+
+def _find_member(cursor, queue, user_id):
+    """
+    Поиск очереди и ключа сортировки пользователя в ней.
+
+    Args:
+        queue: условие поиска очереди (_by_name или _by_id)
+
+    Returns:
+        tuple: (ID очереди, название очереди, ключ сортировки или None, если пользователь
+        не состоит в очереди); (None, None, None), если очередь не найдена
+    """
+    condition, params = queue
+    cursor.execute(f"SELECT queue_id, queue_name FROM Queues WHERE {condition}", params)
+    row = cursor.fetchone()
+    if not row:
+        return None, None, None
+    cursor.execute("SELECT join_order FROM QueueMembers WHERE queue_id = ? AND user_id = ?", (row[0], user_id))
+    member = cursor.fetchone()
+    return row[0], row[1], member[0] if member else None
+
+def _run_queue_operation(user_id, operation, apply_changes):
+    """
+    Выполнение составной операции в одной транзакции записи.
+
+    Args:
+        user_id: пользователь, выполняющий операцию
+        operation: функция (cursor), возвращающая (status, queue_id, queue_name, позиция пользователя
+            после операции (для выхода - до выхода), данные для кэша)
+        apply_changes: функция (queue_id, данные), применяющая выполненную операцию к кэшу
+
+    Returns:
+        QueueOperation
+    """
+    snapshots = []
+
+    def on_commit(result):
+        status, queue_id, _, _, changes = result
+        if status == DONE:
+            apply_changes(queue_id, changes)
+        if queue_id is not None:
+            # Снимок берется сразу после применения изменений, до следующих операций записи
+            snapshots.append(_queue_cache.snapshot(queue_id))
+
+    status, queue_id, queue_name, position, _ = _write(operation, on_commit)
+    if queue_id is None:
+        return QueueOperation(QUEUE_NOT_FOUND, None, None, None, None)
+    
+    # Незакэшированная очередь не загружается целиком: снимка нет, позиция вычислена
+    # в транзакции операции, а обработчик прочитает нужную страницу
+    if not snapshots or snapshots[0] is None:
+        return QueueOperation(status, queue_id, position, None, queue_name)
+    
+    version, creator_name, members = snapshots[0]
+    if not _is_current(queue_id, version):
+        # Изменение применено к устаревшему состоянию (имена изменил другой процесс)
+        return QueueOperation(status, queue_id, position, None, queue_name)
+    snapshot = QueueSnapshot(version, creator_name,
+                             [(name, username, index, member_id)
+                              for index, (name, username, member_id) in enumerate(members, 1)])
+    # Позиция пользователя в снимке, если он остался в очереди
+    for name, username, index, member_id in snapshot.members:
+        if member_id == user_id:
+            position = index
+            break
+    return QueueOperation(status, queue_id, position, snapshot, queue_name)
+
+def _join(queue, user_id):
+    def operation(cursor):
+        queue_id, queue_name, user_key = _find_member(cursor, queue, user_id)
+        if queue_id is None:
+            return QUEUE_NOT_FOUND, None, None, None, None
+        if user_key is not None:
+            return ALREADY_MEMBER, queue_id, queue_name, _position_by_key(cursor, queue_id, user_key), None
         
-        connection.commit()
-        return True, user_order
+        new_key = _next_order_key(cursor, queue_id)
+        cursor.execute("INSERT INTO QueueMembers (queue_id, user_id, join_order, joined_at) VALUES (?, ?, ?, ?)", 
+                      (queue_id, user_id, new_key, time.time()))
+        _bump_version(cursor, queue_id, 1)
+        return DONE, queue_id, queue_name, _position_by_key(cursor, queue_id, new_key), _member_entry(cursor, user_id)
+
+    return _run_queue_operation(user_id, operation, _append_to_cache)
+
+def _exit(queue, user_id):
+    def operation(cursor):
+        queue_id, queue_name, user_key = _find_member(cursor, queue, user_id)
+        if queue_id is None:
+            return QUEUE_NOT_FOUND, None, None, None, None
+        if user_key is None:
+            return NOT_MEMBER, queue_id, queue_name, None, None
+        
+        position = _position_by_key(cursor, queue_id, user_key)
+        cursor.execute("DELETE FROM QueueMembers WHERE queue_id = ? AND user_id = ?", (queue_id, user_id))
+        _bump_version(cursor, queue_id, -1)
+        return DONE, queue_id, queue_name, position, None
+
+    return _run_queue_operation(user_id, operation,
+                                lambda queue_id, _: _queue_cache.remove_member(queue_id, user_id))
+
+def _rejoin(queue, user_id):
+    def operation(cursor):
+        queue_id, queue_name, user_key = _find_member(cursor, queue, user_id)
+        if queue_id is None:
+            return QUEUE_NOT_FOUND, None, None, None, None
+        if user_key is None:
+            return NOT_MEMBER, queue_id, queue_name, None, None
+        
+        new_key = _next_order_key(cursor, queue_id)
+        cursor.execute("UPDATE QueueMembers SET join_order = ? WHERE queue_id = ? AND user_id = ?", 
+                      (new_key, queue_id, user_id))
+        _bump_version(cursor, queue_id)
+        return DONE, queue_id, queue_name, _position_by_key(cursor, queue_id, new_key), None
+
+    return _run_queue_operation(user_id, operation,
+                                lambda queue_id, _: _queue_cache.move_member(queue_id, user_id))
+
+def _skip(queue, user_id):
+    def operation(cursor):
+        queue_id, queue_name, user_key = _find_member(cursor, queue, user_id)
+        if queue_id is None:
+            return QUEUE_NOT_FOUND, None, None, None, None
+        if user_key is None:
+            return NOT_MEMBER, queue_id, queue_name, None, None
+        
+        cursor.execute("""
+            SELECT user_id, join_order FROM QueueMembers 
+            WHERE queue_id = ? AND join_order > ? 
+            ORDER BY join_order LIMIT 1
+        """, (queue_id, user_key))
+        next_member = cursor.fetchone()
+        if not next_member:
+            return LAST_IN_QUEUE, queue_id, queue_name, _position_by_key(cursor, queue_id, user_key), None
+        
+        next_user_id, next_key = next_member
+        cursor.executemany("UPDATE QueueMembers SET join_order = ? WHERE queue_id = ? AND user_id = ?",
+                          [(user_key, queue_id, next_user_id), (next_key, queue_id, user_id)])
+        _bump_version(cursor, queue_id)
+        return DONE, queue_id, queue_name, _position_by_key(cursor, queue_id, next_key), None
+
+    return _run_queue_operation(user_id, operation,
+                                lambda queue_id, _: _queue_cache.swap_with_next(queue_id, user_id))
+
+@_timed
+def join_by_name(chat_id, queue_name, user_id):
+    """
+    Присоединение пользователя к очереди по ее названию в одной транзакции.
+
+    Returns:
+        QueueOperation со статусом QUEUE_NOT_FOUND, ALREADY_MEMBER или DONE
+    """
+    return _join(_by_name(chat_id, queue_name), user_id)
+
+@_timed
+def exit_by_name(chat_id, queue_name, user_id):
+    """
+    Выход пользователя из очереди по ее названию в одной транзакции.
+
+    Returns:
+        QueueOperation со статусом QUEUE_NOT_FOUND, NOT_MEMBER или DONE;
+        position - позиция, которую пользователь занимал до выхода
+    """
+    return _exit(_by_name(chat_id, queue_name), user_id)
+
+@_timed
+def rejoin_by_name(chat_id, queue_name, user_id):
+    """
+    Перемещение пользователя в конец очереди по ее названию в одной транзакции.
+
+    Returns:
+        QueueOperation со статусом QUEUE_NOT_FOUND, NOT_MEMBER или DONE
+    """
+    return _rejoin(_by_name(chat_id, queue_name), user_id)
+
+@_timed
+def skip_by_name(chat_id, queue_name, user_id):
+    """
+    Обмен пользователя местами со следующим участником очереди в одной транзакции.
+
+    Returns:
+        QueueOperation со статусом QUEUE_NOT_FOUND, NOT_MEMBER, LAST_IN_QUEUE или DONE
+    """
+    return _skip(_by_name(chat_id, queue_name), user_id)
+
+@_timed
+def join_by_id(chat_id, queue_id, user_id):
+    """Присоединение к очереди по ID (из данных кнопки), аналог join_by_name"""
+    return _join(_by_id(chat_id, queue_id), user_id)
+
+@_timed
+def exit_by_id(chat_id, queue_id, user_id):
+    """Выход из очереди по ID (из данных кнопки), аналог exit_by_name"""
+    return _exit(_by_id(chat_id, queue_id), user_id)
+
+@_timed
+def rejoin_by_id(chat_id, queue_id, user_id):
+    """Перемещение в конец очереди по ID (из данных кнопки), аналог rejoin_by_name"""
+    return _rejoin(_by_id(chat_id, queue_id), user_id)
+
+@_timed
+def skip_by_id(chat_id, queue_id, user_id):
+    """Обмен местами со следующим участником по ID очереди (из данных кнопки), аналог skip_by_name"""
+    return _skip(_by_id(chat_id, queue_id), user_id)
+
+def get_cache_stats():
+    """Статистика кэша состояния очередей: размер, попадания, промахи и вытеснения"""
+    return _queue_cache.stats()
 
 def close_connection():
-    """Закрытие соединения с базой данных"""
-    connection.close() 
\ No newline at end of file
+    """Фиксация отложенных записей и закрытие всех соединений пула с базой данных"""
+    global _group_writer, _local
+
+    if _group_writer is not None:
+        _group_writer.stop()
+        _group_writer = None
+    
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    # Потоки, обратившиеся к базе после закрытия, откроют новые соединения
+    _local = threading.local()
+    for connection in connections:
+        connection.close()
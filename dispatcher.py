@@ -0,0 +1,152 @@
+import collections
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class ChatLaneDispatcher:
+    """
+    Диспетчер задач с очередями (полосами) по ключу, обычно по ID чата.
+
+    Задачи с одним ключом выполняются строго по одной и в порядке поступления,
+    задачи с разными ключами - параллельно в общем пуле потоков. Полоса
+    существует, пока в ней есть задачи, поэтому память занимают только активные чаты.
+    """
+
+    # Сколько задач подряд выполняет поток из одной полосы, прежде чем уступить
+    # место другим полосам (чтобы активный чат не занимал поток надолго)
+    MAX_BATCH = 16
+
+    def __init__(self, workers, name="lanes"):
+        """
+        Args:
+            workers: количество потоков, выполняющих задачи
+            name: префикс имен потоков
+        """
+        self.workers = workers
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self._lanes = {}  # ключ -> deque ожидающих задач (полоса активна, пока ключ в словаре)
+        self._closed = False
+        self._lock = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+
+    def submit(self, key, task):
+        """
+        Постановка задачи в полосу key.
+
+        Args:
+            key: ключ полосы (задачи с одинаковым ключом выполняются по порядку)
+            task: функция без аргументов
+
+        Raises:
+            RuntimeError: диспетчер остановлен
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Dispatcher stopped")
+            self.submitted += 1
+            lane = self._lanes.get(key)
+            if lane is not None:
+                # Полоса уже обрабатывается: задачу выполнит тот же поток после текущих
+                lane.append(task)
+                self.max_depth = max(self.max_depth, len(lane))
+                return
+            self._lanes[key] = collections.deque()
+        try:
+            self._executor.submit(self._run_lane, key, task)
+        except RuntimeError:
+            # Пул потоков остановлен между проверкой и постановкой задачи
+            self._drop_lane(key, 1)
+            raise
+
+    def _run_lane(self, key, task):
+        for _ in range(self.MAX_BATCH):
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"Error processing task in lane {key}: {str(e)}", exc_info=True)
+                with self._lock:
+                    self.failed += 1
+            with self._lock:
+                self.processed += 1
+                lane = self._lanes[key]
+                if not lane:
+                    del self._lanes[key]
+                    self._lock.notify_all()
+                    return
+                task = lane.popleft()
+        # Полоса не опустела: продолжаем ее после задач других полос
+        try:
+            self._executor.submit(self._run_lane, key, task)
+        except RuntimeError:
+            dropped = self._drop_lane(key, 1)
+            logger.warning(f"Dispatcher stopped, {dropped} tasks in lane {key} dropped")
+
+    def _drop_lane(self, key, pending):
+        """
+        Удаление полосы, которую больше некому выполнить; ее задачи считаются невыполненными.
+
+        Args:
+            key: ключ полосы
+            pending: количество задач полосы, уже извлеченных из очереди
+
+        Returns:
+            int: количество отброшенных задач
+        """
+        with self._lock:
+            dropped = pending + len(self._lanes.pop(key))
+            self.failed += dropped
+            self._lock.notify_all()
+            return dropped
+
+    def depth(self):
+        """Количество задач, ожидающих выполнения (без выполняемых)"""
+        with self._lock:
+            return sum(len(lane) for lane in self._lanes.values())
+
+    def stats(self):
+        """Статистика: поставлено, выполнено, с ошибкой, активные полосы, ожидают и наибольшая длина полосы"""
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'failed': self.failed,
+                'lanes': len(self._lanes),
+                'queued': sum(len(lane) for lane in self._lanes.values()),
+                'max_depth': self.max_depth,
+            }
+
+    def join(self, timeout=None):
+        """
+        Ожидание выполнения всех поставленных задач.
+
+        Returns:
+            bool: True, если все задачи выполнены до истечения timeout секунд
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._lanes:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            return True
+
+    def stop(self, timeout=5):
+        """
+        Остановка диспетчера. Новые задачи не принимаются (submit вызывает RuntimeError),
+        уже поставленные выполняются.
+
+        Args:
+            timeout: сколько секунд ждать выполнения уже поставленных задач
+        """
+        with self._lock:
+            self._closed = True
+        if not self.join(timeout):
+            logger.warning(f"Update dispatcher stopped with {self.depth()} queued tasks")
+        self._executor.shutdown(wait=False)
@@ -1,86 +1,139 @@
 import telebot
-import sqlite3
 import threading
 import time
 import os
 import functools
 import collections
 from config import BOT_TOKEN, MESSAGES
-import database as db
+from config import RENDER_CACHE_SIZE, MESSAGE_VERSIONS_CACHE_SIZE, EDIT_COALESCE_WINDOW, QUEUE_PAGE_SIZE
+from config import ADMIN_CACHE_TTL, ADMIN_CACHE_SIZE, USER_PROFILE_CACHE_SIZE
+from config import OUTBOUND_LIMITS, OUTBOUND_WORKERS, UPDATE_WORKERS
+from config import BOT_MODE, ALLOWED_UPDATES
+from config import METRICS_HOST, METRICS_PORT, TELEGRAM_API_URL
+from cache import LRUCache, AdminCache
+from rate_limiter import RateLimiter
+from dispatcher import ChatLaneDispatcher
+from outbound import EditCoalescer, RetryScheduler, OutboundGovernor, get_retry_after
+from outbound import PRIORITY_CALLBACK, PRIORITY_EDIT, PRIORITY_MESSAGE
+from storage import default_storage as db, QueueExistsError
+import metrics
+import callback_data
+import webhook
+from webhook import create_webhook_server
 import logging
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
 
+# Диспетчер обработки обновлений: обновления одного чата выполняются по порядку,
+# обновления разных чатов - параллельно
+update_dispatcher = ChatLaneDispatcher(UPDATE_WORKERS, name="updates")
+
+def update_chat_id(update):
+    """ID чата, к которому относится обновление (ключ полосы диспетчера)"""
+    message = update.message or update.edited_message
+    if message is not None:
+        return message.chat.id
+    if update.callback_query is not None:
+        call = update.callback_query
+        return call.message.chat.id if call.message is not None else call.from_user.id
+    member_update = update.chat_member or update.my_chat_member or update.chat_join_request
+    if member_update is not None:
+        return member_update.chat.id
+    return None
+
+class ChatLaneTeleBot(telebot.TeleBot):
+    """
+    TeleBot, передающий каждое обновление в полосу его чата в update_dispatcher.
+
+    Сам бот создается с threaded=False: обработчики выполняются в потоке диспетчера,
+    а не в собственном пуле потоков TeleBot.
+    """
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # Смещение getUpdates сдвигаем сразу, не дожидаясь обработки обновления
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            update_dispatcher.submit(update_chat_id(update),
+                                     functools.partial(super().process_new_updates, [update]))
+
+# Локальный сервер Bot API вместо api.telegram.org
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
 # Создаем экземпляр бота
-bot = telebot.TeleBot(BOT_TOKEN)
+bot = ChatLaneTeleBot(BOT_TOKEN, threaded=False)
 
 # Глобальная переменная для контроля работы бота
 bot_running = True
 
-# Системы защиты от спама и флуда
+# HTTP-сервер вебхука (в режиме BOT_MODE=webhook)
+webhook_server = None
+
+# HTTP-сервер метрик (если METRICS_PORT не равен 0)
+metrics_server = None
 
-# Словари для отслеживания использования команд
-command_usage = {}  # Для индивидуальных пользователей
-chat_command_usage = {}  # Для групповых чатов
-join_queue_usage = {}  # Специально для команды присоединения к очереди
+# Системы защиты от спама и флуда
 
 # Настройки ограничений
 RATE_LIMITS = {
     'default': {'count': 5, 'period': 60},  # 5 команд в минуту для обычных команд
     'join': {'count': 30, 'period': 60},    # 30 присоединений к очереди в минуту
-    'chat': {'count': 30, 'period': 60}     # 30 команд в минуту для всего чата
+    'chat': {'count': 30, 'period': 60},    # 30 команд в минуту для всего чата
+    # Перелистывание страниц очереди: изменения одного сообщения объединяются в окне
+    # EDIT_COALESCE_WINDOW, поэтому нажатие дешево и не расходует лимит команд
+    'page': {'count': 20, 'period': 10},    # 20 нажатий подряд, затем 2 в секунду
 }
 
+# Ограничители частоты для каждого типа ограничения (ключ - ID пользователя или чата)
+rate_limiters = {name: RateLimiter(limit['count'], limit['period']) for name, limit in RATE_LIMITS.items()}
+
 def check_rate_limit(user_id, command_type='default', chat_id=None):
     """
     Проверяет, не превышен ли лимит использования команд.
     
     Args:
         user_id: ID пользователя
-        command_type: Тип команды ('default', 'join', 'chat')
+        command_type: Тип команды ('default', 'join', 'chat', 'page')
         chat_id: ID чата (для групповых ограничений)
         
     Returns:
         tuple: (is_limited, wait_time) - превышен ли лимит и время ожидания
     """
-    current_time = time.time()
-    
-    # Выбираем соответствующий словарь и настройки в зависимости от типа команды
-    if command_type == 'join':
-        usage_dict = join_queue_usage
-        limit_settings = RATE_LIMITS['join']
-    elif command_type == 'chat' and chat_id:
-        usage_dict = chat_command_usage
-        limit_settings = RATE_LIMITS['chat']
-        key = str(chat_id)
+    # Выбираем ограничитель и ключ в зависимости от типа команды
+    if command_type == 'chat' and chat_id:
+        limiter, key = rate_limiters['chat'], chat_id
+    elif command_type in ('join', 'page'):
+        limiter, key = rate_limiters[command_type], user_id
     else:
-        usage_dict = command_usage
-        limit_settings = RATE_LIMITS['default']
-        key = str(user_id)
-    
-    # Для индивидуальных ограничений используем ID пользователя
-    if command_type != 'chat':
-        key = str(user_id)
-    
-    # Инициализируем очередь временных меток, если её еще нет
-    if key not in usage_dict:
-        usage_dict[key] = collections.deque()
+        limiter, key = rate_limiters['default'], user_id
     
-    # Удаляем устаревшие временные метки
-    while usage_dict[key] and current_time - usage_dict[key][0] > limit_settings['period']:
-        usage_dict[key].popleft()
-    
-    # Проверяем, не превышен ли лимит
-    if len(usage_dict[key]) >= limit_settings['count']:
-        # Вычисляем, сколько нужно подождать до освобождения слота
-        wait_time = int(usage_dict[key][0] + limit_settings['period'] - current_time) + 1
-        return True, wait_time
-    
-    # Добавляем текущую временную метку
-    usage_dict[key].append(current_time)
+    wait_time = limiter.hit(key)
+    if wait_time:
+        metrics.RATE_LIMIT_REJECTIONS.inc(command_type)
+        # Округляем время ожидания вверх до целых секунд
+        return True, int(wait_time) + 1
     return False, 0
 
+def timed_handler(label):
+    """
+    Декоратор для учета времени выполнения обработчика в метрике HANDLER_LATENCY.
+    
+    Args:
+        label: Название обработчика или функция, получающая обновление и возвращающая название
+        
+    Returns:
+        Декоратор функции
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(update, *args, **kwargs):
+            with metrics.HANDLER_LATENCY.time(label(update) if callable(label) else label):
+                return func(update, *args, **kwargs)
+        return wrapper
+    return decorator
+
 def rate_limit_decorator(command_type='default'):
     """
     Декоратор для ограничения частоты использования команд.
@@ -122,56 +175,110 @@ def rate_limit_decorator(command_type='default'):
         return wrapper
     return decorator
 
-# Декоратор для повторных попыток при ошибке превышения лимита запросов
-def retry_on_rate_limit(max_retries=3, initial_delay=1):
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            retries = 0
-            delay = initial_delay
-            
-            while retries <= max_retries:
-                try:
-                    return func(*args, **kwargs)
-                except telebot.apihelper.ApiTelegramException as e:
-                    if "Too Many Requests" in str(e) or e.error_code == 429:
-                        retry_after = delay
-                        
-                        # Пытаемся получить время ожидания из ответа
-                        if hasattr(e, 'result') and isinstance(e.result, dict):
-                            if 'parameters' in e.result and 'retry_after' in e.result['parameters']:
-                                retry_after = e.result['parameters']['retry_after']
-                        
-                        if retries < max_retries:
-                            logger.warning(f"Rate limit exceeded. Retry {retries+1}/{max_retries} after {retry_after} seconds")
-                            time.sleep(retry_after)
-                            retries += 1
-                            delay *= 2  # Экспоненциальное увеличение задержки
-                        else:
-                            logger.error(f"Max retries exceeded for rate limit. Giving up.")
-                            raise
-                    else:
-                        # Другие ошибки API пробрасываем дальше
-                        raise
-        return wrapper
-    return decorator
+# Ограничитель исходящих запросов: общий лимит и лимиты групп, приоритеты запросов
+outbound_governor = OutboundGovernor(OUTBOUND_LIMITS['global'], OUTBOUND_LIMITS['group'], workers=OUTBOUND_WORKERS)
+
+# Планировщик повторной отправки запросов после ошибки превышения лимита (429);
+# повторы снова проходят через ограничитель. Ограничитель берется при каждом повторе:
+# рабочий процесс супервизора заменяет outbound_governor своим (supervisor.run_worker)
+retry_scheduler = RetryScheduler(max_retries=3, initial_delay=1,
+                                 submit=lambda *args, **kwargs: outbound_governor.submit(*args, **kwargs))
+
+def log_outbound_error(future):
+    """Запись в лог ошибки запроса, выполненного ограничителем"""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None and "message is not modified" not in str(error):
+        logger.error(f"Error sending request to Telegram: {str(error)}")
+
+def call_api(method, request):
+    """
+    Выполнение запроса к Telegram с учетом его времени и ошибок 429 в метриках.
+
+    Args:
+        method: название метода Bot API (метка метрик)
+        request: функция без аргументов, выполняющая запрос
+
+    Returns:
+        Результат запроса
+    """
+    try:
+        with metrics.API_LATENCY.time(method):
+            return request()
+    except telebot.apihelper.ApiTelegramException as e:
+        if get_retry_after(e) is not None:
+            metrics.API_RATE_LIMITED.inc(method)
+        raise
+
+def send_outbound(priority, chat_id, method, request, key=None, on_error=None):
+    """
+    Отправка запроса к Telegram через ограничитель с повтором при ошибке 429.
+
+    Обработчик не ждет отправки: повторы после ошибки 429 retry_scheduler снова
+    ставит в очередь ограничителя с тем же приоритетом, а ошибки записываются в лог.
+
+    Args:
+        priority: приоритет запроса (PRIORITY_CALLBACK, PRIORITY_EDIT, PRIORITY_MESSAGE)
+        chat_id: ID чата назначения
+        method: название метода Bot API (для метрик)
+        request: функция без аргументов, выполняющая запрос
+        key: ключ замены ожидающего запроса более новым
+        on_error: функция (error), вызываемая, если запрос не выполнен, в том числе
+            когда отложенный после ошибки 429 запрос так и не был отправлен
+            (error - None, если запрос отменен)
+
+    Returns:
+        Future с результатом запроса (None, если запрос отложен после ошибки 429)
+    """
+    timed_request = lambda: call_api(method, request)
+    future = outbound_governor.submit(
+        lambda: retry_scheduler.call(timed_request, chat_id=chat_id, key=key, priority=priority, on_error=on_error),
+        priority, chat_id=chat_id, key=key
+    )
+    future.add_done_callback(log_outbound_error)
+    if on_error is not None:
+        def report_error(future):
+            if future.cancelled():
+                on_error(None)
+            elif future.exception() is not None:
+                on_error(future.exception())
+        future.add_done_callback(report_error)
+    return future
 
 # Безопасные функции для работы с API Telegram
-@retry_on_rate_limit()
 def safe_send_message(chat_id, text, **kwargs):
-    return bot.send_message(chat_id, text, **kwargs)
+    return send_outbound(PRIORITY_MESSAGE, chat_id, 'sendMessage', lambda: bot.send_message(chat_id, text, **kwargs))
 
-@retry_on_rate_limit()
-def safe_edit_message_text(chat_id, message_id, text, **kwargs):
-    return bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+def safe_edit_message_text(chat_id, message_id, text, on_error=None, **kwargs):
+    return send_outbound(PRIORITY_EDIT, chat_id, 'editMessageText',
+                         lambda: bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, **kwargs),
+                         key=(chat_id, message_id), on_error=on_error)
 
-@retry_on_rate_limit()
 def safe_answer_callback_query(callback_query_id, text, **kwargs):
-    return bot.answer_callback_query(callback_query_id, text, **kwargs)
+    return send_outbound(PRIORITY_CALLBACK, None, 'answerCallbackQuery', lambda: bot.answer_callback_query(callback_query_id, text, **kwargs))
 
-@retry_on_rate_limit()
 def safe_reply_to(message, text, **kwargs):
-    return bot.reply_to(message, text, **kwargs)
+    return send_outbound(PRIORITY_MESSAGE, message.chat.id, 'sendMessage', lambda: bot.reply_to(message, text, **kwargs))
+
+# Статусы участников чата, дающие права администратора бота
+ADMIN_STATUSES = ['administrator', 'creator']
+
+def fetch_chat_admins(chat_id):
+    """Загрузка ID администраторов и создателя группы одним запросом"""
+    admins = call_api('getChatAdministrators', lambda: bot.get_chat_administrators(chat_id))
+    return {member.user.id for member in admins}
+
+# Кэш администраторов групп
+admin_cache = AdminCache(fetch_chat_admins, ADMIN_CACHE_TTL, ADMIN_CACHE_SIZE)
+
+def is_chat_admin(chat_id, user_id):
+    """Проверка, является ли пользователь администратором или создателем чата"""
+    if chat_id > 0:
+        # В личном чате нет списка администраторов, проверяем участника напрямую
+        member = call_api('getChatMember', lambda: bot.get_chat_member(chat_id, user_id))
+        return member.status in ADMIN_STATUSES
+    return admin_cache.is_admin(chat_id, user_id)
 
 # Функция для обработки ошибок
 def handle_error(message, error, operation):
@@ -184,6 +291,7 @@ def handle_error(message, error, operation):
 
 # Обработчик команды /start
 @bot.message_handler(commands=['start'])
+@timed_handler('start')
 @rate_limit_decorator('default')
 def send_welcome(message):
     try:
@@ -199,6 +307,7 @@ def send_welcome(message):
     
 # Обработчик команды /help
 @bot.message_handler(commands=['help'])
+@timed_handler('help')
 @rate_limit_decorator('default')
 def send_help(message):
     try:
@@ -208,6 +317,7 @@ def send_help(message):
     
 # Обработчик упоминаний бота в группе
 @bot.message_handler(func=lambda message: message.text and '@QueueMateBot' in message.text)
+@timed_handler('mention')
 @rate_limit_decorator('default')
 def handle_mention(message):
     # Получаем список очередей в текущем чате
@@ -233,10 +343,11 @@ def handle_mention(message):
     response += "`/exit [название]` - выйти из очереди\n"
     response += "`/help` - полный список команд\n"
     
-    bot.reply_to(message, response, parse_mode="Markdown")
+    safe_reply_to(message, response, parse_mode="Markdown")
 
 # Обработчик команды /create
 @bot.message_handler(commands=['create'])
+@timed_handler('create')
 @rate_limit_decorator('default')
 def create_queue(message):
     try:
@@ -245,7 +356,7 @@ def create_queue(message):
         
         # Проверяем, указано ли название очереди
         if len(command_parts) < 2:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди. Пример: /create Математика")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: /create Математика")
             return
         
         queue_name = command_parts[1].strip()
@@ -253,9 +364,8 @@ def create_queue(message):
         user_id = message.from_user.id
         
         # Проверяем, является ли пользователь администратором или создателем чата
-        chat_member = bot.get_chat_member(chat_id, user_id)
-        if chat_member.status not in ['administrator', 'creator']:
-            bot.reply_to(message, "Только администраторы могут создавать очереди.")
+        if not is_chat_admin(chat_id, user_id):
+            safe_reply_to(message, "Только администраторы могут создавать очереди.")
             return
         
         # Добавляем чат в базу данных
@@ -268,66 +378,161 @@ def create_queue(message):
         # Создаем новую очередь
         db.create_queue(queue_name, chat_id, user_id)
         
-        bot.reply_to(message, f"Очередь '*{queue_name}*' успешно создана! Используйте `/join {queue_name}` чтобы присоединиться.", parse_mode="Markdown")
+        safe_reply_to(message, f"Очередь '*{queue_name}*' успешно создана! Используйте `/join {queue_name}` чтобы присоединиться.", parse_mode="Markdown")
     
-    except sqlite3.IntegrityError:
-        bot.reply_to(message, f"Очередь с названием '{queue_name}' уже существует в этом чате.")
+    except QueueExistsError:
+        safe_reply_to(message, f"Очередь с названием '{queue_name}' уже существует в этом чате.")
     except Exception as e:
         handle_error(message, e, "создании очереди")
 
-# Вспомогательная функция для форматирования вывода очереди
-def format_queue_info(queue_name, queue_id):
-    # Получаем информацию о создателе очереди
-    creator_name = db.get_queue_creator(queue_id)
-    
-    # Получаем список участников очереди
-    queue_members = db.get_queue_members(queue_id)
-    
-    if not queue_members:
+# Кэши отображения очередей
+# Текст страницы очереди для (queue_id, version, page): повторные просмотры не пересобирают Markdown
+rendered_queues = LRUCache(RENDER_CACHE_SIZE)
+# Клавиатуры управления очередью по (queue_id, version, page, pages)
+queue_keyboards = LRUCache(RENDER_CACHE_SIZE)
+# Версия очереди и страница, показанные в сообщении: (chat_id, message_id) -> (queue_id, version, page)
+message_versions = LRUCache(MESSAGE_VERSIONS_CACHE_SIZE)
+# Страница, выбранная для сообщения: (chat_id, message_id) -> (queue_id, page). Запоминается
+# сразу при нажатии «◀» / «▶», поэтому отложенное изменение после других нажатий покажет ее же
+message_pages = LRUCache(MESSAGE_VERSIONS_CACHE_SIZE)
+# Объединение изменений сообщений с очередями при частых нажатиях кнопок. Изменение
+# выполняется в полосе чата update_dispatcher, а не в отдельном потоке на каждое сообщение
+edit_coalescer = EditCoalescer(EDIT_COALESCE_WINDOW,
+                               submit=lambda key, task: update_dispatcher.submit(key[0], task))
+
+# Таблица экранирования специальных символов Markdown
+MARKDOWN_ESCAPES = str.maketrans({'*': '\\*', '_': '\\_', '`': '\\`', '[': '\\['})
+
+def escape_markdown(text):
+    """Экранирование специальных символов Markdown"""
+    return text.translate(MARKDOWN_ESCAPES)
+
+def build_queue_text(queue_name, creator_name, queue_members, total=None, page=1, pages=1):
+    """
+    Формирование текста очереди по имени создателя и участникам страницы.
+
+    Args:
+        queue_members: участники показываемой страницы (позиции - во всей очереди)
+        total: количество участников во всей очереди (по умолчанию - len(queue_members))
+        page, pages: номер страницы и количество страниц
+    """
+    if total is None:
+        total = len(queue_members)
+    if not total:
         return f"Очередь '*{queue_name}*' пуста.\nСоздатель: _{creator_name}_"
     
-    # Ограничиваем количество участников для отображения
-    max_members_to_show = 50
-    total_members = len(queue_members)
-    
-    if total_members > max_members_to_show:
-        queue_members = queue_members[:max_members_to_show]
-    
     # Экранируем специальные символы в именах пользователей
     queue_list = []
     for name, username, order, _ in queue_members:
-        # Экранируем специальные символы в имени
-        safe_name = name.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`').replace('[', '\\[')
-        
         if username:
-            # Экранируем специальные символы в username
-            safe_username = username.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`').replace('[', '\\[')
-            queue_list.append(f"{order}. {safe_name} (@{safe_username})")
+            queue_list.append(f"{order}. {escape_markdown(name)} (@{escape_markdown(username)})")
         else:
-            queue_list.append(f"{order}. {safe_name}")
+            queue_list.append(f"{order}. {escape_markdown(name)}")
     
     # Соединяем список в строку
     queue_list_text = "\n".join(queue_list)
     
-    # Экранируем специальные символы в имени создателя
-    safe_creator_name = creator_name.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`').replace('[', '\\[')
-    
-    result = f"Очередь '*{queue_name}*'\nСоздатель: _{safe_creator_name}_\nКоличество участников: {total_members}"
+    result = f"Очередь '*{queue_name}*'\nСоздатель: _{escape_markdown(creator_name)}_\nКоличество участников: {total}"
     
-    if total_members > max_members_to_show:
-        result += f"\n\nПоказаны первые {max_members_to_show} из {total_members} участников:\n\n{queue_list_text}"
+    if pages > 1:
+        result += f"\n\nСтраница {page} из {pages}:\n\n{queue_list_text}"
     else:
         result += f"\n\n{queue_list_text}"
     
     return result
 
+# Отрисованная страница очереди: текст, версия очереди (None, если очередь не найдена),
+# номер показанной страницы и количество страниц
+RenderedQueue = collections.namedtuple('RenderedQueue', ['text', 'version', 'page', 'pages'])
+
+def page_count(total):
+    """Количество страниц очереди из total участников (не меньше одной)"""
+    return max(1, -(-total // QUEUE_PAGE_SIZE))
+
+def page_of(position):
+    """Страница, на которой показана позиция position (1, если позиции нет)"""
+    return (position - 1) // QUEUE_PAGE_SIZE + 1 if position else 1
+
+def render_queue(queue_name, queue_id, snapshot=None, page=1):
+    """
+    Текст страницы очереди с учетом кэша отрисовки.
+
+    Args:
+        snapshot: уже полученный снимок очереди (например, из результата db.join_by_name);
+            если не передан, из хранилища читается только нужная страница
+        page: номер страницы; номер больше количества страниц заменяется последней страницей
+
+    Returns:
+        RenderedQueue
+    """
+    if snapshot is not None:
+        total = len(snapshot.members)
+        page = min(page, page_count(total))
+        offset = (page - 1) * QUEUE_PAGE_SIZE
+        version, creator_name = snapshot.version, snapshot.creator_name
+        members = snapshot.members[offset:offset + QUEUE_PAGE_SIZE]
+    else:
+        offset = (page - 1) * QUEUE_PAGE_SIZE
+        queue_page = db.get_queue_members_page(queue_id, offset, QUEUE_PAGE_SIZE)
+        if queue_page is not None and page > page_count(queue_page.total):
+            # Очередь сократилась: показываем последнюю страницу
+            page = page_count(queue_page.total)
+            offset = (page - 1) * QUEUE_PAGE_SIZE
+            queue_page = db.get_queue_members_page(queue_id, offset, QUEUE_PAGE_SIZE)
+        if queue_page is None:
+            return RenderedQueue(build_queue_text(queue_name, None, []), None, 1, 1)
+        total = queue_page.total
+        version, creator_name, members = queue_page.version, queue_page.creator_name, queue_page.members
+    
+    pages = page_count(total)
+    key = (queue_id, version, page)
+    text = rendered_queues.get(key)
+    if text is None:
+        text = build_queue_text(queue_name, creator_name, members, total, page, pages)
+        rendered_queues.put(key, text)
+    return RenderedQueue(text, version, page, pages)
+
+# Вспомогательная функция для форматирования вывода очереди
+def format_queue_info(queue_name, queue_id):
+    return render_queue(queue_name, queue_id).text
+
+def operation_queue_state(result):
+    """
+    Версия и количество участников очереди после составной операции (db.exit_by_name и др.).
+
+    Снимок есть в результате только для закэшированной очереди; для остальных
+    читается лишь заголовок страницы, без списка участников.
+
+    Returns:
+        (version, total); (None, 0), если очередь уже удалена
+    """
+    if result.snapshot is not None:
+        return result.snapshot.version, len(result.snapshot.members)
+    header = db.get_queue_members_page(result.queue_id, 0, 0)
+    if header is None:
+        return None, 0
+    return header.version, header.total
+
 # Функция для создания клавиатуры с кнопками для управления очередью
-def create_queue_keyboard(queue_name):
+def create_queue_keyboard(queue_id, version, page=1, pages=1):
+    """
+    Клавиатура управления очередью.
+
+    Данные кнопок содержат ID очереди и показанную в сообщении версию (callback_data.encode):
+    их длина не зависит от названия очереди, а нажатие в устаревшем сообщении распознается.
+    Если в очереди больше одной страницы, добавляются кнопки перехода «◀» и «▶».
+    """
+    version = version or 0
+    key = (queue_id, version, page, pages)
+    keyboard = queue_keyboards.get(key)
+    if keyboard is not None:
+        return keyboard
+    
     keyboard = telebot.types.InlineKeyboardMarkup(row_width=2)
-    join_button = telebot.types.InlineKeyboardButton("Присоединиться", callback_data=f"join_{queue_name}")
-    exit_button = telebot.types.InlineKeyboardButton("Выйти", callback_data=f"exit_{queue_name}")
-    rejoin_button = telebot.types.InlineKeyboardButton("В конец", callback_data=f"rejoin_{queue_name}")
-    skip_button = telebot.types.InlineKeyboardButton("Пропустить", callback_data=f"skip_{queue_name}")
+    join_button = telebot.types.InlineKeyboardButton("Присоединиться", callback_data=callback_data.encode('join', queue_id, version))
+    exit_button = telebot.types.InlineKeyboardButton("Выйти", callback_data=callback_data.encode('exit', queue_id, version))
+    rejoin_button = telebot.types.InlineKeyboardButton("В конец", callback_data=callback_data.encode('rejoin', queue_id, version))
+    skip_button = telebot.types.InlineKeyboardButton("Пропустить", callback_data=callback_data.encode('skip', queue_id, version))
     
     # Размещаем кнопку "Присоединиться" в первом ряду
     keyboard.row(join_button)
@@ -336,10 +541,105 @@ def create_queue_keyboard(queue_name):
     # Размещаем кнопки "Пропустить" и "Выйти" в третьем ряду
     keyboard.row(skip_button, exit_button)
     
+    # Кнопки перехода между страницами в четвертом ряду
+    if pages > 1:
+        page_buttons = []
+        if page > 1:
+            page_buttons.append(telebot.types.InlineKeyboardButton("◀", callback_data=callback_data.encode_page(queue_id, page - 1)))
+        if page < pages:
+            page_buttons.append(telebot.types.InlineKeyboardButton("▶", callback_data=callback_data.encode_page(queue_id, page + 1)))
+        keyboard.row(*page_buttons)
+    
+    queue_keyboards.put(key, keyboard)
     return keyboard
 
+def remember_queue_message(sent, queue_id, version, page=1):
+    """
+    Запоминание версии очереди и страницы, показанных в отправленном сообщении.
+
+    Args:
+        sent: Future, возвращенный safe_reply_to или safe_send_message
+    """
+    def remember(future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        message = future.result()
+        if message is not None and version is not None:
+            key = (message.chat.id, message.message_id)
+            message_versions.put(key, (queue_id, version, page))
+            message_pages.put(key, (queue_id, page))
+
+    sent.add_done_callback(remember)
+
+def shown_page(key, queue_id):
+    """Страница очереди, выбранная для сообщения key (1, если неизвестна)"""
+    selected = message_pages.peek(key)
+    return selected[1] if selected is not None and selected[0] == queue_id else 1
+
+def update_queue_message(chat_id, message_id, queue_name, queue_id, page=None):
+    """
+    Обновление сообщения с очередью.
+
+    Если в сообщении уже показана текущая версия очереди, запрос к Telegram не отправляется.
+
+    Args:
+        page: страница для показа (по умолчанию - страница, выбранная для сообщения)
+
+    Returns:
+        bool: было ли поставлено в очередь изменение сообщения
+    """
+    key = (chat_id, message_id)
+    if page is None:
+        page = shown_page(key, queue_id)
+    rendered = render_queue(queue_name, queue_id, page=page)
+    version = rendered.version
+    message_pages.put(key, (queue_id, rendered.page))
+    shown = (queue_id, version, rendered.page)
+    if version is not None and message_versions.get(key) == shown:
+        return False
+    
+    # Версия запоминается сразу, чтобы повторные нажатия не ставили в очередь то же изменение;
+    # если изменение (или его повтор после ошибки 429) не выполнено, версия забывается
+    if version is not None:
+        message_versions.put(key, shown)
+
+    def forget_shown(error):
+        # Ошибка "message is not modified" означает, что сообщение уже актуально
+        if error is not None and "message is not modified" in str(error):
+            return
+        if message_versions.peek(key) == shown:
+            message_versions.pop(key)
+
+    safe_edit_message_text(
+        chat_id=chat_id,
+        message_id=message_id,
+        text=rendered.text,
+        parse_mode="Markdown",
+        reply_markup=create_queue_keyboard(queue_id, version, rendered.page, rendered.pages),
+        on_error=forget_shown
+    )
+    return True
+
+def schedule_queue_message_update(chat_id, message_id, queue_name, queue_id, page=None):
+    """
+    Отложенное обновление сообщения с очередью.
+
+    Нажатия в пределах окна EDIT_COALESCE_WINDOW объединяются в одно изменение,
+    текст которого строится по состоянию очереди на момент отправки.
+
+    Args:
+        page: новая страница для показа (None - оставить выбранную страницу)
+    """
+    if page is not None:
+        message_pages.put((chat_id, message_id), (queue_id, page))
+    edit_coalescer.schedule(
+        (chat_id, message_id),
+        lambda: update_queue_message(chat_id, message_id, queue_name, queue_id)
+    )
+
 # Обработчик команды /join
 @bot.message_handler(commands=['join'])
+@timed_handler('join')
 @rate_limit_decorator('join')
 def join_queue(message):
     try:
@@ -348,7 +648,7 @@ def join_queue(message):
         
         # Проверяем, указано ли название очереди
         if len(command_parts) < 2:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/join Математика`", parse_mode="Markdown")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/join Математика`", parse_mode="Markdown")
             return
         
         queue_name = command_parts[1].strip()
@@ -359,33 +659,31 @@ def join_queue(message):
         user_name = message.from_user.username or ""
         update_user_info(user_id, user_name, message.from_user.first_name, message.from_user.last_name)
         
-        # Проверяем существование очереди
-        queue_id = db.get_queue_id(queue_name, chat_id)
-        if not queue_id:
-            bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+        # Находим очередь и добавляем в нее пользователя одной транзакцией
+        result = db.join_by_name(chat_id, queue_name, user_id)
+        if result.status == db.QUEUE_NOT_FOUND:
+            safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
             return
-        
-        # Проверяем, не состоит ли пользователь уже в этой очереди
-        if db.check_user_in_queue(queue_id, user_id):
-            bot.reply_to(message, f"Вы уже состоите в очереди '{queue_name}'.")
+        if result.status == db.ALREADY_MEMBER:
+            safe_reply_to(message, f"Вы уже состоите в очереди '{queue_name}'.")
             return
-        
-        # Добавляем пользователя в очередь
-        db.add_user_to_queue(queue_id, user_id)
+        queue_id = result.queue_id
         
         # Формируем сообщение с информацией об очереди
-        queue_info = format_queue_info(queue_name, queue_id)
+        queue_info, version, page, pages = render_queue(queue_name, queue_id, result.snapshot, page_of(result.position))
         
         # Создаем клавиатуру с кнопками
-        keyboard = create_queue_keyboard(queue_name)
+        keyboard = create_queue_keyboard(queue_id, version, page, pages)
         
-        bot.reply_to(message, f"Вы успешно присоединились к очереди '*{queue_name}*'!\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+        sent = safe_reply_to(message, f"Вы успешно присоединились к очереди '*{queue_name}*'!\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+        remember_queue_message(sent, queue_id, version, page)
     
     except Exception as e:
         handle_error(message, e, "присоединении к очереди")
 
 # Обработчик команды /exit
 @bot.message_handler(commands=['exit'])
+@timed_handler('exit')
 @rate_limit_decorator('default')
 def exit_queue(message):
     try:
@@ -394,47 +692,41 @@ def exit_queue(message):
         
         # Проверяем, указано ли название очереди
         if len(command_parts) < 2:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/exit Математика`", parse_mode="Markdown")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/exit Математика`", parse_mode="Markdown")
             return
         
         queue_name = command_parts[1].strip()
         chat_id = message.chat.id
         user_id = message.from_user.id
         
-        # Проверяем существование очереди
-        queue_id = db.get_queue_id(queue_name, chat_id)
-        if not queue_id:
-            bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+        # Находим очередь и удаляем из нее пользователя одной транзакцией
+        result = db.exit_by_name(chat_id, queue_name, user_id)
+        if result.status == db.QUEUE_NOT_FOUND:
+            safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
             return
-        
-        # Проверяем, состоит ли пользователь в этой очереди
-        user_order = db.check_user_in_queue(queue_id, user_id)
-        if not user_order:
-            bot.reply_to(message, f"Вы не состоите в очереди '{queue_name}'.")
+        if result.status == db.NOT_MEMBER:
+            safe_reply_to(message, f"Вы не состоите в очереди '{queue_name}'.")
             return
+        queue_id = result.queue_id
         
-        # Удаляем пользователя из очереди
-        db.remove_user_from_queue(queue_id, user_id, user_order)
-        
-        # Получаем обновленный список участников очереди
-        queue_members = db.get_queue_members(queue_id)
-        
-        if queue_members:
+        if operation_queue_state(result)[1]:
             # Формируем сообщение с информацией об очереди
-            queue_info = format_queue_info(queue_name, queue_id)
+            queue_info, version, page, pages = render_queue(queue_name, queue_id, result.snapshot)
             
             # Создаем клавиатуру с кнопками
-            keyboard = create_queue_keyboard(queue_name)
+            keyboard = create_queue_keyboard(queue_id, version, page, pages)
             
-            bot.reply_to(message, f"Вы успешно вышли из очереди '*{queue_name}*'.\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+            sent = safe_reply_to(message, f"Вы успешно вышли из очереди '*{queue_name}*'.\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+            remember_queue_message(sent, queue_id, version, page)
         else:
-            bot.reply_to(message, f"Вы успешно вышли из очереди '{queue_name}'.\nОчередь теперь пуста.")
+            safe_reply_to(message, f"Вы успешно вышли из очереди '{queue_name}'.\nОчередь теперь пуста.")
     
     except Exception as e:
         handle_error(message, e, "выходе из очереди")
 
 # Обработчик команды /rejoin
 @bot.message_handler(commands=['rejoin'])
+@timed_handler('rejoin')
 @rate_limit_decorator('default')
 def rejoin_queue(message):
     try:
@@ -443,41 +735,38 @@ def rejoin_queue(message):
         
         # Проверяем, указано ли название очереди
         if len(command_parts) < 2:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/rejoin Математика`", parse_mode="Markdown")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/rejoin Математика`", parse_mode="Markdown")
             return
         
         queue_name = command_parts[1].strip()
         chat_id = message.chat.id
         user_id = message.from_user.id
         
-        # Проверяем существование очереди
-        queue_id = db.get_queue_id(queue_name, chat_id)
-        if not queue_id:
-            bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+        # Находим очередь и перемещаем пользователя в ее конец одной транзакцией
+        result = db.rejoin_by_name(chat_id, queue_name, user_id)
+        if result.status == db.QUEUE_NOT_FOUND:
+            safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
             return
-        
-        # Проверяем, состоит ли пользователь в этой очереди
-        user_order = db.check_user_in_queue(queue_id, user_id)
-        if not user_order:
-            bot.reply_to(message, f"Вы не состоите в очереди '*{queue_name}*'. Используйте `/join {queue_name}` чтобы присоединиться.", parse_mode="Markdown")
+        if result.status == db.NOT_MEMBER:
+            safe_reply_to(message, f"Вы не состоите в очереди '*{queue_name}*'. Используйте `/join {queue_name}` чтобы присоединиться.", parse_mode="Markdown")
             return
-        
-        # Используем функцию rejoin_queue из базы данных вместо ручного удаления и добавления
-        db.rejoin_queue(queue_id, user_id)
+        queue_id = result.queue_id
         
         # Формируем сообщение с информацией об очереди
-        queue_info = format_queue_info(queue_name, queue_id)
+        queue_info, version, page, pages = render_queue(queue_name, queue_id, result.snapshot, page_of(result.position))
         
         # Создаем клавиатуру с кнопками
-        keyboard = create_queue_keyboard(queue_name)
+        keyboard = create_queue_keyboard(queue_id, version, page, pages)
         
-        bot.reply_to(message, f"Вы успешно переместились в конец очереди '*{queue_name}*'.\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+        sent = safe_reply_to(message, f"Вы успешно переместились в конец очереди '*{queue_name}*'.\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+        remember_queue_message(sent, queue_id, version, page)
     
     except Exception as e:
         handle_error(message, e, "перемещении в конец очереди")
 
 # Обработчик команды /delete
 @bot.message_handler(commands=['delete'])
+@timed_handler('delete')
 @rate_limit_decorator('default')
 def delete_queue(message):
     try:
@@ -486,7 +775,7 @@ def delete_queue(message):
         
         # Проверяем, указано ли название очереди
         if len(command_parts) < 2:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/delete Математика`", parse_mode="Markdown")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/delete Математика`", parse_mode="Markdown")
             return
         
         queue_name = command_parts[1].strip()
@@ -494,15 +783,14 @@ def delete_queue(message):
         user_id = message.from_user.id
         
         # Проверяем, является ли пользователь администратором или создателем чата
-        chat_member = bot.get_chat_member(chat_id, user_id)
-        if chat_member.status not in ['administrator', 'creator']:
-            bot.reply_to(message, "Только администраторы могут удалять очереди.")
+        if not is_chat_admin(chat_id, user_id):
+            safe_reply_to(message, "Только администраторы могут удалять очереди.")
             return
         
         # Проверяем существование очереди
         queue_id = db.get_queue_id(queue_name, chat_id)
         if not queue_id:
-            bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+            safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
             return
         
         # Получаем количество участников в очереди для информационного сообщения
@@ -511,13 +799,14 @@ def delete_queue(message):
         # Удаляем очередь
         db.delete_queue(queue_id)
         
-        bot.reply_to(message, f"Очередь '{queue_name}' успешно удалена. Было удалено {members_count} участников.")
+        safe_reply_to(message, f"Очередь '{queue_name}' успешно удалена. Было удалено {members_count} участников.")
     
     except Exception as e:
         handle_error(message, e, "удалении очереди")
 
 # Обработчик команды /view
 @bot.message_handler(commands=['view'])
+@timed_handler('view')
 @rate_limit_decorator('default')
 def view_queue(message):
     try:
@@ -531,13 +820,13 @@ def view_queue(message):
             queues = db.get_all_queues(chat_id)
             
             if not queues:
-                bot.reply_to(message, "В этом чате пока нет очередей. Создайте новую с помощью команды `/create`.", parse_mode="Markdown")
+                safe_reply_to(message, "В этом чате пока нет очередей. Создайте новую с помощью команды `/create`.", parse_mode="Markdown")
                 return
             
             # Формируем сообщение со списком очередей
             queues_list = "\n".join([f"📋 {name} - {count} участник(ов)" for name, count in queues])
             
-            bot.reply_to(message, f"Список очередей в этом чате:\n\n{queues_list}\n\nДля просмотра конкретной очереди используйте `/view [название очереди]`", parse_mode="Markdown")
+            safe_reply_to(message, f"Список очередей в этом чате:\n\n{queues_list}\n\nДля просмотра конкретной очереди используйте `/view [название очереди]`", parse_mode="Markdown")
         
         # Если указано название очереди, выводим информацию о ней
         else:
@@ -546,22 +835,24 @@ def view_queue(message):
             # Проверяем существование очереди
             queue_id = db.get_queue_id(queue_name, chat_id)
             if not queue_id:
-                bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+                safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
                 return
             
             # Формируем сообщение с информацией об очереди
-            queue_info = format_queue_info(queue_name, queue_id)
+            queue_info, version, page, pages = render_queue(queue_name, queue_id)
             
             # Создаем клавиатуру с кнопками
-            keyboard = create_queue_keyboard(queue_name)
+            keyboard = create_queue_keyboard(queue_id, version, page, pages)
             
-            bot.reply_to(message, queue_info, parse_mode="Markdown", reply_markup=keyboard)
+            sent = safe_reply_to(message, queue_info, parse_mode="Markdown", reply_markup=keyboard)
+            remember_queue_message(sent, queue_id, version, page)
     
     except Exception as e:
         handle_error(message, e, "просмотре очереди")
 
 # Обработчик команды /setname
 @bot.message_handler(commands=['setname'])
+@timed_handler('setname')
 @rate_limit_decorator('default')
 def set_custom_name(message):
     try:
@@ -578,72 +869,36 @@ def set_custom_name(message):
                 telegram_name += " " + message.from_user.last_name
             
             # Обновляем имя пользователя в базе данных
-            db.update_display_name(user_id, telegram_name)
+            update_user_display_name(user_id, telegram_name)
             
-            bot.reply_to(message, f"Ваше имя сброшено на стандартное из Telegram: '{telegram_name}'!")
+            safe_reply_to(message, f"Ваше имя сброшено на стандартное из Telegram: '{telegram_name}'!")
             return
         
         new_name = command_parts[1].strip()
         user_id = message.from_user.id
         
         # Обновляем имя пользователя в базе данных
-        db.update_display_name(user_id, new_name)
+        update_user_display_name(user_id, new_name)
         
-        bot.reply_to(message, f"Ваше имя успешно изменено на '{new_name}'!")
+        safe_reply_to(message, f"Ваше имя успешно изменено на '{new_name}'!")
     
     except Exception as e:
         handle_error(message, e, "изменении имени")
 
-# Вспомогательная функция для форматирования вывода очереди
-def format_queue_info(queue_name, queue_id):
-    # Получаем информацию о создателе очереди
-    creator_name = db.get_queue_creator(queue_id)
-    
-    # Получаем список участников очереди
-    queue_members = db.get_queue_members(queue_id)
-    
-    if not queue_members:
-        return f"Очередь '*{queue_name}*' пуста.\nСоздатель: _{creator_name}_"
-    
-    # Ограничиваем количество участников для отображения
-    max_members_to_show = 50
-    total_members = len(queue_members)
-    
-    if total_members > max_members_to_show:
-        queue_members = queue_members[:max_members_to_show]
-    
-    # Экранируем специальные символы в именах пользователей
-    queue_list = []
-    for name, username, order, _ in queue_members:
-        # Экранируем специальные символы в имени
-        safe_name = name.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`').replace('[', '\\[')
-        
-        if username:
-            # Экранируем специальные символы в username
-            safe_username = username.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`').replace('[', '\\[')
-            queue_list.append(f"{order}. {safe_name} (@{safe_username})")
-        else:
-            queue_list.append(f"{order}. {safe_name}")
-    
-    # Соединяем список в строку
-    queue_list_text = "\n".join(queue_list)
-    
-    # Экранируем специальные символы в имени создателя
-    safe_creator_name = creator_name.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`').replace('[', '\\[')
-    
-    result = f"Очередь '*{queue_name}*'\nСоздатель: _{safe_creator_name}_\nКоличество участников: {total_members}"
-    
-    if total_members > max_members_to_show:
-        result += f"\n\nПоказаны первые {max_members_to_show} из {total_members} участников:\n\n{queue_list_text}"
-    else:
-        result += f"\n\n{queue_list_text}"
-    
-    return result
+# Последние известные данные пользователей: user_id -> (username, display_name).
+# Позволяют не читать базу данных при каждом нажатии кнопки и писать в нее только при изменениях.
+user_profiles = LRUCache(USER_PROFILE_CACHE_SIZE)
 
 # Вспомогательная функция для обновления информации о пользователе
 def update_user_info(user_id, username, first_name, last_name):
-    # Получаем текущую информацию о пользователе
-    current_username, display_name = db.get_user_info(user_id)
+    # Telegram не передает username, если он не задан; в базе храним пустую строку
+    username = username or ""
+
+    # Получаем текущую информацию о пользователе (из кэша или из базы данных)
+    profile = user_profiles.get(user_id)
+    if profile is None:
+        profile = db.get_user_info(user_id)
+    current_username, display_name = profile
     
     # Если пользователь уже существует в базе, не обновляем его имя
     if display_name:
@@ -657,6 +912,15 @@ def update_user_info(user_id, username, first_name, last_name):
             display_name += " " + last_name
         db.add_or_update_user(user_id, username, display_name)
 
+    user_profiles.put(user_id, (username, display_name))
+
+def update_user_display_name(user_id, display_name):
+    """Изменение отображаемого имени пользователя в базе данных и в кэше user_profiles"""
+    db.update_display_name(user_id, display_name)
+    profile = user_profiles.peek(user_id)
+    if profile is not None:
+        user_profiles.put(user_id, (profile[0], display_name))
+
 # Функция для остановки бота
 def stop_bot():
     global bot_running
@@ -664,13 +928,24 @@ def stop_bot():
     bot_running = False
     # Останавливаем поллинг бота
     bot.stop_polling()
+    if webhook_server is not None:
+        webhook_server.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+    # Отложенные изменения сообщений больше не отправляются
+    edit_coalescer.stop()
+    # Дожидаемся обработки уже полученных обновлений
+    update_dispatcher.stop()
+    # Отправляем уже поставленные в очередь запросы и останавливаем повторную отправку
+    outbound_governor.stop()
+    retry_scheduler.stop()
     logger.info("Bot stopped")
     logger.info("=======================================")
 
 # Функция для чтения команд из консоли
 def console_listener():
     global bot_running
-    logger.info("Console interface started. Available commands: stop, exit, quit, status")
+    logger.info("Console interface started. Available commands: stop, exit, quit, status, cache, counts, updates, edits, retries, outbound, metrics")
     
     # Проверяем, запущен ли бот через systemd
     is_systemd = os.environ.get('INVOCATION_ID') is not None or os.environ.get('JOURNAL_STREAM') is not None
@@ -694,10 +969,63 @@ def console_listener():
             elif command == 'status':
                 logger.info(f"Bot status: {'running' if bot_running else 'stopped'}")
                 print(f"Bot status: {'running' if bot_running else 'stopped'}")
+            elif command == 'cache':
+                admin_stats = admin_cache.stats()
+                for cache_name, stats in [('Queue cache', db.get_cache_stats()),
+                                          ('Rendered queues', rendered_queues.stats()),
+                                          ('Message versions', message_versions.stats()),
+                                          ('User profiles', user_profiles.stats()),
+                                          ('Chat admins', admin_stats)]:
+                    lookups = stats['hits'] + stats['misses']
+                    hit_rate = stats['hits'] / lookups * 100 if lookups else 0
+                    print(f"{cache_name}: {stats['size']}/{stats['maxsize']} entries, "
+                          f"hits={stats['hits']}, misses={stats['misses']} ({hit_rate:.1f}% hit rate), "
+                          f"evictions={stats['evictions']}")
+                print(f"Chat admins: ttl={admin_stats['ttl']}s, oldest entry age={admin_stats['oldest_age']:.0f}s, "
+                      f"refreshes={admin_stats['refreshes']}, invalidations={admin_stats['invalidations']}")
+            elif command in ['counts', 'counts repair']:
+                drift = db.check_member_counts(repair=command == 'counts repair')
+                for queue_id, stored, actual in drift:
+                    print(f"Queue {queue_id}: stored member count {stored}, actual {actual}")
+                if not drift:
+                    print("Queue member counts are consistent")
+                elif command == 'counts repair':
+                    print(f"Repaired member counts of {len(drift)} queues")
+                else:
+                    print("Type 'counts repair' to fix them")
+            elif command == 'updates':
+                stats = update_dispatcher.stats()
+                print(f"Updates: submitted={stats['submitted']}, processed={stats['processed']}, "
+                      f"failed={stats['failed']}, active chats={stats['lanes']}, queued={stats['queued']}, "
+                      f"max chat queue={stats['max_depth']}")
+            elif command == 'edits':
+                stats = edit_coalescer.stats()
+                print(f"Message edits: requested={stats['requested']}, sent={stats['sent']}, "
+                      f"saved={stats['saved']}, pending={stats['pending']}")
+            elif command == 'retries':
+                stats = retry_scheduler.stats()
+                print(f"Rate-limited requests: depth={stats['depth']}, scheduled={stats['scheduled']}, "
+                      f"retried={stats['retried']}, dropped={stats['dropped']}, "
+                      f"blocked chats={stats['blocked_chats']}")
+            elif command == 'outbound':
+                stats = outbound_governor.stats()
+                print(f"Outbound requests: submitted={stats['submitted']}, sent={stats['sent']}, "
+                      f"replaced={stats['replaced']}, in flight={stats['inflight']}")
+                print(f"Queued: callbacks={stats['callbacks']}, edits={stats['edits']}, messages={stats['messages']}")
+            elif command == 'metrics':
+                lines = metrics.summary()
+                print("\n".join(lines) if lines else "No metrics recorded yet")
             elif command == 'help':
                 print("Available commands:")
                 print("  stop, exit, quit - stop the bot")
                 print("  status - check bot status")
+                print("  cache - show cache statistics")
+                print("  counts [repair] - check (and repair) stored queue member counts")
+                print("  updates - show per-chat update queue statistics")
+                print("  edits - show coalesced message edit statistics")
+                print("  retries - show rate-limit retry queue statistics")
+                print("  outbound - show outbound request queue statistics")
+                print("  metrics - show handler, database and API latency metrics")
                 print("  help - show this help message")
             else:
                 print(f"Unknown command: {command}")
@@ -711,21 +1039,149 @@ def console_listener():
     
     logger.info("Console interface stopped")
 
+# Обработчик изменений статуса участников чата (приходит, если бот - администратор группы)
+@bot.chat_member_handler()
+@timed_handler('chat_member')
+def handle_chat_member_update(update):
+    was_admin = update.old_chat_member.status in ADMIN_STATUSES
+    is_admin = update.new_chat_member.status in ADMIN_STATUSES
+    if was_admin != is_admin:
+        admin_cache.invalidate(update.chat.id)
+
+# Действие инлайн-кнопки с очередью:
+# rate_limit - тип ограничения частоты (ключ RATE_LIMITS),
+# operation - составная операция хранилища (<operation>_by_id и <operation>_by_name);
+#     None - действие не изменяет очередь (переход между страницами),
+# refusals - ответы при невыполненных условиях действия (статус операции -> текст),
+# done - ответ при успешном выполнении
+CallbackAction = collections.namedtuple('CallbackAction', ['rate_limit', 'operation', 'refusals', 'done'])
+
+# Реестр действий по названию из callback_data.ACTIONS (и перехода между страницами).
+# Новое действие добавляется в callback_data.ACTIONS и сюда, обработка нажатия для всех действий общая
+CALLBACK_ACTIONS = {
+    'join': CallbackAction(
+        rate_limit='join',
+        operation='join',
+        refusals={db.ALREADY_MEMBER: "Вы уже состоите в очереди '{queue_name}'."},
+        done="Вы присоединились к очереди '{queue_name}'.",
+    ),
+    'exit': CallbackAction(
+        rate_limit='default',
+        operation='exit',
+        refusals={db.NOT_MEMBER: "Вы не состоите в очереди '{queue_name}'."},
+        done="Вы вышли из очереди '{queue_name}'.",
+    ),
+    'rejoin': CallbackAction(
+        rate_limit='default',
+        operation='rejoin',
+        refusals={db.NOT_MEMBER: "Вы не состоите в очереди '{queue_name}'."},
+        done="Вы переместились в конец очереди '{queue_name}'.",
+    ),
+    'skip': CallbackAction(
+        rate_limit='default',
+        operation='skip',
+        refusals={
+            db.NOT_MEMBER: "Вы не состоите в очереди '{queue_name}'.",
+            db.LAST_IN_QUEUE: "Вы уже находитесь в конце очереди '{queue_name}'.",
+        },
+        done="Вы пропустили одного человека вперед в очереди '{queue_name}'.",
+    ),
+    callback_data.PAGE_ACTION: CallbackAction(
+        rate_limit='page',
+        operation=None,
+        refusals={},
+        done="Страница {page}",
+    ),
+}
+
+# Результат обработки нажатия: текст ответа и, если сообщение нужно обновить,
+# название и ID очереди и страница для показа (None - уже показанная в сообщении)
+CallbackOutcome = collections.namedtuple('CallbackOutcome', ['answer', 'refresh', 'queue_name', 'queue_id', 'page'],
+                                         defaults=(None,))
+
+def decode_callback(call):
+    """
+    Данные нажатой кнопки и ее действие из реестра.
+
+    Returns:
+        tuple: (CallbackData, CallbackAction) или (None, None) для неизвестных кнопок
+    """
+    callback = callback_data.decode(call.data)
+    action = CALLBACK_ACTIONS.get(callback.action) if callback is not None else None
+    return (callback, action) if action is not None else (None, None)
+
+def callback_handler_label(call):
+    """Название обработчика нажатия кнопки для метрик: callback_<действие>"""
+    callback, _ = decode_callback(call)
+    return f"callback_{callback.action if callback is not None else 'other'}"
+
+# Ответ на нажатие кнопки, действие которой неизвестно (например, кнопка устаревшего формата)
+UNKNOWN_CALLBACK_ANSWER = "Эта кнопка больше не поддерживается."
+
+def callback_rate_limit(action):
+    """Тип ограничения частоты для нажатия (неизвестные кнопки ограничиваются как 'default')"""
+    return action.rate_limit if action is not None else 'default'
+
+def run_callback_operation(chat_id, callback, action, user_id):
+    """
+    Составная операция для нажатой кнопки.
+
+    Кнопки компактного формата содержат ID очереди, и очередь не ищется по названию;
+    кнопки прежнего формата ('join_Название') обрабатываются по названию очереди.
+
+    Returns:
+        QueueOperation
+    """
+    if callback.queue_id is not None:
+        return getattr(db, f"{action.operation}_by_id")(chat_id, callback.queue_id, user_id)
+    return getattr(db, f"{action.operation}_by_name")(chat_id, callback.queue_name, user_id)
+
+def callback_queue_not_found_text(callback):
+    """Ответ на нажатие кнопки очереди, которой больше нет"""
+    if callback.queue_name is None:
+        return "Очередь не найдена: возможно, она была удалена."
+    return f"Очередь '{callback.queue_name}' не найдена."
+
+def execute_callback(chat_id, user_id, callback, action):
+    """
+    Общая для синхронной и асинхронной сред часть обработки нажатия: операция
+    с очередью одной транзакцией и выбор ответа. Ответ на нажатие и изменение
+    сообщения отправляет вызывающий.
+
+    Сообщение обновляется после изменения очереди, а также если кнопка нажата
+    в сообщении с устаревшей версией очереди (версия записана в данных кнопки).
+
+    Returns:
+        CallbackOutcome
+    """
+    if action.operation is None:
+        # Переход между страницами: проверяется только, что очередь есть в этом чате
+        queue_page = db.get_queue_members_page(callback.queue_id, 0, 0)
+        if queue_page is None or queue_page.chat_id != chat_id:
+            return CallbackOutcome(callback_queue_not_found_text(callback), False, None, None)
+        return CallbackOutcome(action.done.format(page=callback.page), True,
+                               queue_page.queue_name, callback.queue_id, callback.page)
+    
+    result = run_callback_operation(chat_id, callback, action, user_id)
+    if result.status == db.QUEUE_NOT_FOUND:
+        return CallbackOutcome(callback_queue_not_found_text(callback), False, None, None)
+    
+    answer = action.done if result.status == db.DONE else action.refusals[result.status]
+    refresh = result.status == db.DONE or callback_data.is_stale(callback, operation_queue_state(result)[0])
+    return CallbackOutcome(answer.format(queue_name=result.queue_name), refresh, result.queue_name, result.queue_id)
+
 # Обработчик нажатий на инлайн-кнопки
 @bot.callback_query_handler(func=lambda call: True)
+@timed_handler(callback_handler_label)
 def handle_callback_query(call):
     try:
         # Получаем данные из callback
-        data = call.data
+        callback, action = decode_callback(call)
         chat_id = call.message.chat.id
         user_id = call.from_user.id
         
-        # Проверяем ограничение для callback-запросов
-        # Для присоединения к очереди используем специальный тип ограничения
-        if data.startswith('join_'):
-            is_limited, wait_time = check_rate_limit(user_id, 'join')
-        else:
-            is_limited, wait_time = check_rate_limit(user_id, 'default')
+        # Проверяем ограничение для callback-запросов по типу, указанному в действии
+        is_limited, wait_time = check_rate_limit(user_id, callback_rate_limit(action))
         
         if is_limited:
             logger.warning(f"Rate limit exceeded for user {user_id} in callback query")
@@ -735,168 +1191,20 @@ def handle_callback_query(call):
                 logger.error(f"Failed to send rate limit message via callback: {str(e)}")
             return
         
+        if action is None:
+            safe_answer_callback_query(call.id, UNKNOWN_CALLBACK_ANSWER)
+            return
+        
         # Обновляем информацию о пользователе
         update_user_info(user_id, call.from_user.username, call.from_user.first_name, call.from_user.last_name)
         
-        # Обрабатываем callback для присоединения к очереди
-        if data.startswith('join_'):
-            queue_name = data[5:]  # Получаем название очереди
-            
-            # Получаем ID очереди
-            queue_id = db.get_queue_id(queue_name, chat_id)
-            if not queue_id:
-                safe_answer_callback_query(call.id, f"Очередь '{queue_name}' не найдена.")
-                return
-            
-            # Проверяем, состоит ли пользователь в очереди
-            if db.check_user_in_queue(queue_id, user_id):
-                safe_answer_callback_query(call.id, f"Вы уже состоите в очереди '{queue_name}'.")
-                return
-            
-            # Добавляем пользователя в очередь
-            db.add_user_to_queue(queue_id, user_id)
-            safe_answer_callback_query(call.id, f"Вы присоединились к очереди '{queue_name}'.")
-            
-            # Обновляем сообщение с очередью
-            queue_info = format_queue_info(queue_name, queue_id)
-            keyboard = create_queue_keyboard(queue_name)
-            
-            try:
-                safe_edit_message_text(
-                    chat_id=chat_id,
-                    message_id=call.message.message_id,
-                    text=queue_info,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-            except telebot.apihelper.ApiTelegramException as api_error:
-                # Игнорируем ошибку "message is not modified"
-                if "message is not modified" in str(api_error):
-                    pass
-                else:
-                    logger.error(f"Error updating message: {str(api_error)}")
-        
-        # Обрабатываем callback для выхода из очереди
-        elif data.startswith('exit_'):
-            queue_name = data[5:]  # Получаем название очереди
-            
-            # Получаем ID очереди
-            queue_id = db.get_queue_id(queue_name, chat_id)
-            if not queue_id:
-                safe_answer_callback_query(call.id, f"Очередь '{queue_name}' не найдена.")
-                return
-            
-            # Проверяем, состоит ли пользователь в очереди
-            user_order = db.check_user_in_queue(queue_id, user_id)
-            if not user_order:
-                safe_answer_callback_query(call.id, f"Вы не состоите в очереди '{queue_name}'.")
-                return
-            
-            # Удаляем пользователя из очереди
-            db.remove_user_from_queue(queue_id, user_id, user_order)
-            safe_answer_callback_query(call.id, f"Вы вышли из очереди '{queue_name}'.")
-            
-            # Обновляем сообщение с очередью
-            queue_info = format_queue_info(queue_name, queue_id)
-            keyboard = create_queue_keyboard(queue_name)
-            
-            try:
-                safe_edit_message_text(
-                    chat_id=chat_id,
-                    message_id=call.message.message_id,
-                    text=queue_info,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-            except telebot.apihelper.ApiTelegramException as api_error:
-                # Игнорируем ошибку "message is not modified"
-                if "message is not modified" in str(api_error):
-                    pass
-                else:
-                    logger.error(f"Error updating message: {str(api_error)}")
-        
-        # Обрабатываем callback для перемещения в конец очереди
-        elif data.startswith('rejoin_'):
-            queue_name = data[7:]  # Получаем название очереди
-            
-            # Получаем ID очереди
-            queue_id = db.get_queue_id(queue_name, chat_id)
-            if not queue_id:
-                safe_answer_callback_query(call.id, f"Очередь '{queue_name}' не найдена.")
-                return
-            
-            # Проверяем, состоит ли пользователь в очереди
-            user_order = db.check_user_in_queue(queue_id, user_id)
-            if not user_order:
-                safe_answer_callback_query(call.id, f"Вы не состоите в очереди '{queue_name}'.")
-                return
-            
-            # Перемещаем пользователя в конец очереди
-            new_position = db.rejoin_queue(queue_id, user_id)
-            safe_answer_callback_query(call.id, f"Вы переместились в конец очереди '{queue_name}'.")
-            
-            # Обновляем сообщение с очередью
-            queue_info = format_queue_info(queue_name, queue_id)
-            keyboard = create_queue_keyboard(queue_name)
-            
-            try:
-                safe_edit_message_text(
-                    chat_id=chat_id,
-                    message_id=call.message.message_id,
-                    text=queue_info,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-            except telebot.apihelper.ApiTelegramException as api_error:
-                # Игнорируем ошибку "message is not modified"
-                if "message is not modified" in str(api_error):
-                    pass
-                else:
-                    logger.error(f"Error updating message: {str(api_error)}")
+        outcome = execute_callback(chat_id, user_id, callback, action)
+        safe_answer_callback_query(call.id, outcome.answer)
         
-        # Обрабатываем callback для пропуска позиции в очереди
-        elif data.startswith('skip_'):
-            queue_name = data[5:]  # Получаем название очереди
-            
-            # Получаем ID очереди
-            queue_id = db.get_queue_id(queue_name, chat_id)
-            if not queue_id:
-                safe_answer_callback_query(call.id, f"Очередь '{queue_name}' не найдена.")
-                return
-            
-            # Проверяем, состоит ли пользователь в очереди
-            user_order = db.check_user_in_queue(queue_id, user_id)
-            if not user_order:
-                safe_answer_callback_query(call.id, f"Вы не состоите в очереди '{queue_name}'.")
-                return
-            
-            # Перемещаем пользователя на одну позицию назад
-            success = db.skip_position_in_queue(queue_id, user_id)
-            
-            if not success:
-                safe_answer_callback_query(call.id, f"Вы уже находитесь в конце очереди '{queue_name}'.")
-                return
-            
-            safe_answer_callback_query(call.id, f"Вы пропустили одного человека вперед в очереди '{queue_name}'.")
-            
-            # Обновляем сообщение с очередью
-            queue_info = format_queue_info(queue_name, queue_id)
-            keyboard = create_queue_keyboard(queue_name)
-            
-            try:
-                safe_edit_message_text(
-                    chat_id=chat_id,
-                    message_id=call.message.message_id,
-                    text=queue_info,
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
-            except telebot.apihelper.ApiTelegramException as api_error:
-                # Игнорируем ошибку "message is not modified"
-                if "message is not modified" in str(api_error):
-                    pass
-                else:
-                    logger.error(f"Error updating message: {str(api_error)}")
+        # Обновляем сообщение с очередью
+        if outcome.refresh:
+            schedule_queue_message_update(chat_id, call.message.message_id, outcome.queue_name,
+                                          outcome.queue_id, outcome.page)
     
     except Exception as e:
         # Сокращаем текст ошибки, чтобы избежать MESSAGE_TOO_LONG
@@ -909,46 +1217,36 @@ def handle_callback_query(call):
         except Exception as callback_error:
             logger.error(f"Error answering callback query about error: {str(callback_error)}")
 
-# Функция для периодической очистки словарей использования команд
-def cleanup_command_usage():
-    """
-    Периодически очищает словари использования команд от устаревших записей.
-    """
-    while bot_running:
-        try:
-            current_time = time.time()
-            
-            # Очищаем словарь обычных команд
-            for user_id in list(command_usage.keys()):
-                while command_usage[user_id] and current_time - command_usage[user_id][0] > RATE_LIMITS['default']['period']:
-                    command_usage[user_id].popleft()
-                if not command_usage[user_id]:
-                    del command_usage[user_id]
-            
-            # Очищаем словарь присоединений к очереди
-            for user_id in list(join_queue_usage.keys()):
-                while join_queue_usage[user_id] and current_time - join_queue_usage[user_id][0] > RATE_LIMITS['join']['period']:
-                    join_queue_usage[user_id].popleft()
-                if not join_queue_usage[user_id]:
-                    del join_queue_usage[user_id]
-            
-            # Очищаем словарь групповых чатов
-            for chat_id in list(chat_command_usage.keys()):
-                while chat_command_usage[chat_id] and current_time - chat_command_usage[chat_id][0] > RATE_LIMITS['chat']['period']:
-                    chat_command_usage[chat_id].popleft()
-                if not chat_command_usage[chat_id]:
-                    del chat_command_usage[chat_id]
-            
-            # Логируем статистику использования
-            logger.debug(f"Command usage stats: users={len(command_usage)}, joins={len(join_queue_usage)}, chats={len(chat_command_usage)}")
-            
-        except Exception as e:
-            logger.error(f"Error in cleanup_command_usage: {str(e)}")
-        
-        # Запускаем очистку каждые 5 минут
-        time.sleep(300)
-
 # Функция для запуска бота
+def process_update_json(update_json):
+    """Передача обновления, полученного вебхуком, зарегистрированным обработчикам"""
+    update = telebot.types.Update.de_json(update_json)
+    bot.process_new_updates([update])
+
+def set_webhook():
+    """Установка вебхука в Telegram, если задан публичный адрес WEBHOOK_URL"""
+    webhook.set_webhook(bot, ALLOWED_UPDATES)
+
+def run_webhook():
+    """Получение обновлений через встроенный HTTP-сервер до остановки бота"""
+    global webhook_server
+    webhook_server = create_webhook_server(process_update_json)
+    set_webhook()
+    webhook_server.serve_forever()
+
+def start_metrics_server(port=METRICS_PORT):
+    """Запуск HTTP-сервера метрик, если он включен (port не равен 0)"""
+    global metrics_server
+    if not port:
+        return None
+    try:
+        metrics_server = metrics.MetricsServer(METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"Failed to start metrics server on {METRICS_HOST}:{port}: {str(e)}")
+        return None
+    metrics_server.start()
+    return metrics_server
+
 def start_bot():
     global bot_running
     bot_running = True
@@ -970,14 +1268,16 @@ def start_bot():
     else:
         logger.info("Running under systemd, console interface disabled")
     
-    # Запускаем поток для очистки словарей использования команд
-    cleanup_thread = threading.Thread(target=cleanup_command_usage, daemon=True)
-    cleanup_thread.start()
-    logger.info("Command usage cleanup thread started")
+    start_metrics_server()
     
     try:
-        # Запускаем бота с увеличенным интервалом между запросами
-        bot.polling(none_stop=True, interval=3, timeout=30)
+        if BOT_MODE == 'webhook':
+            run_webhook()
+        else:
+            # Вебхук и getUpdates несовместимы: удаляем вебхук, оставшийся от запуска в режиме webhook
+            bot.remove_webhook()
+            # Запускаем бота с увеличенным интервалом между запросами
+            bot.polling(none_stop=True, interval=3, timeout=30, allowed_updates=ALLOWED_UPDATES)
     except Exception as e:
         logger.error(f"Error during bot operation: {str(e)}", exc_info=True)
     finally:
@@ -986,8 +1286,43 @@ def start_bot():
     
     return bot
 
+def find_queue_member(queue_members, user_identifier):
+    """
+    Поиск участника очереди по имени или username (с @ или без, без учета регистра).
+
+    Returns:
+        (display_name, username, позиция, user_id) или None
+    """
+    identifier = user_identifier.strip().lower()
+    for member in queue_members:
+        name, username, _, _ = member
+        if username and identifier in (username.lower(), f"@{username}".lower()):
+            return member
+        if name and name.lower() == identifier:
+            return member
+    return None
+
+def admin_queue_id(message, queue_name, denied_text):
+    """
+    Проверка прав администратора и поиск очереди для команд администратора.
+
+    Args:
+        denied_text: ответ пользователю, не являющемуся администратором
+
+    Returns:
+        ID очереди или None (ответ пользователю уже отправлен)
+    """
+    if not is_chat_admin(message.chat.id, message.from_user.id):
+        safe_reply_to(message, denied_text)
+        return None
+    queue_id = db.get_queue_id(queue_name, message.chat.id)
+    if not queue_id:
+        safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+    return queue_id
+
 # Обработчик команды /remove - удаление пользователя из очереди администратором
 @bot.message_handler(commands=['remove'])
+@timed_handler('remove')
 @rate_limit_decorator('default')
 def remove_user_admin(message):
     try:
@@ -996,7 +1331,7 @@ def remove_user_admin(message):
         
         # Проверяем, указаны ли все необходимые параметры
         if len(command_parts) < 3:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди и имя пользователя или @username. Пример: `/remove Математика @username` или `/remove Математика Иван`", parse_mode="Markdown")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди и имя пользователя или @username. Пример: `/remove Математика @username` или `/remove Математика Иван`", parse_mode="Markdown")
             return
         
         queue_name = command_parts[1].strip()
@@ -1005,58 +1340,36 @@ def remove_user_admin(message):
         admin_id = message.from_user.id
         
         # Проверяем, является ли пользователь администратором или создателем чата
-        chat_member = bot.get_chat_member(chat_id, admin_id)
-        if chat_member.status not in ['administrator', 'creator']:
-            bot.reply_to(message, "Только администраторы могут удалять пользователей из очереди.")
+        if not is_chat_admin(chat_id, admin_id):
+            safe_reply_to(message, "Только администраторы могут удалять пользователей из очереди.")
             return
         
         # Проверяем существование очереди
         queue_id = db.get_queue_id(queue_name, chat_id)
         if not queue_id:
-            bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+            safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
             return
         
         # Получаем список участников очереди
         queue_members = db.get_queue_members(queue_id)
         if not queue_members:
-            bot.reply_to(message, f"Очередь '{queue_name}' пуста.")
+            safe_reply_to(message, f"Очередь '{queue_name}' пуста.")
             return
         
         # Ищем пользователя по идентификатору (имя или @username)
-        user_found = False
-        user_id = None
-        user_order = None
-        user_name = None
-        
-        for name, username, order, uid in queue_members:
-            # Проверяем совпадение по username (если указан с @ или без)
-            if username and (user_identifier.lower() == username.lower() or 
-                            user_identifier.lower() == f"@{username}".lower()):
-                user_found = True
-                user_id = uid
-                user_order = order
-                user_name = name
-                break
-            
-            # Проверяем совпадение по имени
-            if name.lower() == user_identifier.lower():
-                user_found = True
-                user_id = uid
-                user_order = order
-                user_name = name
-                break
-        
-        if not user_found:
-            bot.reply_to(message, f"Пользователь '{user_identifier}' не найден в очереди '{queue_name}'.")
+        member = find_queue_member(queue_members, user_identifier)
+        if member is None:
+            safe_reply_to(message, f"Пользователь '{user_identifier}' не найден в очереди '{queue_name}'.")
             return
+        user_name, _, _, user_id = member
         
         # Удаляем пользователя из очереди
-        db.remove_user_from_queue(queue_id, user_id, user_order)
+        db.remove_user_from_queue(queue_id, user_id)
         
         # Формируем сообщение с обновленной информацией об очереди
         queue_info = format_queue_info(queue_name, queue_id)
         
-        bot.reply_to(message, f"Пользователь '{user_name}' удален из очереди '{queue_name}'.\n\n{queue_info}", parse_mode="Markdown")
+        safe_reply_to(message, f"Пользователь '{user_name}' удален из очереди '{queue_name}'.\n\n{queue_info}", parse_mode="Markdown")
         logger.info(f"Admin {admin_id} removed user {user_id} ({user_name}) from queue '{queue_name}'")
     
     except Exception as e:
@@ -1064,6 +1377,7 @@ def remove_user_admin(message):
 
 # Обработчик команды /setposition - установка позиции участника в очереди
 @bot.message_handler(commands=['setposition'])
+@timed_handler('setposition')
 @rate_limit_decorator('default')
 def set_user_position(message):
     try:
@@ -1072,7 +1386,7 @@ def set_user_position(message):
         
         # Проверяем, указаны ли все необходимые параметры
         if len(command_parts) < 4:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди, имя пользователя или @username и новую позицию. Пример: `/setposition Математика @username 1` или `/setposition Математика Иван 3`", parse_mode="Markdown")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди, имя пользователя или @username и новую позицию. Пример: `/setposition Математика @username 1` или `/setposition Математика Иван 3`", parse_mode="Markdown")
             return
         
         queue_name = command_parts[1].strip()
@@ -1082,137 +1396,269 @@ def set_user_position(message):
         try:
             new_position = int(command_parts[3].strip())
             if new_position < 1:
-                bot.reply_to(message, "Позиция должна быть положительным числом.")
+                safe_reply_to(message, "Позиция должна быть положительным числом.")
                 return
         except ValueError:
-            bot.reply_to(message, "Позиция должна быть числом.")
+            safe_reply_to(message, "Позиция должна быть числом.")
             return
         
         chat_id = message.chat.id
         admin_id = message.from_user.id
         
         # Проверяем, является ли пользователь администратором или создателем чата
-        chat_member = bot.get_chat_member(chat_id, admin_id)
-        if chat_member.status not in ['administrator', 'creator']:
-            bot.reply_to(message, "Только администраторы могут изменять позиции участников в очереди.")
+        if not is_chat_admin(chat_id, admin_id):
+            safe_reply_to(message, "Только администраторы могут изменять позиции участников в очереди.")
             return
         
         # Проверяем существование очереди
         queue_id = db.get_queue_id(queue_name, chat_id)
         if not queue_id:
-            bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+            safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
             return
         
         # Получаем список участников очереди
         queue_members = db.get_queue_members(queue_id)
         if not queue_members:
-            bot.reply_to(message, f"Очередь '{queue_name}' пуста.")
+            safe_reply_to(message, f"Очередь '{queue_name}' пуста.")
             return
         
         # Проверяем, что новая позиция не превышает количество участников
         if new_position > len(queue_members):
-            bot.reply_to(message, f"Позиция не может быть больше количества участников ({len(queue_members)}).")
+            safe_reply_to(message, f"Позиция не может быть больше количества участников ({len(queue_members)}).")
             return
         
         # Ищем пользователя по идентификатору (имя или @username)
-        user_found = False
-        user_id = None
-        user_order = None
-        user_name = None
-        
-        for name, username, order, uid in queue_members:
-            # Проверяем совпадение по username (если указан с @ или без)
-            if username and (user_identifier.lower() == username.lower() or 
-                            user_identifier.lower() == f"@{username}".lower()):
-                user_found = True
-                user_id = uid
-                user_order = order
-                user_name = name
-                break
-            
-            # Проверяем совпадение по имени
-            if name.lower() == user_identifier.lower():
-                user_found = True
-                user_id = uid
-                user_order = order
-                user_name = name
-                break
-        
-        if not user_found:
-            bot.reply_to(message, f"Пользователь '{user_identifier}' не найден в очереди '{queue_name}'.")
+        member = find_queue_member(queue_members, user_identifier)
+        if member is None:
+            safe_reply_to(message, f"Пользователь '{user_identifier}' не найден в очереди '{queue_name}'.")
             return
+        user_name, _, _, user_id = member
         
         # Изменяем позицию пользователя в очереди
         success, old_position = db.set_user_position(queue_id, user_id, new_position)
         
         if not success:
             if old_position == new_position:
-                bot.reply_to(message, f"Пользователь '{user_name}' уже находится на позиции {new_position}.")
+                safe_reply_to(message, f"Пользователь '{user_name}' уже находится на позиции {new_position}.")
                 return
             else:
-                bot.reply_to(message, f"Невозможно изменить позицию пользователя '{user_name}'.")
+                safe_reply_to(message, f"Невозможно изменить позицию пользователя '{user_name}'.")
                 return
         
         # Формируем сообщение с обновленной информацией об очереди
         queue_info = format_queue_info(queue_name, queue_id)
         
-        bot.reply_to(message, f"Пользователь '{user_name}' перемещен на позицию {new_position} в очереди '{queue_name}'.\n\n{queue_info}", parse_mode="Markdown")
+        safe_reply_to(message, f"Пользователь '{user_name}' перемещен на позицию {new_position} в очереди '{queue_name}'.\n\n{queue_info}", parse_mode="Markdown")
         logger.info(f"Admin {admin_id} moved user {user_id} ({user_name}) to position {new_position} in queue '{queue_name}'")
     
     except Exception as e:
         handle_error(message, e, "изменении позиции пользователя")
 
-# Обработчик команды /skip
-@bot.message_handler(commands=['skip'])
+def resolve_queue_members(queue_id, identifiers):
+    """
+    Поиск участников очереди по списку имен и @username через запятую.
+
+    Returns:
+        (список user_id найденных участников в порядке списка, список ненайденных имен)
+    """
+    queue_members = db.get_queue_members(queue_id)
+    user_ids = []
+    missing = []
+    for identifier in identifiers.split(','):
+        identifier = identifier.strip()
+        if not identifier:
+            continue
+        member = find_queue_member(queue_members, identifier)
+        if member is None:
+            missing.append(identifier)
+        else:
+            user_ids.append(member[3])
+    return user_ids, missing
+
+def missing_members_text(missing):
+    """Строка ответа о ненайденных участниках (пустая, если все найдены)"""
+    if not missing:
+        return ""
+    return "\nНе найдены в очереди: " + ", ".join(f"'{escape_markdown(name)}'" for name in missing)
+
+# Обработчик команды /shuffle - случайная перестановка участников очереди
+@bot.message_handler(commands=['shuffle'])
+@timed_handler('shuffle')
 @rate_limit_decorator('default')
-def skip_position(message):
+def shuffle_queue(message):
     try:
-        # Получаем текст после команды /skip
         command_parts = message.text.split(' ', 1)
+        if len(command_parts) < 2:
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/shuffle Математика`", parse_mode="Markdown")
+            return
         
-        # Проверяем, указано ли название очереди
+        queue_name = command_parts[1].strip()
+        queue_id = admin_queue_id(message, queue_name, "Только администраторы могут перемешивать очередь.")
+        if not queue_id:
+            return
+        
+        # Вся перестановка - одна транзакция записи
+        db.shuffle_queue(queue_id)
+        
+        queue_info = format_queue_info(queue_name, queue_id)
+        safe_reply_to(message, f"Очередь '{queue_name}' перемешана.\n\n{queue_info}", parse_mode="Markdown")
+        logger.info(f"Admin {message.from_user.id} shuffled queue '{queue_name}'")
+    
+    except Exception as e:
+        handle_error(message, e, "перемешивании очереди")
+
+# Обработчик команды /sort - восстановление порядка вступления в очередь
+@bot.message_handler(commands=['sort'])
+@timed_handler('sort')
+@rate_limit_decorator('default')
+def sort_queue(message):
+    try:
+        command_parts = message.text.split(' ', 1)
         if len(command_parts) < 2:
-            bot.reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/skip Математика`", parse_mode="Markdown")
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/sort Математика`", parse_mode="Markdown")
             return
         
         queue_name = command_parts[1].strip()
-        chat_id = message.chat.id
-        user_id = message.from_user.id
+        queue_id = admin_queue_id(message, queue_name, "Только администраторы могут сортировать очередь.")
+        if not queue_id:
+            return
         
-        # Проверяем существование очереди
-        queue_id = db.get_queue_id(queue_name, chat_id)
+        if not db.sort_queue_by_join_time(queue_id):
+            safe_reply_to(message, f"Участники очереди '{queue_name}' уже расположены в порядке вступления.")
+            return
+        
+        queue_info = format_queue_info(queue_name, queue_id)
+        safe_reply_to(message, f"Участники очереди '{queue_name}' расположены в порядке вступления.\n\n{queue_info}", parse_mode="Markdown")
+        logger.info(f"Admin {message.from_user.id} sorted queue '{queue_name}' by join time")
+    
+    except Exception as e:
+        handle_error(message, e, "сортировке очереди")
+
+# Обработчик команды /setorder - установка порядка нескольких участников очереди
+@bot.message_handler(commands=['setorder'])
+@timed_handler('setorder')
+@rate_limit_decorator('default')
+def set_queue_order(message):
+    try:
+        command_parts = message.text.split(' ', 2)
+        if len(command_parts) < 3:
+            safe_reply_to(message, "Пожалуйста, укажите название очереди и участников через запятую. Пример: `/setorder Математика @username, Иван, Петр`", parse_mode="Markdown")
+            return
+        
+        queue_name = command_parts[1].strip()
+        queue_id = admin_queue_id(message, queue_name, "Только администраторы могут изменять порядок очереди.")
         if not queue_id:
-            bot.reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
             return
         
-        # Проверяем, состоит ли пользователь в очереди
-        user_order = db.check_user_in_queue(queue_id, user_id)
-        if not user_order:
-            bot.reply_to(message, f"Вы не состоите в очереди '{queue_name}'.")
+        user_ids, missing = resolve_queue_members(queue_id, command_parts[2])
+        if not user_ids:
+            safe_reply_to(message, f"Указанные пользователи не найдены в очереди '{queue_name}'.")
             return
         
-        # Получаем количество участников в очереди
-        members_count = db.get_queue_members_count(queue_id)
+        # Перечисленные участники встают в начало очереди одной транзакцией, остальные - за ними
+        db.set_queue_order(queue_id, user_ids)
+        
+        queue_info = format_queue_info(queue_name, queue_id)
+        safe_reply_to(message, f"Порядок очереди '{queue_name}' изменен.{missing_members_text(missing)}\n\n{queue_info}", parse_mode="Markdown")
+        logger.info(f"Admin {message.from_user.id} set order of {len(user_ids)} users in queue '{queue_name}'")
+    
+    except Exception as e:
+        handle_error(message, e, "изменении порядка очереди")
+
+# Обработчик команды /removemany - удаление нескольких участников очереди
+@bot.message_handler(commands=['removemany'])
+@timed_handler('removemany')
+@rate_limit_decorator('default')
+def remove_many_users(message):
+    try:
+        command_parts = message.text.split(' ', 2)
+        if len(command_parts) < 3:
+            safe_reply_to(message, "Пожалуйста, укажите название очереди и участников через запятую. Пример: `/removemany Математика @username, Иван`", parse_mode="Markdown")
+            return
         
-        # Проверяем, не последний ли пользователь в очереди
-        if user_order == members_count:
-            bot.reply_to(message, f"Вы уже находитесь в конце очереди '{queue_name}'.")
+        queue_name = command_parts[1].strip()
+        queue_id = admin_queue_id(message, queue_name, "Только администраторы могут удалять пользователей из очереди.")
+        if not queue_id:
             return
         
-        # Перемещаем пользователя на одну позицию назад
-        success = db.skip_position_in_queue(queue_id, user_id)
+        user_ids, missing = resolve_queue_members(queue_id, command_parts[2])
+        if not user_ids:
+            safe_reply_to(message, f"Указанные пользователи не найдены в очереди '{queue_name}'.")
+            return
         
-        if not success:
-            bot.reply_to(message, f"Невозможно пропустить позицию в очереди '{queue_name}'.")
+        removed = db.remove_users_from_queue(queue_id, user_ids)
+        
+        queue_info = format_queue_info(queue_name, queue_id)
+        safe_reply_to(message, f"Из очереди '{queue_name}' удалено участников: {len(removed)}.{missing_members_text(missing)}\n\n{queue_info}", parse_mode="Markdown")
+        logger.info(f"Admin {message.from_user.id} removed users {removed} from queue '{queue_name}'")
+    
+    except Exception as e:
+        handle_error(message, e, "удалении пользователей из очереди")
+
+# Обработчик команды /clear - удаление всех участников очереди
+@bot.message_handler(commands=['clear'])
+@timed_handler('clear')
+@rate_limit_decorator('default')
+def clear_queue(message):
+    try:
+        command_parts = message.text.split(' ', 1)
+        if len(command_parts) < 2:
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/clear Математика`", parse_mode="Markdown")
             return
         
-        # Формируем сообщение с обновленной информацией об очереди
+        queue_name = command_parts[1].strip()
+        queue_id = admin_queue_id(message, queue_name, "Только администраторы могут очищать очередь.")
+        if not queue_id:
+            return
+        
+        removed_count = db.clear_queue(queue_id)
+        
         queue_info = format_queue_info(queue_name, queue_id)
+        safe_reply_to(message, f"Очередь '{queue_name}' очищена, удалено участников: {removed_count}.\n\n{queue_info}", parse_mode="Markdown")
+        logger.info(f"Admin {message.from_user.id} cleared queue '{queue_name}' ({removed_count} users)")
+    
+    except Exception as e:
+        handle_error(message, e, "очистке очереди")
+
+# Обработчик команды /skip
+@bot.message_handler(commands=['skip'])
+@timed_handler('skip')
+@rate_limit_decorator('default')
+def skip_position(message):
+    try:
+        # Получаем текст после команды /skip
+        command_parts = message.text.split(' ', 1)
+        
+        # Проверяем, указано ли название очереди
+        if len(command_parts) < 2:
+            safe_reply_to(message, "Пожалуйста, укажите название очереди. Пример: `/skip Математика`", parse_mode="Markdown")
+            return
+        
+        queue_name = command_parts[1].strip()
+        chat_id = message.chat.id
+        user_id = message.from_user.id
+        
+        # Находим очередь и меняем пользователя местами со следующим участником одной транзакцией
+        result = db.skip_by_name(chat_id, queue_name, user_id)
+        if result.status == db.QUEUE_NOT_FOUND:
+            safe_reply_to(message, f"Очередь '{queue_name}' не найдена в этом чате.")
+            return
+        if result.status == db.NOT_MEMBER:
+            safe_reply_to(message, f"Вы не состоите в очереди '{queue_name}'.")
+            return
+        if result.status == db.LAST_IN_QUEUE:
+            safe_reply_to(message, f"Вы уже находитесь в конце очереди '{queue_name}'.")
+            return
+        queue_id = result.queue_id
+        
+        # Формируем сообщение с обновленной информацией об очереди
+        queue_info, version, page, pages = render_queue(queue_name, queue_id, result.snapshot, page_of(result.position))
         
         # Создаем клавиатуру с кнопками
-        keyboard = create_queue_keyboard(queue_name)
+        keyboard = create_queue_keyboard(queue_id, version, page, pages)
         
-        bot.reply_to(message, f"Вы пропустили одного человека вперед в очереди '{queue_name}'.\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+        sent = safe_reply_to(message, f"Вы пропустили одного человека вперед в очереди '{queue_name}'.\n\n{queue_info}", parse_mode="Markdown", reply_markup=keyboard)
+        remember_queue_message(sent, queue_id, version, page)
     
     except Exception as e:
         handle_error(message, e, "пропуске позиции в очереди") 
\ No newline at end of file
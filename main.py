@@ -1,7 +1,8 @@
 import logging
 import atexit
-from database import init_database, close_connection
-from handlers import start_bot
+import asyncio
+from config import BOT_RUNTIME, BOT_MODE, WORKER_PROCESSES, STORAGE_BACKEND
+from storage import default_storage
 
 # Настройка логирования
 logging.basicConfig(
@@ -15,15 +16,28 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Регистрируем функцию закрытия соединения с базой данных при завершении работы
-atexit.register(close_connection)
+# Регистрируем закрытие хранилища (соединений с базой данных или сохранение снимка) при завершении работы
+atexit.register(default_storage.close)
 
 def start_bot_wrapper():
     try:
-        logger.info("Initializing database...")
-        init_database()
+        logger.info(f"Initializing {STORAGE_BACKEND} storage...")
+        default_storage.init()
         logger.info("Starting bot...")
-        start_bot()
+        if WORKER_PROCESSES > 1 and BOT_MODE == 'webhook' and BOT_RUNTIME != 'async' and STORAGE_BACKEND == 'sqlite':
+            # Модули бота импортируются в рабочих процессах, а не в супервизоре
+            from supervisor import Supervisor
+            Supervisor(WORKER_PROCESSES).run()
+        elif BOT_RUNTIME == 'async':
+            # Модуль импортируется только в асинхронном режиме: ему нужен aiohttp
+            from async_handlers import start_bot as start_async_bot
+            asyncio.run(start_async_bot())
+        else:
+            if WORKER_PROCESSES > 1:
+                logger.warning("WORKER_PROCESSES > 1 requires BOT_MODE=webhook, BOT_RUNTIME=threaded "
+                               "and STORAGE_BACKEND=sqlite, running a single process")
+            from handlers import start_bot
+            start_bot()
     except Exception as e:
         logger.error(f"Error starting bot: {str(e)}", exc_info=True)
 
@@ -0,0 +1,249 @@
+import bisect
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм по умолчанию (в секундах): от 50 мкс (чтения из кэша,
+# ожидание свободной блокировки) до 10 с
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Все созданные метрики в порядке создания
+_registry = []
+
+def _escape(value):
+    """Экранирование значения метки для текстового формата Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Монотонно возрастающий счетчик с метками"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Args:
+            name: имя метрики
+            documentation: описание метрики (строка HELP)
+            labelnames: имена меток; значения передаются в inc() в том же порядке
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        """Увеличение счетчика для значений меток labels"""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        """Текущее значение счетчика"""
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        """Строки метрики в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+    def summary(self):
+        """Краткие строки для консоли"""
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} = {value}" for labels, value in values]
+
+class _Timer:
+    """Контекстный менеджер, записывающий в гистограмму время выполнения блока"""
+
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+class Histogram:
+    """Гистограмма значений (обычно длительностей в секундах) с метками"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            name: имя метрики
+            documentation: описание метрики (строка HELP)
+            labelnames: имена меток; значения передаются в observe() в том же порядке
+            buckets: возрастающие верхние границы корзин (корзина +Inf добавляется автоматически)
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # метки -> [счетчики корзин, сумма, количество]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        """Учет значения value для значений меток labels"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        """Контекстный менеджер, учитывающий время выполнения блока"""
+        return _Timer(self, labels)
+
+    def count(self, *labels):
+        """Количество учтенных значений"""
+        with self._lock:
+            series = self._series.get(labels)
+            return series[2] if series else 0
+
+    def quantile(self, q, *labels):
+        """
+        Оценка квантиля q по корзинам (линейная интерполяция внутри корзины,
+        как histogram_quantile в Prometheus). Для значений выше последней границы
+        возвращается последняя граница.
+        """
+        with self._lock:
+            series = self._series.get(labels)
+            if not series or not series[2]:
+                return 0.0
+            counts = list(series[0])
+            total = series[2]
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self):
+        """Строки метрики в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._series.items())
+        bounds = [_format_value(float(bound)) for bound in self.buckets] + ['+Inf']
+        for labels, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, ('le', bound))} {cumulative}")
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+    def summary(self):
+        """Краткие строки для консоли: количество, среднее, p50 и p99 в миллисекундах"""
+        with self._lock:
+            series = sorted((labels, total, count) for labels, (_, total, count) in self._series.items())
+        lines = []
+        for labels, total, count in series:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)}: count={count}, "
+                         f"avg={total / count * 1000:.2f}ms, p50={self.quantile(0.5, *labels) * 1000:.2f}ms, "
+                         f"p99={self.quantile(0.99, *labels) * 1000:.2f}ms")
+        return lines
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def summary():
+    """Краткая сводка всех метрик, по которым есть данные, для консольной команды metrics"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.summary())
+    return lines
+
+# Метрики бота
+
+HANDLER_LATENCY = Histogram('queuemate_handler_seconds', 'Время выполнения обработчика обновления', ['handler'])
+DB_QUERY_LATENCY = Histogram('queuemate_db_query_seconds', 'Время выполнения функции модуля database', ['function'])
+DB_LOCK_WAIT = Histogram('queuemate_db_lock_wait_seconds', 'Время ожидания блокировки записи db_write_lock')
+API_LATENCY = Histogram('queuemate_api_request_seconds', 'Время выполнения запроса к Telegram Bot API', ['method'])
+API_RATE_LIMITED = Counter('queuemate_api_rate_limited_total', 'Ответы Telegram Bot API с ошибкой 429', ['method'])
+RATE_LIMIT_REJECTIONS = Counter('queuemate_rate_limit_rejections_total',
+                                'Команды и нажатия, отклоненные ограничением частоты', ['type'])
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик HTTP-запросов: GET /metrics возвращает все метрики"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics {self.client_address[0]}: {format % args}")
+
+class MetricsServer:
+    """HTTP-сервер, отдающий метрики по адресу /metrics в фоновом потоке"""
+
+    def __init__(self, host, port):
+        self._server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        """Фактический адрес сервера (host, port)"""
+        return self._server.server_address
+
+    def start(self):
+        """Запуск сервера в отдельном потоке"""
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logger.info(f"Metrics available at http://{self.address[0]}:{self.address[1]}/metrics")
+
+    def stop(self):
+        """Остановка сервера"""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
@@ -0,0 +1,656 @@
+import collections
+import functools
+import heapq
+import itertools
+import threading
+import time
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import telebot
+
+logger = logging.getLogger(__name__)
+
+class EditCoalescer:
+    """
+    Объединение частых изменений одного сообщения.
+
+    Первое изменение сообщения откладывается на окно window секунд; все
+    последующие запросы на изменение того же сообщения в пределах окна
+    заменяют отложенное, и по истечении окна выполняется одно изменение
+    с последним состоянием. Сроки всех сообщений хранятся в одной куче,
+    которую обслуживает один поток, как в RetryScheduler.
+    """
+
+    def __init__(self, window, submit=None):
+        """
+        Args:
+            window: окно объединения в секундах (0 - изменения выполняются сразу)
+            submit: функция (key, task), передающая изменение на выполнение в пул
+                потоков (например, в полосу чата); по умолчанию изменение
+                выполняется в потоке планировщика
+        """
+        self.window = window
+        self.requested = 0
+        self.sent = 0
+        self._submit = submit
+        self._pending = {}
+        self._heap = []  # [время отправки, порядковый номер, ключ сообщения]
+        self._counter = itertools.count()
+        self._lock = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """Запуск потока, отправляющего изменения по окончании окна"""
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="edit-coalescer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановка потока; отложенные изменения отбрасываются"""
+        with self._lock:
+            self._running = False
+            self._pending.clear()
+            self._heap.clear()
+            self._lock.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def schedule(self, key, edit):
+        """
+        Планирование изменения сообщения.
+
+        Args:
+            key: ключ сообщения, например (chat_id, message_id)
+            edit: функция без аргументов, выполняющая изменение; возвращает False,
+                если запрос к Telegram не понадобился
+        """
+        with self._lock:
+            self.requested += 1
+            is_first = key not in self._pending
+            self._pending[key] = edit
+            if self.window > 0 and is_first:
+                heapq.heappush(self._heap, (time.monotonic() + self.window, next(self._counter), key))
+                self._lock.notify()
+
+        if self.window <= 0:
+            self._flush(key)
+        elif is_first:
+            self.start()
+
+    def _next_key(self):
+        """Ожидание и извлечение ключа сообщения, окно которого истекло"""
+        with self._lock:
+            while self._running:
+                if not self._heap:
+                    self._lock.wait()
+                    continue
+                due = self._heap[0][0]
+                now = time.monotonic()
+                if due > now:
+                    self._lock.wait(due - now)
+                    continue
+                return heapq.heappop(self._heap)[2]
+            return None
+
+    def _run(self):
+        while True:
+            key = self._next_key()
+            if key is None:
+                break
+            if self._submit is None:
+                self._flush(key)
+                continue
+            try:
+                self._submit(key, functools.partial(self._flush, key))
+            except Exception as e:
+                # Пул потоков уже остановлен: изменение отбрасывается
+                logger.error(f"Failed to submit coalesced edit for {key}: {str(e)}")
+                with self._lock:
+                    self._pending.pop(key, None)
+
+    def _flush(self, key):
+        with self._lock:
+            edit = self._pending.pop(key, None)
+        if edit is None:
+            return
+
+        try:
+            if edit() is not False:
+                with self._lock:
+                    self.sent += 1
+        except Exception as e:
+            logger.error(f"Error applying coalesced edit for {key}: {str(e)}", exc_info=True)
+
+    def stats(self):
+        """Статистика: запрошено изменений, отправлено, сэкономлено и ожидает отправки"""
+        with self._lock:
+            pending = len(self._pending)
+            return {
+                'requested': self.requested,
+                'sent': self.sent,
+                'saved': self.requested - self.sent - pending,
+                'pending': pending,
+            }
+
+def get_retry_after(error):
+    """
+    Время ожидания из ошибки Telegram 429 (Too Many Requests).
+
+    Returns:
+        float: рекомендованная пауза в секундах (0, если Telegram ее не указал)
+            или None, если это не ошибка превышения лимита
+    """
+    # Проверяем атрибуты, а не класс: у AsyncTeleBot свой класс ApiTelegramException
+    error_code = getattr(error, 'error_code', None)
+    if error_code is None:
+        return None
+    if error_code != 429 and "Too Many Requests" not in str(error):
+        return None
+    if isinstance(getattr(error, 'result_json', None), dict):
+        parameters = error.result_json.get('parameters') or {}
+        if 'retry_after' in parameters:
+            return float(parameters['retry_after'])
+    return 0.0
+
+class RetryScheduler:
+    """
+    Планировщик повторной отправки запросов после ошибки 429.
+
+    Вместо ожидания в потоке обработчика запрос помещается в кучу отложенных
+    задач, которую обслуживает отдельный поток. Для каждого чата запоминается
+    время, до которого Telegram попросил не отправлять запросы (retry_after):
+    новые запросы в такой чат сразу откладываются до окончания паузы.
+    Наступивший повтор передается функции submit (например, OutboundGovernor.submit)
+    с исходными приоритетом и чатом, чтобы повторы учитывались в общих лимитах.
+    """
+
+    def __init__(self, max_retries=3, initial_delay=1, submit=None):
+        """
+        Args:
+            max_retries: максимальное количество повторов одного запроса
+            initial_delay: начальная задержка повтора в секундах (удваивается с каждой попыткой)
+            submit: функция с сигнатурой OutboundGovernor.submit, ставящая повтор в очередь
+                ограничителя; по умолчанию повтор выполняется в потоке планировщика
+        """
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+        self.scheduled = 0
+        self.retried = 0
+        self.dropped = 0
+        self._submit = submit
+        self._heap = []  # [время выполнения, порядковый номер, задача]
+        self._keys = {}  # ключ замены -> задача
+        self._blocked_until = {}  # chat_id -> время окончания паузы
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """Запуск потока обработки отложенных запросов"""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="retry-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Остановка потока; неотправленные запросы отбрасываются"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def retry_after(self, chat_id):
+        """Сколько секунд осталось до окончания паузы для чата"""
+        with self._condition:
+            until = self._blocked_until.get(chat_id)
+            if until is None:
+                return 0
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                del self._blocked_until[chat_id]
+                return 0
+            return remaining
+
+    def call(self, request, chat_id=None, key=None, priority=None, on_error=None):
+        """
+        Выполнение запроса к Telegram без блокировки при ошибке 429.
+
+        Args:
+            request: функция без аргументов, выполняющая запрос
+            chat_id: чат, к которому относится запрос (для учета retry_after)
+            key: ключ замены: отложенный запрос с тем же ключом заменяется новым
+                (например, (chat_id, message_id) для изменений сообщения)
+            priority: приоритет, с которым повтор передается в submit
+            on_error: функция (error), вызываемая, если отложенный запрос так и не
+                выполнен: повторы исчерпаны, повтор завершился ошибкой или был
+                отменен (error - None)
+
+        Returns:
+            Результат запроса или None, если запрос отложен
+        """
+        task = [request, chat_id, key, 0, priority, on_error]
+        if key is not None:
+            with self._condition:
+                # Новый запрос с тем же ключом делает отложенный ненужным
+                previous = self._keys.pop(key, None)
+                if previous is not None:
+                    previous[0] = None
+        return self._attempt(task, raise_errors=True)
+
+    def _attempt(self, task, raise_errors=False):
+        """
+        Выполнение запроса задачи; при ошибке 429 задача откладывается снова.
+
+        Args:
+            raise_errors: передавать ли вызывающему ошибки, отличные от 429
+                (иначе они записываются в лог)
+        """
+        request, chat_id, key = task[:3]
+        # Пока повтор ждал в очереди ограничителя, Telegram мог снова приостановить чат
+        wait = self.retry_after(chat_id)
+        if wait > 0:
+            self._schedule(task, wait)
+            return None
+
+        try:
+            return request()
+        except telebot.apihelper.ApiTelegramException as e:
+            retry_after = get_retry_after(e)
+            if retry_after is not None:
+                self._on_rate_limited(task, retry_after, e)
+                return None
+            if raise_errors:
+                raise
+            logger.error(f"Error retrying request in chat {chat_id}: {str(e)}")
+            self._fail(task, e)
+        except Exception as e:
+            if raise_errors:
+                raise
+            logger.error(f"Error retrying request in chat {chat_id}: {str(e)}", exc_info=True)
+            self._fail(task, e)
+        return None
+
+    def _fail(self, task, error):
+        """Сообщение владельцу запроса, что отложенный запрос не будет выполнен"""
+        on_error = task[5]
+        if on_error is None:
+            return
+        try:
+            on_error(error)
+        except Exception as e:
+            logger.error(f"Error in retry failure callback: {str(e)}", exc_info=True)
+
+    def _on_rate_limited(self, task, retry_after, error):
+        request, chat_id, key, attempt, priority, on_error = task
+        if attempt >= self.max_retries:
+            logger.error(f"Max retries exceeded for rate limit in chat {chat_id}. Giving up.")
+            with self._condition:
+                self.dropped += 1
+            self._fail(task, error)
+            return
+
+        delay = max(retry_after, self.initial_delay * 2 ** attempt)
+        logger.warning(f"Rate limit exceeded in chat {chat_id}. Retry {attempt + 1}/{self.max_retries} "
+                       f"scheduled in {delay} seconds")
+        with self._condition:
+            until = time.monotonic() + retry_after
+            if until > self._blocked_until.get(chat_id, 0):
+                self._blocked_until[chat_id] = until
+        self._schedule([request, chat_id, key, attempt + 1, priority, on_error], delay)
+
+    def _schedule(self, task, delay):
+        key = task[2]
+        with self._condition:
+            if key is not None:
+                previous = self._keys.get(key)
+                if previous is not None:
+                    # Устаревший отложенный запрос больше не нужен
+                    previous[0] = None
+                self._keys[key] = task
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), task))
+            self.scheduled += 1
+            self._condition.notify()
+        self.start()
+
+    def _next_task(self):
+        """Ожидание и извлечение очередной задачи, время выполнения которой наступило"""
+        with self._condition:
+            while self._running:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _, task = self._heap[0]
+                now = time.monotonic()
+                if due > now:
+                    self._condition.wait(due - now)
+                    continue
+                heapq.heappop(self._heap)
+                request, chat_id, key = task[:3]
+                if request is None:
+                    continue
+                # Пауза для чата могла продлиться после планирования задачи
+                until = self._blocked_until.get(chat_id, 0)
+                if until > now:
+                    heapq.heappush(self._heap, (until, next(self._counter), task))
+                    continue
+                if key is not None and self._keys.get(key) is task:
+                    del self._keys[key]
+                return task
+            return None
+
+    def _run(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                break
+            with self._condition:
+                self.retried += 1
+            if self._submit is None:
+                self._attempt(task)
+                continue
+            request, chat_id, key, attempt, priority, on_error = task
+            try:
+                # Отложенный запрос не заменяет более новый с тем же ключом, уже ожидающий в очереди
+                future = self._submit(functools.partial(self._attempt, task), priority, chat_id, key, replace=False)
+            except Exception as e:
+                logger.error(f"Failed to submit retry in chat {chat_id}: {str(e)}")
+                with self._condition:
+                    self.dropped += 1
+                self._fail(task, e)
+                continue
+            future.add_done_callback(functools.partial(self._on_submitted, task))
+
+    def _on_submitted(self, task, future):
+        # Ограничитель остановлен раньше, чем повтор был отправлен
+        if future.cancelled():
+            self._fail(task, None)
+
+    def depth(self):
+        """Количество ожидающих отправки запросов"""
+        with self._condition:
+            return sum(1 for _, _, task in self._heap if task[0] is not None)
+
+    def stats(self):
+        """Статистика: отложено, повторено, отброшено, в очереди и чатов на паузе"""
+        with self._condition:
+            now = time.monotonic()
+            return {
+                'scheduled': self.scheduled,
+                'retried': self.retried,
+                'dropped': self.dropped,
+                'depth': sum(1 for _, _, task in self._heap if task[0] is not None),
+                'blocked_chats': sum(1 for until in self._blocked_until.values() if until > now),
+            }
+
+# Приоритеты исходящих запросов: чем меньше значение, тем раньше отправка
+PRIORITY_CALLBACK = 0  # Ответы на нажатия кнопок (Telegram ждет их не дольше нескольких секунд)
+PRIORITY_EDIT = 1      # Изменения сообщений с очередями
+PRIORITY_MESSAGE = 2   # Информационные сообщения и ответы на команды
+
+class TokenBucket:
+    """Ведро токенов: count запросов за period секунд с возможностью всплеска до count"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, count, period, now):
+        self.rate = count / period
+        self.capacity = count
+        self.tokens = count
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Сколько секунд ждать до появления токена (0 - токен есть)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Расход одного токена"""
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        """Ведро заполнено, то есть давно не использовалось"""
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundGovernor:
+    """
+    Ограничитель исходящих запросов к Telegram Bot API.
+
+    Запросы ставятся в очереди по приоритетам и отправляются потоком-диспетчером
+    с учетом общего ведра токенов и отдельных ведер для групповых чатов.
+    Запросы в один чат отправляются строго по одному и по порядку; запрос,
+    ожидающий токена своего чата, не задерживает запросы в другие чаты.
+    """
+
+    # Сколько ведер групповых чатов хранить, прежде чем удалять неиспользуемые
+    BUCKETS_CLEANUP_THRESHOLD = 1000
+
+    def __init__(self, global_limit, group_limit, workers=8):
+        """
+        Args:
+            global_limit: общее ограничение {'count': ..., 'period': ...}
+            group_limit: ограничение для одного группового чата {'count': ..., 'period': ...}
+            workers: количество потоков, выполняющих HTTP-запросы
+        """
+        self.global_limit = global_limit
+        self.group_limit = group_limit
+        self.workers = workers
+        self.submitted = 0
+        self.sent = 0
+        self.replaced = 0
+        self._global = TokenBucket(global_limit['count'], global_limit['period'], time.monotonic())
+        self._buckets = {}  # chat_id -> TokenBucket
+        self._queues = [collections.deque() for _ in (PRIORITY_CALLBACK, PRIORITY_EDIT, PRIORITY_MESSAGE)]
+        self._keys = {}  # ключ замены -> ожидающий запрос
+        self._inflight = set()  # чаты, запрос в которые выполняется
+        self._condition = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        """Запуск диспетчера"""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbound")
+            self._thread = threading.Thread(target=self._run, name="outbound-governor", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Остановка диспетчера.
+
+        Args:
+            timeout: сколько секунд ждать отправки уже поставленных в очередь запросов
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._running and (any(self._queues) or self._inflight):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._running = False
+            dropped = sum(len(queue) for queue in self._queues)
+            for queue in self._queues:
+                for task in queue:
+                    for future in task[3]:
+                        future.cancel()
+                queue.clear()
+            self._keys.clear()
+            self._condition.notify_all()
+        if dropped:
+            logger.warning(f"Outbound governor stopped, {dropped} queued requests dropped")
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        self._thread = None
+        self._executor = None
+
+    def submit(self, request, priority, chat_id=None, key=None, replace=True):
+        """
+        Постановка запроса в очередь.
+
+        Args:
+            request: функция без аргументов, выполняющая запрос
+            priority: PRIORITY_CALLBACK, PRIORITY_EDIT или PRIORITY_MESSAGE
+            chat_id: чат назначения (None - запрос не относится к чату)
+            key: ключ замены: ожидающий запрос с тем же ключом заменяется новым
+                с сохранением места в очереди
+            replace: False - если запрос с тем же ключом уже ожидает, он сохраняется,
+                а новый запрос отбрасывается (Future получит результат ожидающего)
+
+        Returns:
+            Future с результатом запроса
+        """
+        future = Future()
+        with self._condition:
+            self.submitted += 1
+            task = self._keys.get(key) if key is not None else None
+            if task is not None:
+                if replace:
+                    task[0] = request
+                task[3].append(future)
+                self.replaced += 1
+            else:
+                task = [request, chat_id, key, [future]]
+                if key is not None:
+                    self._keys[key] = task
+                self._queues[priority].append(task)
+                self._condition.notify()
+        self.start()
+        return future
+
+    def take_tokens(self, chat_id=None):
+        """
+        Расход токенов общего ведра и ведра чата для запроса, который отправляется
+        не через очередь ограничителя (асинхронной средой выполнения), чтобы все
+        запросы процесса укладывались в одни и те же лимиты.
+
+        Returns:
+            0, если токены получены, иначе сколько секунд ждать до следующей попытки
+        """
+        with self._condition:
+            now = time.monotonic()
+            bucket = self._chat_bucket(chat_id, now)
+            wait = max(self._global.wait_time(now), bucket.wait_time(now) if bucket is not None else 0)
+            if not wait:
+                self._global.take(now)
+                if bucket is not None:
+                    bucket.take(now)
+            return wait
+
+    def _chat_bucket(self, chat_id, now):
+        # Отдельное ограничение действует только для групп (отрицательные ID чатов)
+        if chat_id is None or chat_id >= 0:
+            return None
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= self.BUCKETS_CLEANUP_THRESHOLD:
+                for idle_chat in [chat for chat, idle in self._buckets.items() if idle.is_full(now)]:
+                    del self._buckets[idle_chat]
+            bucket = TokenBucket(self.group_limit['count'], self.group_limit['period'], now)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _next_task(self):
+        """Ожидание запроса, который можно отправить прямо сейчас"""
+        with self._condition:
+            while self._running:
+                now = time.monotonic()
+                wait = self._global.wait_time(now) if any(self._queues) else None
+                if wait == 0:
+                    wait = None
+                    for queue in self._queues:
+                        for index, task in enumerate(queue):
+                            chat_id = task[1]
+                            if chat_id is not None and chat_id in self._inflight:
+                                continue
+                            bucket = self._chat_bucket(chat_id, now)
+                            chat_wait = bucket.wait_time(now) if bucket is not None else 0
+                            if chat_wait:
+                                wait = chat_wait if wait is None else min(wait, chat_wait)
+                                continue
+                            del queue[index]
+                            if task[2] is not None:
+                                del self._keys[task[2]]
+                            if chat_id is not None:
+                                self._inflight.add(chat_id)
+                            if bucket is not None:
+                                bucket.take(now)
+                            self._global.take(now)
+                            return task
+                self._condition.wait(wait)
+            return None
+
+    def _run(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                break
+            try:
+                self._executor.submit(self._execute, task)
+            except RuntimeError:
+                # Пул потоков уже остановлен
+                self._finish(task, None, RuntimeError("Outbound governor stopped"))
+
+    def _execute(self, task):
+        request = task[0]
+        try:
+            result = request()
+        except Exception as e:
+            self._finish(task, None, e)
+        else:
+            self._finish(task, result, None)
+
+    def _finish(self, task, result, error):
+        with self._condition:
+            self.sent += 1
+            self._inflight.discard(task[1])
+            self._condition.notify_all()
+        for future in task[3]:
+            if not future.set_running_or_notify_cancel():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def depth(self):
+        """Количество запросов, ожидающих отправки"""
+        with self._condition:
+            return sum(len(queue) for queue in self._queues)
+
+    def stats(self):
+        """Статистика: поставлено, отправлено, заменено и ожидает по приоритетам"""
+        with self._condition:
+            return {
+                'submitted': self.submitted,
+                'sent': self.sent,
+                'replaced': self.replaced,
+                'callbacks': len(self._queues[PRIORITY_CALLBACK]),
+                'edits': len(self._queues[PRIORITY_EDIT]),
+                'messages': len(self._queues[PRIORITY_MESSAGE]),
+                'inflight': len(self._inflight),
+            }
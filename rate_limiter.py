@@ -0,0 +1,102 @@
+import threading
+import time
+
+# Количество сегментов (shards) ограничителя: ключи распределяются по сегментам
+# с отдельными блокировками, чтобы потоки с разными ключами не ждали друг друга
+DEFAULT_SHARDS = 16
+
+class _Shard:
+    """Сегмент ограничителя: ключ -> теоретическое время следующего запроса (TAT)"""
+
+    __slots__ = ('lock', 'tats')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Словарь сохраняет порядок добавления: при появлении нового ключа
+        # проверяется самая старая запись (см. RateLimiter.hit)
+        self.tats = {}
+
+class RateLimiter:
+    """
+    Потокобезопасный ограничитель частоты по алгоритму GCRA (generic cell rate algorithm).
+
+    Для каждого ключа хранится одно число - теоретическое время прибытия следующего
+    запроса (TAT), поэтому память на ключ постоянна. Разрешается до count запросов
+    подряд, после чего - один запрос каждые period / count секунд.
+
+    Ключи распределены по сегментам с отдельными блокировками. Записи, по которым
+    лимит полностью восстановился, удаляются при добавлении новых ключей в сегмент,
+    без отдельного потока очистки.
+    """
+
+    def __init__(self, count, period, shards=DEFAULT_SHARDS, clock=time.monotonic):
+        """
+        Args:
+            count: сколько запросов разрешено за period секунд (размер всплеска)
+            period: период в секундах
+            shards: количество сегментов
+            clock: функция, возвращающая текущее время в секундах
+        """
+        self.count = count
+        self.period = period
+        self.interval = period / count
+        # Насколько TAT ключа может опережать текущее время, чтобы запрос был разрешен
+        self._burst = period - self.interval
+        self.clock = clock
+        self._shards = [_Shard() for _ in range(shards)]
+        self._shard_count = shards
+
+    def hit(self, key):
+        """
+        Учет запроса по ключу.
+
+        Returns:
+            float: 0, если запрос разрешен, иначе сколько секунд ждать до разрешения
+        """
+        now = self.clock()
+        shard = self._shards[hash(key) % self._shard_count]
+        tats = shard.tats
+        burst = self._burst
+        # Отклонение без блокировки: TAT ключа только растет (удаляются лишь записи
+        # с восстановленным лимитом), поэтому прочитанное без блокировки значение
+        # не больше текущего, и отклоненный по нему запрос был бы отклонен и под блокировкой
+        tat = tats.get(key)
+        if tat is not None and tat - burst > now:
+            return tat - burst - now
+        # acquire/release вместо with: в горячем пути заметно дешевле
+        lock = shard.lock
+        lock.acquire()
+        try:
+            tat = tats.get(key)
+            if tat is None:
+                # Новый ключ: самая старая запись сегмента удаляется, если лимит по ней
+                # восстановился, иначе переносится в конец. Каждый новый ключ проверяет
+                # одну запись, поэтому устаревшие записи не накапливаются
+                if tats:
+                    oldest = next(iter(tats))
+                    oldest_tat = tats.pop(oldest)
+                    if oldest_tat > now:
+                        tats[oldest] = oldest_tat
+                tat = now
+            elif tat < now:
+                tat = now
+            elif tat - burst > now:
+                # Запрос отклонен: состояние ключа не меняется
+                return tat - burst - now
+            tats[key] = tat + self.interval
+            return 0
+        finally:
+            lock.release()
+
+    def reset(self, key=None):
+        """Сброс ограничения по ключу (или по всем ключам, если key не указан)"""
+        shards = self._shards if key is None else [self._shards[hash(key) % self._shard_count]]
+        for shard in shards:
+            with shard.lock:
+                if key is None:
+                    shard.tats.clear()
+                else:
+                    shard.tats.pop(key, None)
+
+    def __len__(self):
+        return sum(len(shard.tats) for shard in self._shards)
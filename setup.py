@@ -34,12 +34,15 @@ setup(
     long_description_content_type="text/markdown",
     author="dmitrym1309 & stepanovvladislav",
     packages=find_packages(),
-    py_modules=["main", "handlers", "database", "config", "qm_docs_build"],
+    py_modules=["main", "handlers", "database", "cache", "outbound", "rate_limiter", "dispatcher", "webhook", "async_handlers", "metrics", "config", "qm_docs_build", "supervisor", "storage", "callback_data"],
     install_requires=[
         "pyTelegramBotAPI==4.14.0",
         "python-dotenv==1.0.0",
     ],
     extras_require={
+        'async': [
+            'aiohttp==3.9.1',
+        ],
         'docs': [
             'mkdocs==1.5.3',
             'mkdocs-material==9.4.14',
@@ -0,0 +1,940 @@
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+import random
+import logging
+import functools
+
+from config import STORAGE_BACKEND, STORAGE_SNAPSHOT_PATH, STORAGE_SNAPSHOT_INTERVAL
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Версия формата файла снимка хранилища в памяти
+SNAPSHOT_FORMAT = 1
+
+class QueueExistsError(Exception):
+    """Очередь с таким названием в чате уже существует"""
+
+class Storage(abc.ABC):
+    """
+    Интерфейс хранилища бота: пользователи, чаты, очереди и их участники.
+
+    Обработчики работают с хранилищем только через эти методы, поэтому реализации
+    взаимозаменяемы. Форматы результатов совпадают с функциями модуля database:
+    участники - (display_name, username, позиция, user_id), снимок - QueueSnapshot,
+    страница очереди - QueuePage, составные операции - QueueOperation со статусами ниже.
+    Все методы абстрактные: реализацию без любого из них нельзя создать.
+    """
+
+    QueueSnapshot = database.QueueSnapshot
+    QueuePage = database.QueuePage
+    QueueOperation = database.QueueOperation
+
+    QUEUE_NOT_FOUND = database.QUEUE_NOT_FOUND
+    ALREADY_MEMBER = database.ALREADY_MEMBER
+    NOT_MEMBER = database.NOT_MEMBER
+    LAST_IN_QUEUE = database.LAST_IN_QUEUE
+    DONE = database.DONE
+
+    @abc.abstractmethod
+    def init(self):
+        """Подготовка хранилища к работе (создание схемы, загрузка данных)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self):
+        """Сохранение данных и освобождение ресурсов"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_or_update_user(self, user_id, username, display_name):
+        """Добавление или обновление информации о пользователе"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_user_info(self, user_id):
+        """(username, display_name) пользователя или (None, None)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_display_name(self, user_id, display_name):
+        """Обновление отображаемого имени пользователя"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_username(self, user_id, username):
+        """Обновление только username пользователя"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_chat(self, chat_id, chat_name):
+        """Добавление чата (существующий чат не изменяется)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_queue(self, queue_name, chat_id, creator_id):
+        """
+        Создание очереди.
+
+        Returns:
+            int: ID новой очереди
+
+        Raises:
+            QueueExistsError: очередь с таким названием в чате уже существует
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_queue(self, queue_id):
+        """Удаление очереди и всех ее участников"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_queue_id(self, queue_name, chat_id):
+        """ID очереди по названию и ID чата или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_all_queues(self, chat_id):
+        """Очереди чата в виде (название, количество участников), по названию"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_queue_creator(self, queue_id):
+        """Отображаемое имя создателя очереди или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_queue_version(self, queue_id):
+        """Версия очереди или None, если очередь не найдена"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_queue_snapshot(self, queue_id):
+        """QueueSnapshot(version, creator_name, members) или None, если очередь не найдена"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_queue_members_page(self, queue_id, offset, limit):
+        """
+        QueuePage с limit участниками начиная с offset (0 - с первого) или None,
+        если очередь не найдена. Время не должно зависеть от размера очереди.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_queue_members(self, queue_id):
+        """Участники очереди в виде (display_name, username, позиция, user_id)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_queue_members_count(self, queue_id):
+        """Количество участников очереди"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def check_user_in_queue(self, queue_id, user_id):
+        """Позиция пользователя в очереди или None"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_user_to_queue(self, queue_id, user_id):
+        """Добавление пользователя (не состоящего в очереди) в конец очереди, возвращает позицию"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_user_from_queue(self, queue_id, user_id):
+        """Удаление пользователя из очереди"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rejoin_queue(self, queue_id, user_id):
+        """Перемещение пользователя в конец очереди (или добавление), возвращает позицию"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def skip_position_in_queue(self, queue_id, user_id):
+        """Обмен пользователя местами со следующим участником, возвращает успех"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_user_position(self, queue_id, user_id, new_position):
+        """
+        Перемещение пользователя на позицию new_position.
+
+        Returns:
+            (успех, прежняя позиция); (False, None), если пользователь не в очереди
+        """
+        raise NotImplementedError
+
+    # Массовые операции администратора: одна транзакция на всю очередь
+
+    @abc.abstractmethod
+    def shuffle_queue(self, queue_id, rng=random):
+        """Случайная перестановка участников (rng.sample), возвращает True, если порядок изменился"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sort_queue_by_join_time(self, queue_id):
+        """Упорядочивание участников по времени вступления, возвращает True, если порядок изменился"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_queue_order(self, queue_id, user_ids):
+        """
+        Перемещение участников user_ids в начало очереди в указанном порядке (остальные -
+        за ними в прежнем порядке), возвращает True, если порядок изменился
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove_users_from_queue(self, queue_id, user_ids):
+        """Удаление нескольких пользователей, возвращает список удаленных user_id"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear_queue(self, queue_id):
+        """Удаление всех участников очереди, возвращает их количество"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def join_by_name(self, chat_id, queue_name, user_id):
+        """Присоединение к очереди по названию: QueueOperation (QUEUE_NOT_FOUND, ALREADY_MEMBER, DONE)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def exit_by_name(self, chat_id, queue_name, user_id):
+        """Выход из очереди по названию: QueueOperation (QUEUE_NOT_FOUND, NOT_MEMBER, DONE)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rejoin_by_name(self, chat_id, queue_name, user_id):
+        """Перемещение в конец очереди по названию: QueueOperation (QUEUE_NOT_FOUND, NOT_MEMBER, DONE)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def skip_by_name(self, chat_id, queue_name, user_id):
+        """Пропуск вперед по названию: QueueOperation (QUEUE_NOT_FOUND, NOT_MEMBER, LAST_IN_QUEUE, DONE)"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def join_by_id(self, chat_id, queue_id, user_id):
+        """Присоединение к очереди чата chat_id по ID, аналог join_by_name"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def exit_by_id(self, chat_id, queue_id, user_id):
+        """Выход из очереди чата chat_id по ID, аналог exit_by_name"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rejoin_by_id(self, chat_id, queue_id, user_id):
+        """Перемещение в конец очереди чата chat_id по ID, аналог rejoin_by_name"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def skip_by_id(self, chat_id, queue_id, user_id):
+        """Пропуск вперед в очереди чата chat_id по ID, аналог skip_by_name"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_cache_stats(self):
+        """Статистика кэша очередей в формате LRUCache.stats()"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def check_member_counts(self, repair=False):
+        """
+        Проверка сохраненных счетчиков участников очередей.
+
+        Returns:
+            Список (queue_id, значение счетчика, фактическое количество) для очередей с расхождением
+        """
+        raise NotImplementedError
+
+class SQLiteStorage(Storage):
+    """Хранилище в базе данных SQLite (функции модуля database, файл DB_NAME)"""
+
+    def init(self):
+        database.init_database()
+
+    def close(self):
+        database.close_connection()
+
+    def add_or_update_user(self, user_id, username, display_name):
+        database.add_or_update_user(user_id, username, display_name)
+
+    def get_user_info(self, user_id):
+        return database.get_user_info(user_id)
+
+    def update_display_name(self, user_id, display_name):
+        database.update_display_name(user_id, display_name)
+
+    def update_username(self, user_id, username):
+        database.update_username(user_id, username)
+
+    def add_chat(self, chat_id, chat_name):
+        database.add_chat(chat_id, chat_name)
+
+    def create_queue(self, queue_name, chat_id, creator_id):
+        try:
+            return database.create_queue(queue_name, chat_id, creator_id)
+        except sqlite3.IntegrityError as e:
+            raise QueueExistsError(queue_name) from e
+
+    def delete_queue(self, queue_id):
+        database.delete_queue(queue_id)
+
+    def get_queue_id(self, queue_name, chat_id):
+        return database.get_queue_id(queue_name, chat_id)
+
+    def get_all_queues(self, chat_id):
+        return database.get_all_queues(chat_id)
+
+    def get_queue_creator(self, queue_id):
+        return database.get_queue_creator(queue_id)
+
+    def get_queue_version(self, queue_id):
+        return database.get_queue_version(queue_id)
+
+    def get_queue_snapshot(self, queue_id):
+        return database.get_queue_snapshot(queue_id)
+
+    def get_queue_members_page(self, queue_id, offset, limit):
+        return database.get_queue_members_page(queue_id, offset, limit)
+
+    def get_queue_members(self, queue_id):
+        return database.get_queue_members(queue_id)
+
+    def get_queue_members_count(self, queue_id):
+        return database.get_queue_members_count(queue_id)
+
+    def check_user_in_queue(self, queue_id, user_id):
+        return database.check_user_in_queue(queue_id, user_id)
+
+    def add_user_to_queue(self, queue_id, user_id):
+        return database.add_user_to_queue(queue_id, user_id)
+
+    def remove_user_from_queue(self, queue_id, user_id):
+        database.remove_user_from_queue(queue_id, user_id)
+
+    def rejoin_queue(self, queue_id, user_id):
+        return database.rejoin_queue(queue_id, user_id)
+
+    def skip_position_in_queue(self, queue_id, user_id):
+        return database.skip_position_in_queue(queue_id, user_id)
+
+    def set_user_position(self, queue_id, user_id, new_position):
+        return database.set_user_position(queue_id, user_id, new_position)
+
+    def shuffle_queue(self, queue_id, rng=random):
+        return database.shuffle_queue(queue_id, rng)
+
+    def sort_queue_by_join_time(self, queue_id):
+        return database.sort_queue_by_join_time(queue_id)
+
+    def set_queue_order(self, queue_id, user_ids):
+        return database.set_queue_order(queue_id, user_ids)
+
+    def remove_users_from_queue(self, queue_id, user_ids):
+        return database.remove_users_from_queue(queue_id, user_ids)
+
+    def clear_queue(self, queue_id):
+        return database.clear_queue(queue_id)
+
+    def join_by_name(self, chat_id, queue_name, user_id):
+        return database.join_by_name(chat_id, queue_name, user_id)
+
+    def exit_by_name(self, chat_id, queue_name, user_id):
+        return database.exit_by_name(chat_id, queue_name, user_id)
+
+    def rejoin_by_name(self, chat_id, queue_name, user_id):
+        return database.rejoin_by_name(chat_id, queue_name, user_id)
+
+    def skip_by_name(self, chat_id, queue_name, user_id):
+        return database.skip_by_name(chat_id, queue_name, user_id)
+
+    def join_by_id(self, chat_id, queue_id, user_id):
+        return database.join_by_id(chat_id, queue_id, user_id)
+
+    def exit_by_id(self, chat_id, queue_id, user_id):
+        return database.exit_by_id(chat_id, queue_id, user_id)
+
+    def rejoin_by_id(self, chat_id, queue_id, user_id):
+        return database.rejoin_by_id(chat_id, queue_id, user_id)
+
+    def skip_by_id(self, chat_id, queue_id, user_id):
+        return database.skip_by_id(chat_id, queue_id, user_id)
+
+    def get_cache_stats(self):
+        return database.get_cache_stats()
+
+    def check_member_counts(self, repair=False):
+        return database.check_member_counts(repair)
+
+def _timed(func):
+    """Декоратор, учитывающий время выполнения метода в метрике DB_QUERY_LATENCY"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with metrics.DB_QUERY_LATENCY.time(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+class _MemoryQueue:
+    """Очередь хранилища в памяти: участники - список user_id в порядке очереди"""
+
+    __slots__ = ('queue_id', 'chat_id', 'queue_name', 'creator_id', 'members', 'version', 'joined')
+
+    def __init__(self, queue_id, chat_id, queue_name, creator_id, members=None, version=0, joined=None):
+        self.queue_id = queue_id
+        self.chat_id = chat_id
+        self.queue_name = queue_name
+        self.creator_id = creator_id
+        self.members = members if members is not None else []
+        self.version = version
+        # user_id -> время вступления; словарь хранит порядок вступления, который
+        # разрешает равные времена так же, как rowid в SQLite
+        self.joined = joined if joined is not None else {user_id: 0 for user_id in self.members}
+
+    def position_of(self, user_id):
+        """Позиция (начиная с 1) участника или None"""
+        try:
+            return self.members.index(user_id) + 1
+        except ValueError:
+            return None
+
+class MemoryStorage(Storage):
+    """
+    Хранилище в памяти процесса: операции не обращаются к диску и выполняются
+    под одной блокировкой за микросекунды.
+
+    Порядок очереди - список user_id, позиция участника - его индекс в списке.
+    Если задан путь snapshot_path, данные загружаются из снимка при init(),
+    сохраняются в него каждые snapshot_interval секунд (если были изменения) и при
+    close(). Изменения после последнего снимка теряются при аварийном завершении,
+    а один файл снимка нельзя использовать из нескольких процессов.
+    """
+
+    def __init__(self, snapshot_path=None, snapshot_interval=STORAGE_SNAPSHOT_INTERVAL):
+        """
+        Args:
+            snapshot_path: путь к файлу снимка (None - без сохранения на диск)
+            snapshot_interval: период сохранения снимка в секундах (0 - только при close())
+        """
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._lock = threading.Lock()
+        self._users = {}  # user_id -> (username, display_name)
+        self._chats = {}  # chat_id -> chat_name
+        self._queues = {}  # queue_id -> _MemoryQueue
+        self._queue_ids = {}  # (chat_id, queue_name) -> queue_id
+        self._member_of = {}  # user_id -> множество queue_id, где пользователь участник
+        self._next_queue_id = 1
+        self._changes = 0  # счетчик изменений для сохранения снимка только после изменений
+        self._saved_changes = 0
+        self._stop = threading.Event()
+        self._snapshot_thread = None
+        self._initialized = False
+
+    def init(self):
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            self.load_snapshot()
+        # Снимок сохраняется только после успешной загрузки, иначе close() затер бы его пустыми данными
+        self._initialized = True
+        if self.snapshot_path and self.snapshot_interval > 0 and self._snapshot_thread is None:
+            self._stop.clear()
+            self._snapshot_thread = threading.Thread(target=self._snapshot_loop, name="storage-snapshot", daemon=True)
+            self._snapshot_thread.start()
+
+    def close(self):
+        if self._snapshot_thread is not None:
+            self._stop.set()
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+        if self.snapshot_path and self._initialized:
+            self.save_snapshot()
+
+    # Снимки
+
+    def _snapshot_loop(self):
+        while not self._stop.wait(self.snapshot_interval):
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                logger.error(f"Failed to save storage snapshot: {str(e)}", exc_info=True)
+
+    def save_snapshot(self):
+        """
+        Сохранение снимка, если с прошлого сохранения были изменения. Файл
+        записывается во временный и заменяется целиком, поэтому при сбое остается
+        предыдущий снимок.
+
+        Returns:
+            bool: True, если снимок записан
+        """
+        with self._lock:
+            if self._changes == self._saved_changes and os.path.exists(self.snapshot_path):
+                return False
+            changes = self._changes
+            data = {
+                'format': SNAPSHOT_FORMAT,
+                'next_queue_id': self._next_queue_id,
+                'users': [[user_id, username, display_name]
+                          for user_id, (username, display_name) in self._users.items()],
+                'chats': [[chat_id, chat_name] for chat_id, chat_name in self._chats.items()],
+                'queues': [[queue.queue_id, queue.chat_id, queue.queue_name, queue.creator_id,
+                            queue.version, list(queue.members), [[user_id, joined_at] for user_id, joined_at
+                                                                 in queue.joined.items()]]
+                           for queue in self._queues.values()],
+            }
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        with self._lock:
+            self._saved_changes = max(self._saved_changes, changes)
+        logger.debug(f"Storage snapshot saved to {self.snapshot_path}: {len(data['queues'])} queues")
+        return True
+
+    def load_snapshot(self):
+        """Замена данных хранилища данными из файла снимка"""
+        with open(self.snapshot_path, encoding='utf-8') as file:
+            data = json.load(file)
+        if data.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"Unsupported storage snapshot format: {data.get('format')}")
+        with self._lock:
+            self._users = {user_id: (username, display_name) for user_id, username, display_name in data['users']}
+            self._chats = {chat_id: chat_name for chat_id, chat_name in data['chats']}
+            self._queues = {}
+            self._queue_ids = {}
+            self._member_of = {}
+            for queue_id, chat_id, queue_name, creator_id, version, members, *joined in data['queues']:
+                # В снимках, записанных до появления /sort, времени вступления нет
+                joined = {user_id: joined_at for user_id, joined_at in joined[0]} if joined else None
+                self._queues[queue_id] = _MemoryQueue(queue_id, chat_id, queue_name, creator_id, members, version,
+                                                      joined)
+                self._queue_ids[(chat_id, queue_name)] = queue_id
+                for user_id in members:
+                    self._member_of.setdefault(user_id, set()).add(queue_id)
+            self._next_queue_id = data['next_queue_id']
+            self._changes = self._saved_changes
+        logger.info(f"Storage snapshot loaded from {self.snapshot_path}: {len(self._queues)} queues")
+
+    # Внутренние операции (вызываются под блокировкой)
+
+    def _member_rows(self, queue):
+        rows = []
+        for user_id in queue.members:
+            user = self._users.get(user_id)
+            # Как и в SQLite, участники без записи о пользователе не выводятся
+            if user is not None:
+                rows.append((user[1], user[0], len(rows) + 1, user_id))
+        return rows
+
+    def _snapshot(self, queue):
+        creator = self._users.get(queue.creator_id)
+        return self.QueueSnapshot(queue.version, creator[1] if creator else None, self._member_rows(queue))
+
+    def _changed(self, queue):
+        queue.version += 1
+        self._changes += 1
+
+    def _append(self, queue, user_id):
+        queue.members.append(user_id)
+        queue.joined[user_id] = time.time()
+        self._member_of.setdefault(user_id, set()).add(queue.queue_id)
+        self._changed(queue)
+
+    def _forget_member(self, queue, user_id):
+        queue.joined.pop(user_id, None)
+        queue_ids = self._member_of.get(user_id)
+        if queue_ids is not None:
+            queue_ids.discard(queue.queue_id)
+            if not queue_ids:
+                del self._member_of[user_id]
+
+    def _remove(self, queue, user_id):
+        queue.members.remove(user_id)
+        self._forget_member(queue, user_id)
+        self._changed(queue)
+
+    def _rewrite(self, queue, arrange):
+        """Аналог database._rewrite_queue: arrange(user_ids) возвращает оставшихся участников в новом порядке"""
+        if queue is None:
+            return None
+        order = arrange(list(queue.members))
+        kept = set(order)
+        removed = [user_id for user_id in queue.members if user_id not in kept]
+        if not removed and order == queue.members:
+            return None
+        for user_id in removed:
+            self._forget_member(queue, user_id)
+        queue.members = order
+        self._changed(queue)
+        return order, removed
+
+    def _move(self, queue, user_id, index=None):
+        queue.members.remove(user_id)
+        if index is None:
+            queue.members.append(user_id)
+        else:
+            queue.members.insert(index, user_id)
+        self._changed(queue)
+
+    def _swap_with_next(self, queue, user_id):
+        index = queue.members.index(user_id)
+        if index + 1 >= len(queue.members):
+            return False
+        queue.members[index], queue.members[index + 1] = queue.members[index + 1], queue.members[index]
+        self._changed(queue)
+        return True
+
+    def _bump_user_queues(self, user_id):
+        """Увеличение версий очередей, где пользователь участник или создатель"""
+        queue_ids = set(self._member_of.get(user_id, ()))
+        queue_ids.update(queue.queue_id for queue in self._queues.values() if queue.creator_id == user_id)
+        for queue_id in queue_ids:
+            self._queues[queue_id].version += 1
+        self._changes += 1
+
+    def _operation(self, status, queue, user_id, position=None):
+        """QueueOperation со снимком очереди и позицией пользователя в ней (если он участник)"""
+        snapshot = self._snapshot(queue)
+        for _, _, index, member_id in snapshot.members:
+            if member_id == user_id:
+                position = index
+                break
+        return self.QueueOperation(status, queue.queue_id, position, snapshot, queue.queue_name)
+
+    def _find(self, chat_id, queue_name):
+        queue_id = self._queue_ids.get((chat_id, queue_name))
+        return self._queues[queue_id] if queue_id is not None else None
+
+    def _find_by_id(self, chat_id, queue_id):
+        # Очередь другого чата не находится, как и в SQLiteStorage
+        queue = self._queues.get(queue_id)
+        return queue if queue is not None and queue.chat_id == chat_id else None
+
+    # Пользователи и чаты
+
+    @_timed
+    def add_or_update_user(self, user_id, username, display_name):
+        with self._lock:
+            self._users[user_id] = (username, display_name)
+            self._bump_user_queues(user_id)
+
+    @_timed
+    def get_user_info(self, user_id):
+        with self._lock:
+            return self._users.get(user_id, (None, None))
+
+    @_timed
+    def update_display_name(self, user_id, display_name):
+        with self._lock:
+            if user_id in self._users:
+                self._users[user_id] = (self._users[user_id][0], display_name)
+            self._bump_user_queues(user_id)
+
+    @_timed
+    def update_username(self, user_id, username):
+        with self._lock:
+            if user_id in self._users:
+                self._users[user_id] = (username, self._users[user_id][1])
+            self._bump_user_queues(user_id)
+
+    @_timed
+    def add_chat(self, chat_id, chat_name):
+        with self._lock:
+            if chat_id not in self._chats:
+                self._chats[chat_id] = chat_name
+                self._changes += 1
+
+    # Очереди
+
+    @_timed
+    def create_queue(self, queue_name, chat_id, creator_id):
+        with self._lock:
+            if (chat_id, queue_name) in self._queue_ids:
+                raise QueueExistsError(queue_name)
+            queue_id = self._next_queue_id
+            self._next_queue_id += 1
+            self._queues[queue_id] = _MemoryQueue(queue_id, chat_id, queue_name, creator_id)
+            self._queue_ids[(chat_id, queue_name)] = queue_id
+            self._changes += 1
+            return queue_id
+
+    @_timed
+    def delete_queue(self, queue_id):
+        with self._lock:
+            queue = self._queues.pop(queue_id, None)
+            if queue is None:
+                return
+            del self._queue_ids[(queue.chat_id, queue.queue_name)]
+            for user_id in queue.members:
+                queue_ids = self._member_of.get(user_id)
+                queue_ids.discard(queue_id)
+                if not queue_ids:
+                    del self._member_of[user_id]
+            self._changes += 1
+
+    @_timed
+    def get_queue_id(self, queue_name, chat_id):
+        with self._lock:
+            return self._queue_ids.get((chat_id, queue_name))
+
+    @_timed
+    def get_all_queues(self, chat_id):
+        with self._lock:
+            return sorted((queue.queue_name, len(queue.members))
+                          for queue in self._queues.values() if queue.chat_id == chat_id)
+
+    @_timed
+    def get_queue_creator(self, queue_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            creator = self._users.get(queue.creator_id) if queue else None
+            return creator[1] if creator else None
+
+    @_timed
+    def get_queue_version(self, queue_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            return queue.version if queue else None
+
+    @_timed
+    def get_queue_snapshot(self, queue_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            return self._snapshot(queue) if queue else None
+
+    @_timed
+    def get_queue_members_page(self, queue_id, offset, limit):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            if queue is None:
+                return None
+            creator = self._users.get(queue.creator_id)
+            members = []
+            for position, user_id in enumerate(queue.members[offset:offset + limit], offset + 1):
+                user = self._users.get(user_id)
+                if user is not None:
+                    members.append((user[1], user[0], position, user_id))
+            return self.QueuePage(queue.chat_id, queue.queue_name, queue.version,
+                                  creator[1] if creator else None, len(queue.members), members)
+
+    @_timed
+    def get_queue_members(self, queue_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            return self._member_rows(queue) if queue else []
+
+    @_timed
+    def get_queue_members_count(self, queue_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            return len(queue.members) if queue else 0
+
+    # Участники очередей
+
+    @_timed
+    def check_user_in_queue(self, queue_id, user_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            return queue.position_of(user_id) if queue else None
+
+    @_timed
+    def add_user_to_queue(self, queue_id, user_id):
+        with self._lock:
+            queue = self._queues[queue_id]
+            if user_id in queue.members:
+                raise ValueError(f"User {user_id} is already in queue {queue_id}")
+            self._append(queue, user_id)
+            return len(queue.members)
+
+    @_timed
+    def remove_user_from_queue(self, queue_id, user_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            if queue is not None and user_id in queue.members:
+                self._remove(queue, user_id)
+
+    @_timed
+    def rejoin_queue(self, queue_id, user_id):
+        with self._lock:
+            queue = self._queues[queue_id]
+            if user_id in queue.members:
+                self._move(queue, user_id)
+            else:
+                self._append(queue, user_id)
+            return len(queue.members)
+
+    @_timed
+    def skip_position_in_queue(self, queue_id, user_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            if queue is None or user_id not in queue.members:
+                return False
+            return self._swap_with_next(queue, user_id)
+
+    @_timed
+    def set_user_position(self, queue_id, user_id, new_position):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            position = queue.position_of(user_id) if queue else None
+            if position is None:
+                return False, None
+            if position == new_position:
+                return False, position
+            self._move(queue, user_id, new_position - 1)
+            return True, position
+
+    # Массовые операции администратора
+
+    @_timed
+    def shuffle_queue(self, queue_id, rng=random):
+        with self._lock:
+            return self._rewrite(self._queues.get(queue_id),
+                                 lambda user_ids: rng.sample(user_ids, len(user_ids))) is not None
+
+    @_timed
+    def sort_queue_by_join_time(self, queue_id):
+        with self._lock:
+            queue = self._queues.get(queue_id)
+            # sorted устойчива: при равном времени сохраняется порядок вступления
+            return self._rewrite(queue, lambda user_ids: sorted(queue.joined, key=queue.joined.get)) is not None
+
+    @_timed
+    def set_queue_order(self, queue_id, user_ids):
+        def arrange(members):
+            member_set = set(members)
+            first = [user_id for user_id in dict.fromkeys(user_ids) if user_id in member_set]
+            listed = set(first)
+            return first + [user_id for user_id in members if user_id not in listed]
+
+        with self._lock:
+            return self._rewrite(self._queues.get(queue_id), arrange) is not None
+
+    @_timed
+    def remove_users_from_queue(self, queue_id, user_ids):
+        excluded = set(user_ids)
+        with self._lock:
+            result = self._rewrite(self._queues.get(queue_id),
+                                   lambda members: [user_id for user_id in members if user_id not in excluded])
+            return result[1] if result else []
+
+    @_timed
+    def clear_queue(self, queue_id):
+        with self._lock:
+            result = self._rewrite(self._queues.get(queue_id), lambda members: [])
+            return len(result[1]) if result else 0
+
+    # Составные операции
+
+    # Вызываются под блокировкой с найденной очередью (None, если не найдена)
+
+    def _join(self, queue, user_id):
+        if queue is None:
+            return self.QueueOperation(self.QUEUE_NOT_FOUND, None, None, None, None)
+        if user_id in queue.members:
+            return self._operation(self.ALREADY_MEMBER, queue, user_id)
+        self._append(queue, user_id)
+        return self._operation(self.DONE, queue, user_id)
+
+    def _exit(self, queue, user_id):
+        if queue is None:
+            return self.QueueOperation(self.QUEUE_NOT_FOUND, None, None, None, None)
+        position = queue.position_of(user_id)
+        if position is None:
+            return self._operation(self.NOT_MEMBER, queue, user_id)
+        self._remove(queue, user_id)
+        return self._operation(self.DONE, queue, user_id, position)
+
+    def _rejoin(self, queue, user_id):
+        if queue is None:
+            return self.QueueOperation(self.QUEUE_NOT_FOUND, None, None, None, None)
+        if user_id not in queue.members:
+            return self._operation(self.NOT_MEMBER, queue, user_id)
+        self._move(queue, user_id)
+        return self._operation(self.DONE, queue, user_id)
+
+    def _skip(self, queue, user_id):
+        if queue is None:
+            return self.QueueOperation(self.QUEUE_NOT_FOUND, None, None, None, None)
+        if user_id not in queue.members:
+            return self._operation(self.NOT_MEMBER, queue, user_id)
+        if not self._swap_with_next(queue, user_id):
+            return self._operation(self.LAST_IN_QUEUE, queue, user_id)
+        return self._operation(self.DONE, queue, user_id)
+
+    @_timed
+    def join_by_name(self, chat_id, queue_name, user_id):
+        with self._lock:
+            return self._join(self._find(chat_id, queue_name), user_id)
+
+    @_timed
+    def exit_by_name(self, chat_id, queue_name, user_id):
+        with self._lock:
+            return self._exit(self._find(chat_id, queue_name), user_id)
+
+    @_timed
+    def rejoin_by_name(self, chat_id, queue_name, user_id):
+        with self._lock:
+            return self._rejoin(self._find(chat_id, queue_name), user_id)
+
+    @_timed
+    def skip_by_name(self, chat_id, queue_name, user_id):
+        with self._lock:
+            return self._skip(self._find(chat_id, queue_name), user_id)
+
+    @_timed
+    def join_by_id(self, chat_id, queue_id, user_id):
+        with self._lock:
+            return self._join(self._find_by_id(chat_id, queue_id), user_id)
+
+    @_timed
+    def exit_by_id(self, chat_id, queue_id, user_id):
+        with self._lock:
+            return self._exit(self._find_by_id(chat_id, queue_id), user_id)
+
+    @_timed
+    def rejoin_by_id(self, chat_id, queue_id, user_id):
+        with self._lock:
+            return self._rejoin(self._find_by_id(chat_id, queue_id), user_id)
+
+    @_timed
+    def skip_by_id(self, chat_id, queue_id, user_id):
+        with self._lock:
+            return self._skip(self._find_by_id(chat_id, queue_id), user_id)
+
+    def get_cache_stats(self):
+        # Все очереди всегда в памяти: промахов и вытеснений нет
+        with self._lock:
+            size = len(self._queues)
+        return {'size': size, 'maxsize': size, 'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def check_member_counts(self, repair=False):
+        # Количество участников - длина списка очереди, расхождений не бывает
+        return []
+
+def create_storage(backend=STORAGE_BACKEND):
+    """
+    Создание хранилища по названию реализации.
+
+    Args:
+        backend: 'sqlite' (SQLiteStorage) или 'memory' (MemoryStorage со снимками в STORAGE_SNAPSHOT_PATH)
+    """
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'memory':
+        return MemoryStorage(STORAGE_SNAPSHOT_PATH or None, STORAGE_SNAPSHOT_INTERVAL)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+# Хранилище бота, выбранное переменной окружения STORAGE_BACKEND
+default_storage = create_storage()
@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import signal
+import threading
+
+import telebot
+
+from config import OUTBOUND_LIMITS, OUTBOUND_WORKERS, METRICS_PORT, BOT_TOKEN, TELEGRAM_API_URL, ALLOWED_UPDATES
+from webhook import create_webhook_server, set_webhook
+
+logger = logging.getLogger(__name__)
+
+# Поля обновления, содержащие объект с чатом в поле chat
+CHAT_UPDATE_FIELDS = ('message', 'edited_message', 'chat_member', 'my_chat_member', 'chat_join_request')
+
+def update_chat_id(update):
+    """
+    ID чата обновления в виде словаря JSON (ключ распределения по процессам).
+
+    Returns:
+        int: ID чата, ID пользователя для нажатий без сообщения или 0 для обновлений без чата
+    """
+    for field in CHAT_UPDATE_FIELDS:
+        body = update.get(field)
+        if body is not None:
+            return body['chat']['id']
+    call = update.get('callback_query')
+    if call is not None:
+        message = call.get('message')
+        return message['chat']['id'] if message is not None else call['from']['id']
+    return 0
+
+def shard_for(chat_id, workers):
+    """Номер рабочего процесса, которому принадлежит чат"""
+    return chat_id % workers
+
+def run_worker(index, workers, updates, worker_init=None):
+    """
+    Точка входа рабочего процесса: обработка обновлений из очереди до получения None.
+
+    Args:
+        index: номер процесса
+        workers: общее количество рабочих процессов
+        updates: очередь обновлений (dict) этого процесса
+        worker_init: функция без аргументов, вызываемая после импорта handlers
+    """
+    # Остановкой управляет супервизор: Ctrl+C в терминале получает вся группа процессов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # Модуль handlers импортируется только в рабочем процессе: при импорте он создает бота,
+    # ограничители, планировщики и потоки, которые супервизору не нужны. Поэтому ограничители
+    # команд (RATE_LIMITS) и исходящих запросов у каждого процесса свои
+    import database
+    import handlers
+    from cache import LRUCache
+    from outbound import OutboundGovernor
+    from storage import default_storage
+
+    # Миграции уже применены супервизором, здесь запускается фоновый писатель групповой фиксации
+    default_storage.init()
+    # Имена пользователей может изменить любой процесс: закэшированные очереди сверяются
+    # с версией в базе данных, а кэш профилей, который нечем сверить дешевле чтения
+    # самой записи Users, отключается
+    database.set_shared(True)
+    handlers.user_profiles = LRUCache(0)
+    # Общий лимит Bot API делится между процессами; лимит группы целиком у процесса-владельца чата
+    global_limit = dict(OUTBOUND_LIMITS['global'], count=max(1, OUTBOUND_LIMITS['global']['count'] // workers))
+    handlers.outbound_governor = OutboundGovernor(global_limit, OUTBOUND_LIMITS['group'], workers=OUTBOUND_WORKERS)
+    if worker_init is not None:
+        worker_init()
+    if METRICS_PORT:
+        handlers.start_metrics_server(METRICS_PORT + index + 1)
+
+    logger.info(f"Worker {index} started")
+    while True:
+        update = updates.get()
+        if update is None:
+            break
+        try:
+            handlers.process_update_json(update)
+        except Exception as e:
+            logger.error(f"Worker {index} failed to process update: {str(e)}", exc_info=True)
+    handlers.stop_bot()
+    default_storage.close()
+    logger.info(f"Worker {index} stopped")
+
+def webhook_bot():
+    """Бот без обработчиков, через который супервизор устанавливает вебхук"""
+    if TELEGRAM_API_URL:
+        telebot.apihelper.API_URL = TELEGRAM_API_URL
+    return telebot.TeleBot(BOT_TOKEN, threaded=False)
+
+class Supervisor:
+    """
+    Супервизор рабочих процессов для режима вебхука.
+
+    Принимает обновления встроенным HTTP-сервером и передает каждое обновление
+    процессу, которому принадлежит его чат (chat_id % workers). Все обновления
+    одного чата обрабатываются одним процессом по порядку, поэтому очереди чата
+    изменяет только его процесс. Имена пользователей может изменить любой процесс,
+    поэтому закэшированная очередь перед использованием сверяется с версией в базе
+    данных (database.set_shared), а кэш профилей пользователей в рабочих процессах
+    отключен. Процессы работают с общим файлом базы данных в режиме WAL.
+    Завершившийся с ошибкой процесс перезапускается, необработанные обновления
+    остаются в его очереди. Сам супервизор модуль handlers не импортирует.
+    """
+
+    def __init__(self, workers, worker_init=None):
+        """
+        Args:
+            workers: количество рабочих процессов
+            worker_init: функция без аргументов, вызываемая в каждом рабочем процессе
+                после импорта handlers (должна быть доступна по имени модуля)
+        """
+        self.workers = workers
+        self.worker_init = worker_init
+        self.routed = [0] * workers
+        self.restarts = 0
+        # spawn: процессы не наследуют потоки и соединения с базой данных супервизора
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._monitor_thread = None
+        self.webhook_server = None
+
+    def route(self, update):
+        """Передача обновления (dict) процессу-владельцу его чата"""
+        index = shard_for(update_chat_id(update), self.workers)
+        self._queues[index].put(update)
+        with self._lock:
+            self.routed[index] += 1
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=run_worker, args=(index, self.workers, self._queues[index], self.worker_init),
+            name=f"worker-{index}", daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _monitor(self):
+        """Перезапуск рабочих процессов, завершившихся до остановки супервизора"""
+        while not self._stopping.wait(1):
+            for index, process in enumerate(self._processes):
+                if not process.is_alive() and not self._stopping.is_set():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}, restarting")
+                    self.restarts += 1
+                    self._start_worker(index)
+
+    def start(self, on_update=None):
+        """
+        Запуск рабочих процессов и HTTP-сервера вебхука в отдельном потоке.
+
+        Args:
+            on_update: функция, получающая каждое обновление вместо route (для обертки route)
+        """
+        for index in range(self.workers):
+            self._start_worker(index)
+        self._monitor_thread = threading.Thread(target=self._monitor, name="supervisor-monitor", daemon=True)
+        self._monitor_thread.start()
+        self.webhook_server = create_webhook_server(on_update or self.route)
+        self.webhook_server.start()
+        logger.info(f"Supervisor started {self.workers} worker processes")
+
+    def run(self):
+        """Работа до получения SIGTERM или SIGINT: запуск, установка вебхука, остановка"""
+        stop_requested = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: stop_requested.set())
+        self.start()
+        try:
+            set_webhook(webhook_bot(), ALLOWED_UPDATES)
+            while not stop_requested.wait(1):
+                pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10):
+        """
+        Остановка: прием обновлений прекращается, рабочие процессы обрабатывают
+        уже полученные обновления и завершаются.
+
+        Args:
+            timeout: сколько секунд ждать завершения каждого процесса
+        """
+        self._stopping.set()
+        if self.webhook_server is not None:
+            self.webhook_server.stop()
+        if self._monitor_thread is not None:
+            self._monitor_thread.join()
+        for updates in self._queues:
+            updates.put(None)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop in {timeout} s, terminating")
+                process.terminate()
+                process.join()
+        logger.info(f"Supervisor stopped, updates routed per worker: {self.stats()['routed']}")
+
+    def stats(self):
+        """Статистика: обновления по процессам, живые процессы и перезапуски"""
+        with self._lock:
+            routed = list(self.routed)
+        return {
+            'routed': routed,
+            'alive': sum(1 for process in self._processes if process is not None and process.is_alive()),
+            'restarts': self.restarts,
+        }
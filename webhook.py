@@ -0,0 +1,164 @@
+import hmac
+import json
+import ssl
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL
+from config import WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram передает секретный токен, указанный при установке вебхука
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# Максимальный размер тела запроса с обновлением (в байтах)
+MAX_BODY_SIZE = 1024 * 1024
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик HTTP-запросов от Telegram: принимает только POST с JSON обновления"""
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            self._respond(404)
+            return
+
+        if server.secret_token:
+            received = self.headers.get(SECRET_TOKEN_HEADER, '')
+            if not hmac.compare_digest(received.encode(), server.secret_token.encode()):
+                logger.warning(f"Webhook request with invalid secret token from {self.client_address[0]}")
+                self._respond(403)
+                return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > MAX_BODY_SIZE:
+            self._respond(400)
+            return
+
+        try:
+            update = json.loads(self.rfile.read(length).decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            self._respond(400)
+            return
+        if not isinstance(update, dict):
+            self._respond(400)
+            return
+
+        try:
+            server.on_update(update)
+        except Exception as e:
+            # Отвечаем 200, иначе Telegram будет повторять доставку того же обновления
+            logger.error(f"Error processing webhook update: {str(e)}", exc_info=True)
+        self._respond(200)
+
+    def do_GET(self):
+        self._respond(405)
+
+    def _respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Журнал запросов ведется через logging, а не в stderr
+        logger.debug(f"Webhook {self.client_address[0]}: {format % args}")
+
+class WebhookHTTPServer(ThreadingHTTPServer):
+    """HTTP-сервер с очередью входящих соединений для параллельной доставки обновлений"""
+
+    # Telegram открывает до 100 соединений одновременно (max_connections в setWebhook),
+    # очередь по умолчанию (5 соединений) переполняется, и соединения сбрасываются
+    request_queue_size = 128
+    daemon_threads = True
+
+class WebhookServer:
+    """
+    Встроенный HTTP-сервер для получения обновлений Telegram через вебхук.
+
+    Каждое обновление в виде словаря JSON передается функции on_update.
+    """
+
+    def __init__(self, host, port, path, on_update, secret_token=None, ssl_cert=None, ssl_key=None):
+        """
+        Args:
+            host: адрес, на котором слушает сервер
+            port: порт сервера
+            path: путь URL, на который Telegram отправляет обновления
+            on_update: функция, принимающая обновление (dict)
+            secret_token: секретный токен для проверки заголовка X-Telegram-Bot-Api-Secret-Token
+            ssl_cert: путь к сертификату для HTTPS (без него сервер работает по HTTP,
+                например за обратным прокси)
+            ssl_key: путь к закрытому ключу сертификата
+        """
+        self._server = WebhookHTTPServer((host, port), WebhookRequestHandler)
+        self._server.path = path
+        self._server.on_update = on_update
+        self._server.secret_token = secret_token
+        if ssl_cert:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(ssl_cert, ssl_key)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread = None
+        self._serving = False
+
+    @property
+    def address(self):
+        """Фактический адрес сервера (host, port)"""
+        return self._server.server_address
+
+    def serve_forever(self):
+        """Обработка запросов в текущем потоке до вызова stop()"""
+        logger.info(f"Webhook server listening on {self.address[0]}:{self.address[1]}{self._server.path}")
+        self._serving = True
+        try:
+            self._server.serve_forever()
+        finally:
+            self._serving = False
+
+    def start(self):
+        """Запуск сервера в отдельном потоке"""
+        self._serving = True
+        self._thread = threading.Thread(target=self.serve_forever, name="webhook-server", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Остановка сервера (вызывается из другого потока)"""
+        if self._serving:
+            self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def create_webhook_server(on_update):
+    """HTTP-сервер вебхука с настройками из config, передающий обновления функции on_update"""
+    return WebhookServer(
+        WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, on_update,
+        secret_token=WEBHOOK_SECRET or None,
+        ssl_cert=WEBHOOK_SSL_CERT or None,
+        ssl_key=WEBHOOK_SSL_KEY or None
+    )
+
+def set_webhook(bot, allowed_updates):
+    """
+    Установка вебхука в Telegram, если задан публичный адрес WEBHOOK_URL.
+
+    Args:
+        bot: telebot.TeleBot, от имени которого устанавливается вебхук
+        allowed_updates: типы обновлений, которые бот запрашивает у Telegram
+    """
+    if not WEBHOOK_URL:
+        return
+    certificate = open(WEBHOOK_SSL_CERT, 'rb') if WEBHOOK_SSL_CERT else None
+    try:
+        bot.set_webhook(url=WEBHOOK_URL, certificate=certificate, secret_token=WEBHOOK_SECRET or None,
+                        allowed_updates=allowed_updates)
+    finally:
+        if certificate is not None:
+            certificate.close()
+    logger.info(f"Webhook set to {WEBHOOK_URL}")